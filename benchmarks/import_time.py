@@ -0,0 +1,69 @@
+"""
+    Import time benchmark of the CLI entry point.
+
+    Each run starts a fresh interpreter with `-X importtime` importing the target module from src/, and reports the
+    median cumulative import time of the target and of the heaviest imported packages. Optional dependencies that should
+    only be loaded on first use (plotly, requests, ...) are reported if they were imported anyway.
+
+    Usage:
+        python benchmarks/import_time.py [-m main] [-r 5] [-o import_time.json]
+"""
+from argparse import ArgumentParser
+import json, os, statistics, subprocess, sys
+
+SRC_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+LAZY_MODULES = ['plotly', 'requests', 'webbrowser', 'tqdm', 'read']
+
+
+def measure_once(module):
+    # importtime lines are: "import time: self [us] | cumulative | imported package"
+    output = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import %s' % module],
+                            cwd=SRC_PATH, capture_output=True, text=True, check=True).stderr
+    cumulative = dict()
+    for line in output.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, self_us, cumulative_us, name = [x.strip() for x in line.replace('import time:', '|').split('|')]
+        cumulative[name.strip()] = int(cumulative_us)
+    return cumulative
+
+
+def benchmark(module='main', repeat=5, top=10):
+    runs = [measure_once(module) for _ in range(repeat)]
+    total_s = statistics.median(run[module] for run in runs) / 1e6
+
+    # Only top level packages, to keep the report readable
+    packages = dict()
+    for name in runs[0].keys():
+        if '.' not in name and name != module:
+            packages[name] = statistics.median(run.get(name, 0) for run in runs) / 1e6
+    heaviest = sorted(packages.items(), key=lambda x: x[1], reverse=True)[:top]
+    eagerly_loaded = [name for name in LAZY_MODULES if name in runs[0]]
+
+    return {
+        'module': module,
+        'repeat': repeat,
+        'python': sys.version.split()[0],
+        'import_time_s': total_s,
+        'heaviest_packages_s': dict(heaviest),
+        'eagerly_loaded_lazy_modules': eagerly_loaded
+    }
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Measure the import time of a CANtack module')
+    parser.add_argument('-m', '--module', type=str, default='main', help='The module to import (from src/)')
+    parser.add_argument('-r', '--repeat', type=int, default=5, help='Number of fresh interpreters to run')
+    parser.add_argument('-o', '--output', type=str, default=None, help='Optional JSON file where to store the results')
+    args = parser.parse_args()
+
+    results = benchmark(args.module, args.repeat)
+    print('Importing %s takes %.3fs (median of %d runs)' % (results['module'], results['import_time_s'], results['repeat']))
+    for name, seconds in results['heaviest_packages_s'].items():
+        print('    %-20s %.3fs' % (name, seconds))
+    if len(results['eagerly_loaded_lazy_modules']) > 0:
+        print('Modules that should be loaded on first use but were imported: %s' % ', '.join(results['eagerly_loaded_lazy_modules']))
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=4)
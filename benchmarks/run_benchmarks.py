@@ -0,0 +1,259 @@
+"""
+    Benchmark suite of CANtack on synthetic traces, no network access is needed.
+
+    For every trace size a synthetic trace is generated (see src/synthetic_trace.py) and the loading, READ, the injection
+    and masquerade functions, every attack, the attack configuration generator and the export are timed. Results are
+    stored as JSON and can be compared against a previous run to spot regressions.
+
+    Usage:
+        python benchmarks/run_benchmarks.py --sizes 1 10 50
+        python benchmarks/run_benchmarks.py --sizes 1 --only inject_function drop_attack
+        python benchmarks/run_benchmarks.py --sizes 1 --compare benchmarks/results/baseline.json
+"""
+from argparse import ArgumentParser
+from datetime import datetime
+import gc, json, os, platform, shutil, statistics, subprocess, sys, tempfile, time, warnings
+
+ROOT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+SRC_PATH = os.path.join(ROOT_PATH, 'src')
+RESULTS_PATH = os.path.join(ROOT_PATH, 'benchmarks', 'results')
+sys.path.insert(0, SRC_PATH)
+
+from synthetic_trace import generate_trace, export_trace
+from dataset_loader import load_dataset
+from read import read
+from injection_function import inject_function
+from masquerade_function import masquerade_function
+from basic_injection_attack import Basic_injection_attack
+from dos_attack import Dos_attack
+from drop_attack import Drop_attack
+from fuzzy_injection import Fuzzy_injection_attack
+from progressive_injection_attack import Progressive_injection_attack
+from replay_attack import Replay_attack
+from attack_generator import AttackConfGenerator
+from id_utils import id_to_hex
+from time_utils import ns_to_seconds
+from enums.implementation_type import ImplementationType
+
+N_PACKETS = 100
+
+
+"""
+    Every benchmark receives the environment of the current trace, does its (untimed) setup and returns the function to time
+"""
+
+def bench_load_dataset(env):
+    return lambda: load_dataset(path=env['csv_path'], verbose=False)
+
+def bench_read(env):
+    trace = env['trace'].head(env['read_frames'])
+    return lambda: read(trace, verbose=False)
+
+def bench_inject_function(env):
+    payloads = ['1' * 64] * N_PACKETS
+    return lambda: inject_function(env['trace'], env['id'], payloads, env['btd'], 20)
+
+def bench_masquerade_function(env):
+    dataset = env['trace'].copy()
+    replacements = {(0, 64): ['1' * 64] * N_PACKETS}
+    return lambda: masquerade_function(dataset, env['id'], env['btd'], replacements, verbose=False)
+
+def bench_basic_injection(env):
+    attack = Basic_injection_attack(env['id'], '1' * 64, env['btd'], N_PACKETS, ImplementationType.INJECTION, injection_rate=20)
+    return lambda: attack.build_dataset(env['trace'])
+
+def bench_basic_masquerade(env):
+    dataset = env['trace'].copy()
+    attack = Basic_injection_attack(env['id'], '1' * 64, env['btd'], N_PACKETS, ImplementationType.MASQUERADE)
+    return lambda: attack.build_dataset(dataset)
+
+def bench_dos_attack(env):
+    attack = Dos_attack(env['btd'], 0.1)
+    return lambda: attack.build_dataset(env['trace'])
+
+def bench_drop_attack(env):
+    attack = Drop_attack(env['id'], env['btd'], N_PACKETS)
+    return lambda: attack.build_dataset(env['trace'])
+
+def bench_fuzzy_injection(env):
+    attack = Fuzzy_injection_attack(env['id'], env['btd'], N_PACKETS, ImplementationType.INJECTION, bit_ranges=[(0, 64)], injection_rate=20, seed=42)
+    return lambda: attack.build_dataset(env['trace'])
+
+def bench_fuzzy_masquerade(env):
+    dataset = env['trace'].copy()
+    attack = Fuzzy_injection_attack(env['id'], env['btd'], N_PACKETS, ImplementationType.MASQUERADE, bit_ranges=[(0, 64)], seed=42)
+    return lambda: attack.build_dataset(dataset)
+
+def bench_fuzzy_masquerade_default(env):
+    # Without bit ranges the whole payload is fuzzed
+    dataset = env['trace'].copy()
+    attack = Fuzzy_injection_attack(env['id'], env['btd'], N_PACKETS, ImplementationType.MASQUERADE, seed=42)
+    return lambda: attack.build_dataset(dataset)
+
+def bench_progressive_injection(env):
+    payloads = [bin(x)[2:].zfill(64) for x in range(N_PACKETS)]
+    attack = Progressive_injection_attack(env['id'], payloads, int(env['btd']), ImplementationType.INJECTION, injection_rate=20)
+    return lambda: attack.build_dataset(env['trace'])
+
+def bench_replay_masquerade(env):
+    dataset = env['trace'].copy()
+    attack = Replay_attack(env['id'], env['btd'], env['btd'] - 10, N_PACKETS, ImplementationType.MASQUERADE, pattern_packets=10)
+    return lambda: attack.build_dataset(dataset)
+
+def bench_attack_generator(env):
+    def run():
+        generator = AttackConfGenerator(env['trace'], starting_time=10)
+        generator.random_fill(ratio=0.01)
+    return run
+
+def bench_export_dataset(env):
+    attack = Drop_attack(env['id'], env['btd'], N_PACKETS)
+    attack.original_dataset = env['trace']
+    attack.vulnerable_dataset = env['trace']
+    path = os.path.join(env['tmp_dir'], 'vulnerable.csv')
+    return lambda: attack.export_dataset(path=path, verbose=False)
+
+BENCHMARKS = [
+    ('load_dataset', bench_load_dataset),
+    ('read', bench_read),
+    ('inject_function', bench_inject_function),
+    ('masquerade_function', bench_masquerade_function),
+    ('basic_injection', bench_basic_injection),
+    ('basic_masquerade', bench_basic_masquerade),
+    ('dos_attack', bench_dos_attack),
+    ('drop_attack', bench_drop_attack),
+    ('fuzzy_injection', bench_fuzzy_injection),
+    ('fuzzy_masquerade', bench_fuzzy_masquerade),
+    ('fuzzy_masquerade_default', bench_fuzzy_masquerade_default),
+    ('progressive_injection', bench_progressive_injection),
+    ('replay_masquerade', bench_replay_masquerade),
+    ('attack_generator', bench_attack_generator),
+    ('export_dataset', bench_export_dataset),
+]
+
+
+def time_call(function, repeat):
+    timings = list()
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings)
+
+
+def prepare_env(n_frames, tmp_dir, read_frames, seed):
+    env = dict()
+    start = time.perf_counter()
+    env['trace'] = generate_trace(n_frames=n_frames, seed=seed, verbose=False)
+    env['generate_s'] = time.perf_counter() - start
+
+    env['csv_path'] = os.path.join(tmp_dir, 'trace_%d.csv' % n_frames)
+    start = time.perf_counter()
+    export_trace(env['trace'], env['csv_path'])
+    env['write_csv_s'] = time.perf_counter() - start
+
+    # Attack the most frequent id with 8 bytes payloads, in the middle of the trace
+    trace = env['trace']
+    counts = trace.loc[trace['Dlc'] == 8, 'Id'].value_counts()
+    env['id'] = id_to_hex(counts.index[0])
+    env['btd'] = float(int(ns_to_seconds(trace['Time'].iloc[-1] - trace['Time'].iloc[0]) / 2))
+    env['read_frames'] = read_frames
+    env['tmp_dir'] = tmp_dir
+    return env
+
+
+def run(sizes, only=None, repeat=1, read_frames=1000000, seed=42):
+    results = {
+        'timestamp': datetime.now().isoformat(),
+        'commit': git_commit(),
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'repeat': repeat,
+        'read_frames': read_frames,
+        'sizes': dict()
+    }
+    tmp_dir = tempfile.mkdtemp(prefix='cantack_bench_')
+    try:
+        for size in sizes:
+            n_frames = int(size * 1e6)
+            print('=== %d frames' % n_frames)
+            env = prepare_env(n_frames, tmp_dir, read_frames, seed)
+            size_results = {'generate_trace': env['generate_s'], 'write_csv': env['write_csv_s']}
+            print('%-25s %10.3fs' % ('generate_trace', env['generate_s']))
+            print('%-25s %10.3fs' % ('write_csv', env['write_csv_s']))
+
+            for name, benchmark in BENCHMARKS:
+                if only is not None and name not in only:
+                    continue
+                with warnings.catch_warnings():
+                    warnings.simplefilter('ignore')
+                    try:
+                        size_results[name] = time_call(benchmark(env), repeat)
+                        print('%-25s %10.3fs' % (name, size_results[name]))
+                    except Exception as e:
+                        size_results[name] = None
+                        print('%-25s %10s (%s: %s)' % (name, 'FAILED', type(e).__name__, e))
+            results['sizes'][str(n_frames)] = size_results
+            del env
+            gc.collect()
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return results
+
+
+def compare(results, baseline, threshold):
+    """
+        Print the ratio between the current and the baseline timings, flagging the ones slower than 1 + threshold
+    """
+    regressions = 0
+    print('\n%-12s %-25s %10s %10s %8s' % ('Frames', 'Benchmark', 'Baseline', 'Current', 'Ratio'))
+    for size, size_results in results['sizes'].items():
+        if size not in baseline['sizes']:
+            continue
+        for name, current in size_results.items():
+            previous = baseline['sizes'][size].get(name)
+            if current is None or previous is None or previous == 0:
+                continue
+            ratio = current / previous
+            flag = ' REGRESSION' if ratio > 1 + threshold else ''
+            regressions += flag != ''
+            print('%-12s %-25s %9.3fs %9.3fs %7.2fx%s' % (size, name, previous, current, ratio, flag))
+    return regressions
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT_PATH, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Run the CANtack benchmark suite on synthetic traces')
+    parser.add_argument('--sizes', type=float, nargs='+', default=[1, 10, 50], help='Trace sizes in millions of frames')
+    parser.add_argument('--only', type=str, nargs='+', default=None, help='Run only the given benchmarks: %s' % ', '.join(n for n, _ in BENCHMARKS))
+    parser.add_argument('-r', '--repeat', type=int, default=1, help='Number of timed runs of every benchmark (median is stored)')
+    parser.add_argument('--read_frames', type=int, default=1000000, help='Number of frames READ is run on, READ being quadratic in Python')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('-o', '--output', type=str, default=None, help='Where to store the results (default benchmarks/results/<timestamp>.json)')
+    parser.add_argument('--compare', type=str, default=None, help='Previous results to compare against')
+    parser.add_argument('--threshold', type=float, default=0.1, help='Slowdown reported as regression when comparing')
+    args = parser.parse_args()
+
+    results = run(args.sizes, only=args.only, repeat=args.repeat, read_frames=args.read_frames, seed=args.seed)
+
+    output = args.output
+    if output is None:
+        if not os.path.exists(RESULTS_PATH):
+            os.makedirs(RESULTS_PATH)
+        output = os.path.join(RESULTS_PATH, '%s.json' % datetime.now().strftime('%Y%m%d_%H%M%S'))
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=4)
+    print('Results stored in %s' % output)
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.threshold) > 0:
+            sys.exit(1)
@@ -0,0 +1,154 @@
+import numpy as np
+
+"""
+    Conflict analysis of the attacks of a configuration, to find the groups of attacks that can be applied
+    independently on the same base dataset and merged afterwards, and to split them in time segments of the dataset.
+
+    Two attacks conflict, and are applied in order in the same group, when:
+        - they read or change frames of the same id in overlapping time spans
+        - one of them is a DoS and their time spans overlap, as the bus check of the DoS looks at the frames of every id
+    Spans are lists of (start, end) times, attacks whose span cannot be bounded (Attack.get_span returns None) span the whole dataset. As the attacks pick
+    the frames of their id after their beginning, the spans on an id some attack drops are extended by the number of
+    dropped frames.
+"""
+
+UNBOUNDED_SPAN = (-np.inf, np.inf)
+
+
+def attack_spans(attacks, dataset):
+    """
+    Return the time spans in nanoseconds of the attacks, as lists of (start, end) couples ([UNBOUNDED_SPAN] if they
+    cannot be bounded, None for the attacks that will be skipped)
+
+    Parameters
+    ----------
+    attacks: list(Attack or None)
+        The attacks of the configuration in order, None for the ones that will be skipped
+
+    dataset: pandas.Dataframe
+        The base dataset the attacks are applied to
+    """
+    dropped = dict()
+    for attack in attacks:
+        if attack is not None and attack.attack_type == 'DROP':
+            for _id in attack.get_ids():
+                dropped[_id] = dropped.get(_id, 0) + attack.parameters['dropped_packets']
+
+    return [attack_span(attack, dataset, dropped) if attack is not None else None for attack in attacks]
+
+
+def attack_span(attack, dataset, dropped=None):
+    """
+    Return the time span in nanoseconds of the attack, as a list of (start, end) couples ([UNBOUNDED_SPAN] if it
+    cannot be bounded)
+
+    Parameters
+    ----------
+    dropped: dict(integer -> integer), optional
+        The number of frames of every id dropped by the other attacks, which extend the spans on the id
+    """
+    span = attack.get_span(dataset)
+    if span is None:
+        return [UNBOUNDED_SPAN]
+    span = list(span) if type(span) == list else [span]
+    for _id in attack.get_ids():
+        if dropped is not None and dropped.get(_id, 0) > 0:
+            times = attack.get_id_rows(dataset)['Time'].to_numpy()
+            span = [(x[0], _extend(times, x[1], dropped[_id])) for x in span]
+    return span
+
+
+def conflict_groups(attacks, spans):
+    """
+    Return the groups of conflicting attacks, as lists of positions in attacks in increasing order, sorted by their
+    first attack
+
+    Parameters
+    ----------
+    attacks: list(Attack or None)
+        The attacks of the configuration in order, None for the ones that will be skipped
+
+    spans: list(list(couple(integer, integer)))
+        The spans of the attacks, as returned by attack_spans
+    """
+    n = len(attacks)
+    parent = list(range(n))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    def union(i, j):
+        i, j = find(i), find(j)
+        if i != j:
+            parent[max(i, j)] = min(i, j)
+
+    by_id = dict()
+    dos = list()
+    for i, attack in enumerate(attacks):
+        if attack is None:
+            continue
+        for _id in attack.get_ids():
+            by_id.setdefault(_id, list()).append(i)
+        if attack.attack_type == 'DOS':
+            dos.append(i)
+
+    for _id, positions in by_id.items():
+        for a, i in enumerate(positions):
+            for j in positions[a + 1:]:
+                if _overlap(spans[i], spans[j]):
+                    union(i, j)
+
+    for i in dos:
+        for j in range(n):
+            if j != i and spans[j] is not None and _overlap(spans[i], spans[j]):
+                union(i, j)
+
+    groups = dict()
+    for i in range(n):
+        groups.setdefault(find(i), list()).append(i)
+    return [groups[root] for root in sorted(groups.keys())]
+
+
+def time_segments(groups, spans, n_segments):
+    """
+    Split the groups of conflicting attacks in at most n_segments time segments with about the same number of
+    attacks. Return the segments as couples (positions of the attacks in increasing order, time span of the segment),
+    the span being None if the attacks of the segment have no span (they are all skipped)
+    """
+    group_spans = [_hull([spans[i] for i in group]) for group in groups]
+    order = sorted(range(len(groups)), key=lambda g: group_spans[g][0] if group_spans[g] is not None else -np.inf)
+    n_attacks = sum(len(group) for group in groups)
+
+    segments = list()
+    current = list()
+    done = 0
+    for k, g in enumerate(order):
+        current += groups[g]
+        # A segment is closed once it has its share of the attacks left
+        if len(current) * (n_segments - len(segments)) >= n_attacks - done or k == len(order) - 1:
+            segments.append((sorted(current), _hull([spans[i] for i in current])))
+            done += len(current)
+            current = list()
+    return segments
+
+
+def _extend(times, end, n_frames):
+    # Time of the frame n_frames frames after end (the last one if there are not enough)
+    if end == np.inf or len(times) == 0:
+        return end
+    position = int(np.searchsorted(times, end, side='right')) - 1 + n_frames
+    return max(end, int(times[min(position, len(times) - 1)]))
+
+
+def _hull(spans):
+    spans = [x for span in spans if span is not None for x in span]
+    if len(spans) == 0:
+        return None
+    return (min(x[0] for x in spans), max(x[1] for x in spans))
+
+
+def _overlap(a, b):
+    return any(x[0] <= y[1] and y[0] <= x[1] for x in a for y in b)
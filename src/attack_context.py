@@ -0,0 +1,67 @@
+from id_utils import id_to_int
+from time_utils import ns_to_seconds
+import pandas as pd
+
+"""
+    Values derived from the original dataset that several attacks need (per id index, average inter-arrival times and
+    READ signal maps). They are computed the first time they are asked and then shared by all the attacks of a run, or
+    of a batch of runs on the same dataset.
+"""
+
+
+class AttackContext(object):
+    dataset = None
+
+    def __init__(self, dataset):
+        """
+        Parameters
+        ----------
+        dataset: pandas.Dataframe
+            The original dataset. Values are computed on it when first asked, so payloads tampered in place in the
+            meantime (masquerade attacks) are seen by the signal maps
+        """
+        assert type(dataset) == pd.DataFrame
+        self.dataset = dataset
+        self.__id_indices = None
+        self.__average_intervals = dict()
+        self.__signals = dict()
+
+    def id_indices(self):
+        """
+        Return the positions of the frames of every id, by integer id
+        """
+        if self.__id_indices is None:
+            self.__id_indices = self.dataset.groupby('Id', sort=False).indices
+        return self.__id_indices
+
+    def id_rows(self, _id, columns=None):
+        """
+        Return the frames of the id (hexadecimal string or integer) in the original dataset, only the given columns if
+        any
+        """
+        positions = self.id_indices().get(id_to_int(_id))
+        positions = positions if positions is not None else slice(0, 0)
+        if columns is None:
+            return self.dataset.iloc[positions]
+        # Taking the columns one by one is much faster than iloc on the mixed dtypes dataframe
+        return pd.DataFrame({x: self.dataset[x].to_numpy()[positions] for x in columns}, index=self.dataset.index[positions])
+
+    def average_interval(self, _id):
+        """
+        Return the average inter-arrival time of the id in seconds, None if it has less than two frames
+        """
+        key = id_to_int(_id)
+        if key not in self.__average_intervals:
+            times = self.id_rows(key)['Time'].to_numpy()
+            self.__average_intervals[key] = ns_to_seconds(times[-1] - times[0]) / (len(times) - 1) if len(times) > 1 else None
+        return self.__average_intervals[key]
+
+    def signals(self, _id):
+        """
+        Return the signals found by READ in the payloads of the id, as returned by read(...)[id]
+        """
+        key = id_to_int(_id)
+        if key not in self.__signals:
+            from read import read
+            self.__signals[key] = read(self.id_rows(key), verbose=False)[key]
+        return self.__signals[key]
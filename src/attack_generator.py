@@ -10,6 +10,9 @@ from enum import Enum
 from enums.implementation_type import ImplementationType
 from enums.attack_type import AttackType
 from read import read, SIGN_TYPE
+from id_utils import id_to_int, ids_to_hex
+from time_utils import ns_to_seconds, seconds_to_ns
+from config_loader import JsonlAttackWriter, is_jsonl
 from tqdm import tqdm
 from datetime import datetime
 
@@ -42,6 +45,8 @@ class AttackConfGenerator(object):
     max_delta = None
 
     attacks = None
+    n_attacks = 0
+    writer = None
     ids = None
     dataset_duration = None
 
@@ -51,6 +56,10 @@ class AttackConfGenerator(object):
     id_to_tampered_n = None
     id_to_signals = None
     id_to_period = None
+    id_to_avg_period = None
+    id_to_count = None
+    id_to_usable_count = None
+    id_to_dlc = None
     id_to_n_attacks = None
 
     # TODO: add also the remaing two types
@@ -63,23 +72,38 @@ class AttackConfGenerator(object):
         'REPLAY': ""
     }
 
-    def __init__(self, dataset, blacklisted_ids=None, seed=42, starting_time=100):
+    def __init__(self, dataset, blacklisted_ids=None, seed=42, starting_time=100, stream_path=None, dataset_name=None):
+        """
+        Parameters
+        ----------
+        stream_path: string, optional
+            If given, the generated attacks are written to this JSON Lines file as they are generated instead of
+            being kept in memory until export
+
+        dataset_name: string, optional
+            The dataset field written in the header of the streamed configuration
+        """
         assert type(dataset) == pd.DataFrame
         assert type(seed) == int
         assert type(starting_time) == int
         assert starting_time > 0
         self.dataset = dataset
-        self.ids = list(set(dataset['Id'].tolist()))
+        # The generated configurations refer to the ids as hexadecimal strings
+        self.ids = ids_to_hex(dataset['Id'].unique()).tolist()
         if blacklisted_ids is not None:
             self.blacklisted_ids = blacklisted_ids
             for _id in self.blacklisted_ids:
                 if _id in self.ids:
                     self.ids.remove(_id)
         self.attacks = list()
+        self.n_attacks = 0
+        if stream_path is not None:
+            self.writer = JsonlAttackWriter(stream_path, dataset=dataset_name)
         self.starting_time_delta = starting_time
         self.first_packet_timestamp = dataset.head(1)['Time'].tolist()[0]
         self.last_packet_timestamp = dataset.tail(1)['Time'].tolist()[0]
-        self.max_delta = self.last_packet_timestamp - self.first_packet_timestamp
+        # Timestamps are in nanoseconds as in the dataset, deltas and periods in seconds as in the configurations
+        self.max_delta = ns_to_seconds(self.last_packet_timestamp - self.first_packet_timestamp)
         self.id_to_signals = dict()
         self.id_to_tampered_n = dict()
         self.id_to_n_attacks = dict()
@@ -91,22 +115,32 @@ class AttackConfGenerator(object):
 
     def __compute_periods(self):
         assert type(self.dataset) == pd.DataFrame
+        # Single grouped pass instead of one full-trace filter per id
+        times = self.dataset['Time']
+        by_id = times.groupby(self.dataset['Id'], sort=False)
+        max_deltas = by_id.diff().groupby(self.dataset['Id'], sort=False).max()
+        counts = by_id.size()
+        spans = by_id.max() - by_id.min()
+        starting_timestamp = self.first_packet_timestamp + seconds_to_ns(self.starting_time_delta)
+        usable = (times >= starting_timestamp).groupby(self.dataset['Id'], sort=False).sum()
+        dlcs = self.dataset['Dlc'].groupby(self.dataset['Id'], sort=False).first()
+
         self.id_to_period = dict()
+        self.id_to_avg_period = dict()
+        self.id_to_count = dict()
+        self.id_to_usable_count = dict()
+        self.id_to_dlc = dict()
         for _id in self.ids:
-            id_dataset = self.dataset[self.dataset['Id'] == _id]
-            times = id_dataset['Time'].tolist()
-            deltas = list()
-            for i in range(1, len(id_dataset)):
-                deltas.append(times[i] - times[i-1])
-            self.id_to_period[_id] = max(deltas)
-            
+            key = id_to_int(_id)
+            self.id_to_period[_id] = ns_to_seconds(max_deltas[key])
+            self.id_to_count[_id] = int(counts[key])
+            self.id_to_usable_count[_id] = int(usable[key])
+            self.id_to_dlc[_id] = int(dlcs[key])
+            self.id_to_avg_period[_id] = ns_to_seconds(spans[key]) / (counts[key] - 1) if counts[key] > 1 else float('nan')
 
     def __compute_global_period(self):
-        deltas = list()
-        times = self.dataset['Time'].tolist()
-        for i in range(1, len(self.dataset)):
-            deltas.append(times[i] - times[i - 1])
-        self.average_delta = max(deltas)
+        deltas = np.diff(self.dataset['Time'].to_numpy())
+        self.average_delta = ns_to_seconds(deltas.max())
         # self.average_delta = np.mean(deltas)
         #self.average_delta += self.average_delta * 0.2
         #print(self.average_delta)
@@ -206,10 +240,9 @@ class AttackConfGenerator(object):
             if _id not in self.ids:
                 warnings.warn('Id %s was blacklisted or it doesn\'t exists. Skipping')
                 continue
-            dataset_id = self.dataset[self.dataset['Id'] == _id]
-
             if _id not in self.id_to_signals:
-                self.id_to_signals[_id] = read(dataset_id, verbose=False)[_id] if ('id_to_signals' not in kwargs or kwargs['id_to_signals'] is None) else kwargs['id_to_signals'][_id]
+                dataset_id = self.dataset[self.dataset['Id'] == id_to_int(_id)]
+                self.id_to_signals[_id] = read(dataset_id, verbose=False)[id_to_int(_id)] if ('id_to_signals' not in kwargs or kwargs['id_to_signals'] is None) else kwargs['id_to_signals'][_id]
                 self.id_to_tampered_n[_id] = 0
                 self.id_to_n_attacks[_id] = 0
 
@@ -258,7 +291,7 @@ class AttackConfGenerator(object):
                 if len(ids) != 0:
                     continue
                 else:
-                    print('All traces ended. Generated conf for just %d attaccks' % len(self.attacks))
+                    print('All traces ended. Generated conf for just %d attaccks' % self.n_attacks)
                     return
 
             ############################ REPLAY
@@ -375,19 +408,211 @@ class AttackConfGenerator(object):
             self.cumulative_tampered_n += n_adding
             self.id_to_tampered_n[_id] += n_adding
             self.id_to_n_attacks[_id] += 1
-            self.attacks.append(a.toJSON())
+            self.__add_attack(a)
+
+    def random_fill(self, ratio=None, type_ratios=None, id_weights=None, n_packet_range=(10, 50), implementation_allowed=None, tolerance=0.001, injection_rate=20):
+        """
+        Generate the attacks needed to tamper a given fraction of the dataset
+
+        The per-id frame counts and periods computed at construction time are used to plan, in a single pass, how many attacks
+        of which size are needed for every id and attack type. Tampered frames are the masqueraded, injected and dropped ones,
+        counted with respect to the number of frames of the original dataset.
+
+        Parameters
+        ----------
+        ratio: float, optional
+            The global target fraction of tampered frames (e.g. 0.05 for 5%)
+
+        type_ratios: dict(FunctionType -> float), optional
+            The target fraction of tampered frames for each attack type. If ratio is also given they are used as weights and
+            rescaled to match it. If not given, ratio is split evenly between fuzzy, replay and drop attacks
+
+        id_weights: dict(string -> float), optional
+            The relative weight of each id in the tampered frames. Ids not listed are not attacked. By default every id
+            is weighted by its number of frames
+
+        n_packet_range: couple(int, int), optional
+            The range of the number of frames tampered by a single attack
+
+        implementation_allowed: list(ImplementationType), optional
+            The implementations allowed for fuzzy and replay attacks, by default both
+
+        tolerance: float, optional
+            The maximum difference between the planned and the target ratio before warning
+
+        injection_rate: integer, optional
+            The injection rate of the injection attacks
+
+        Returns
+        -------
+        dict
+            The generated configuration. When streaming, the attacks were already written and the list is empty
+        """
+        assert ratio is not None or type_ratios is not None
+        if type_ratios is None:
+            type_ratios = {function_type: 1 for function_type in FunctionType}
+        assert type(type_ratios) == dict
+        for function_type in type_ratios.keys():
+            assert type(function_type) == FunctionType
+        if ratio is None:
+            ratio = sum(type_ratios.values())
+        assert 0 < ratio < 1
+        assert type(n_packet_range) == tuple or (type(n_packet_range) == list and len(n_packet_range) == 2)
+        assert 0 < n_packet_range[0] <= n_packet_range[1]
+        if implementation_allowed is None:
+            implementation_allowed = [ImplementationType.INJECTION, ImplementationType.MASQUERADE]
+        for t in implementation_allowed:
+            assert type(t) == ImplementationType
+
+        weights_sum = sum(type_ratios.values())
+        type_weights = {ft: w / weights_sum for ft, w in type_ratios.items() if w > 0}
+
+        # An id can be attacked only if it has frames after the starting time and a measurable period
+        candidate_ids = self.ids if id_weights is None else [_id for _id in id_weights.keys() if _id in self.ids]
+        candidate_ids = [_id for _id in candidate_ids if self.id_to_usable_count[_id] > 0 and not math.isnan(self.id_to_avg_period[_id])]
+        weights = {_id: (self.id_to_count[_id] if id_weights is None else id_weights[_id]) for _id in candidate_ids}
+        weights = {_id: w for _id, w in weights.items() if w > 0}
+        assert len(weights) > 0
+
+        n_frames = self.dataset.shape[0]
+        target_n = int(round(ratio * n_frames))
+        capacity = {_id: self.id_to_usable_count[_id] for _id in weights.keys()}
+        id_targets = self.__water_fill(target_n, weights, capacity)
+
+        planned = list()
+        type_to_tampered_n = {ft: 0 for ft in type_weights.keys()}
+        for _id, id_target in id_targets.items():
+            if id_target == 0:
+                continue
+            # Split the frames of the id between the attack types, then into attacks
+            id_attacks = list()
+            for function_type, n in self.__apportion(id_target, type_weights).items():
+                for size in self.__split_sizes(n, n_packet_range):
+                    implementation = None if function_type == FunctionType.Drop else random.choice(implementation_allowed)
+                    id_attacks.append((function_type, size, implementation))
+                type_to_tampered_n[function_type] += n
+            random.shuffle(id_attacks)
+
+            # Lay the attacks out evenly on the id timeline after the starting time
+            period = self.id_to_avg_period[_id]
+            durations = [size * period / (injection_rate if implementation == ImplementationType.INJECTION else 1) for _, size, implementation in id_attacks]
+            window = self.max_delta - period - self.starting_time_delta
+            gap = max(window - sum(durations), 0) / (len(id_attacks) + 1)
+
+            btd = self.starting_time_delta + gap
+            for (function_type, size, implementation), duration in zip(id_attacks, durations):
+                planned.append((round(float(btd), 6), _id, function_type, size, implementation))
+                btd += duration + gap
+
+        # Emit the attacks in temporal order
+        planned.sort(key=lambda x: x[0])
+        first_attack = len(self.attacks)
+        for btd, _id, function_type, size, implementation in tqdm(planned):
+            if function_type == FunctionType.Fuzzy:
+                parameters = {
+                    '_id': _id,
+                    'beginning_time_delta': btd,
+                    'injected_packets': size,
+                    'attack_type': implementation,
+                    'bit_ranges': [(0, self.id_to_dlc[_id] * 8)]
+                }
+                if implementation == ImplementationType.INJECTION:
+                    parameters['injection_rate'] = injection_rate
+                a = Fuzzy_injection_attack(**parameters)
+            elif function_type == FunctionType.Replay:
+                parameters = {
+                    '_id': _id,
+                    'beginning_time_delta': btd,
+                    'sniffing_time_delta': 0,
+                    'injected_packets': size,
+                    'attack_type': implementation,
+                    'pattern_packets': max(1, min(size, self.id_to_count[_id] - self.id_to_usable_count[_id] - 1))
+                }
+                if implementation == ImplementationType.INJECTION:
+                    parameters['injection_rate'] = injection_rate
+                a = Replay_attack(**parameters)
+            else:
+                a = Drop_attack(_id, btd, size)
+
+            self.cumulative_tampered_n += size
+            self.id_to_tampered_n[_id] = self.id_to_tampered_n.get(_id, 0) + size
+            self.id_to_n_attacks[_id] = self.id_to_n_attacks.get(_id, 0) + 1
+            self.__add_attack(a)
+
+        planned_n = sum(type_to_tampered_n.values())
+        print('Planned %d attacks tampering %d frames out of %d (%f%%, target %f%%)' % (len(planned), planned_n, n_frames, planned_n / n_frames * 100, ratio * 100))
+        for function_type, n in type_to_tampered_n.items():
+            print('    %s: %d frames (%f%%)' % (function_type.name, n, n / n_frames * 100))
+        if abs(planned_n / n_frames - ratio) > tolerance:
+            warnings.warn('Planned ratio (%f) is out of tolerance from the target (%f), not enough attackable frames' % (planned_n / n_frames, ratio))
+
+        return {'attacks': self.attacks[first_attack:]}
+
+    def __apportion(self, total, weights):
+        # Split an integer total proportionally to the weights (largest remainder)
+        weights_sum = sum(weights.values())
+        quotas = {k: total * w / weights_sum for k, w in weights.items()}
+        shares = {k: int(q) for k, q in quotas.items()}
+        rest = total - sum(shares.values())
+        for k in sorted(quotas.keys(), key=lambda k: quotas[k] - shares[k], reverse=True)[:rest]:
+            shares[k] += 1
+        return shares
+
+    def __water_fill(self, total, weights, capacity):
+        # Proportional split where what exceeds the capacity of an id is moved to the others
+        allocation = dict()
+        remaining = dict(weights)
+        while total > 0 and len(remaining) > 0:
+            weights_sum = sum(remaining.values())
+            saturated = [k for k, w in remaining.items() if total * w / weights_sum >= capacity[k]]
+            if len(saturated) == 0:
+                allocation.update(self.__apportion(total, remaining))
+                return allocation
+            for k in saturated:
+                allocation[k] = capacity[k]
+                total -= capacity[k]
+                remaining.pop(k)
+        return allocation
+
+    def __split_sizes(self, n, n_packet_range):
+        sizes = list()
+        while n > 0:
+            size = min(random.randint(n_packet_range[0], n_packet_range[1]), n)
+            sizes.append(size)
+            n -= size
+        return sizes
+
+    def __add_attack(self, attack):
+        if self.writer is not None:
+            self.writer.write(attack.toJSON())
+        else:
+            self.attacks.append(attack.toJSON())
+        self.n_attacks += 1
 
     def export(self, path=None):
+        """
+        Export the generated configuration. A .jsonl path is written as JSON Lines, any other as a single JSON document.
+        When streaming, the attacks are already on disk and the stream is just closed.
+        """
+        if self.writer is not None:
+            self.writer.close()
+            print('Attacks streamed to %s' % self.writer.path)
+            return
+
         if path is not None:
             assert type(path) == str
         else:
-            path = './attack_%d_%s.json' % (len(self.attacks), datetime.now())
+            path = './attack_%d_%s.json' % (self.n_attacks, datetime.now())
         print('Exporting..')
-        with open(path, 'w+') as js:
-            json.dump({'attacks': self.attacks}, js, indent=4)
+        if is_jsonl(path):
+            with JsonlAttackWriter(path) as writer:
+                for attack in self.attacks:
+                    writer.write(attack)
+        else:
+            with open(path, 'w+') as js:
+                json.dump({'attacks': self.attacks}, js, indent=4)
         print('..done')
 
-
 if __name__ == '__main__':
     df = load_dataset()
 
@@ -414,5 +639,10 @@ if __name__ == '__main__':
 
     from pprint import pprint
     pprint(acg.attacks)
+
+    # tamper 5% of the frames, half of them with drop attacks
+    acg.random_fill(ratio=0.05,
+                    type_ratios={FunctionType.Fuzzy: 1, FunctionType.Replay: 1, FunctionType.Drop: 2},
+                    n_packet_range=(10, 50))
     """
  
\ No newline at end of file
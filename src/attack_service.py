@@ -0,0 +1,185 @@
+from argparse import ArgumentParser
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+from main import EnsambleAttack, load_base
+from basic_attack import to_export_frame, EXPORT_FLOAT_FORMAT
+from attack_context import AttackContext
+from utils import Logger
+import json, os, socketserver, time, traceback
+
+"""
+    Long-lived local service applying EnsambleAttack configurations to datasets kept in memory.
+
+    The base traces, their id index and the READ signal maps (see AttackContext) are loaded once and reused by all the
+    requests, so that a request only costs the attacks themselves. Endpoints:
+
+        GET  /health                    {"status": "ok", "datasets": [...]}
+        GET  /datasets                  The loaded datasets with their number of frames
+        POST /datasets                  {"dataset": "..."} loads a dataset ahead of the first request using it
+        POST /attack?output=tampered    A configuration ({"dataset": "...", "attacks": [...]}), the vulnerable dataset is
+                                        streamed back as csv: only the tampered frames (output=tampered, default) or
+                                        all of them (output=full). The X-Stats header holds the attack statistics
+
+    Requests are served one at a time, the shared datasets are never modified (every request works on a copy).
+"""
+
+STREAM_CHUNK_ROWS = 100000
+
+
+class AttackService(object):
+    datasets = None
+    logger = None
+
+    def __init__(self, verbose=True):
+        self.datasets = dict()
+        self.logger = Logger(verbose=verbose)
+
+    def load(self, dataset_field):
+        """
+        Return the (source, dataframe, context) of the dataset, loading it the first time. The dataset is kept in memory,
+        there is no lazy source
+        """
+        if dataset_field not in self.datasets:
+            self.logger.print('Loading %s..' % dataset_field)
+            source, dataset = load_base(dataset_field)
+            self.datasets[dataset_field] = (source, dataset, AttackContext(dataset))
+            self.logger.print('..done (%d frames)' % dataset.shape[0])
+        return self.datasets[dataset_field]
+
+    def attack(self, config):
+        """
+        Apply the attacks of the configuration and return the EnsambleAttack, its vulnerable dataset is None if no
+        attack changed the dataset
+        """
+        if 'dataset' not in config or config['dataset'] is None:
+            raise ValueError('No dataset specified in the configuration')
+        if type(config.get('attacks')) != list:
+            raise ValueError('The configuration needs a list of attacks')
+        source, dataset, context = self.load(config['dataset'])
+        ea = EnsambleAttack(source=source, context=context)
+        ea.build_dataset(dataset.copy(), config['attacks'])
+        return ea
+
+
+class AttackRequestHandler(BaseHTTPRequestHandler):
+    # The AttackService is attached to the server
+    server_version = 'CANtackService/1.0'
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        service = self.server.service
+        if path == '/health':
+            self.__send_json(200, {'status': 'ok', 'datasets': list(service.datasets.keys())})
+        elif path == '/datasets':
+            self.__send_json(200, {name: {'n_rows': int(dataset.shape[0])} for name, (_, dataset, _) in service.datasets.items()})
+        else:
+            self.__send_json(404, {'error': 'Unknown endpoint %s' % path})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        try:
+            body = self.__read_json()
+            if url.path == '/datasets':
+                _, dataset, _ = self.server.service.load(body.get('dataset'))
+                self.__send_json(200, {'dataset': body.get('dataset'), 'n_rows': int(dataset.shape[0])})
+            elif url.path == '/attack':
+                output = parse_qs(url.query).get('output', ['tampered'])[0]
+                if output not in ('tampered', 'full'):
+                    raise ValueError('output must be tampered or full')
+                self.__attack(body, output)
+            else:
+                self.__send_json(404, {'error': 'Unknown endpoint %s' % url.path})
+        except (ValueError, KeyError, TypeError, FileNotFoundError) as e:
+            self.__send_json(400, {'error': '%s: %s' % (type(e).__name__, e)})
+        except Exception as e:
+            traceback.print_exc()
+            self.__send_json(500, {'error': '%s: %s' % (type(e).__name__, e)})
+
+    def __attack(self, config, output):
+        start = time.perf_counter()
+        ea = self.server.service.attack(config)
+        if ea.vulnerable_dataset is None:
+            dataset = self.server.service.load(config['dataset'])[1]
+            rows = dataset.iloc[0:0] if output == 'tampered' else dataset
+            stats = {'N_applied_attack': 0}
+        else:
+            rows = ea.get_tampered_rows() if output == 'tampered' else ea.vulnerable_dataset
+            stats = ea.get_stats()
+            # The records of every attack can be too long for a header
+            stats.pop('Attacks', None)
+        stats['Build_s'] = time.perf_counter() - start
+
+        # The body is streamed in chunks and delimited by the end of the connection
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/csv')
+        self.send_header('X-Stats', json.dumps(stats))
+        self.end_headers()
+        for i in range(0, max(rows.shape[0], 1), STREAM_CHUNK_ROWS):
+            chunk = to_export_frame(rows.iloc[i:i + STREAM_CHUNK_ROWS])
+            self.wfile.write(chunk.to_csv(header=i == 0, float_format=EXPORT_FLOAT_FORMAT).encode())
+        self.close_connection = True
+
+    def __read_json(self):
+        length = int(self.headers.get('Content-Length', 0))
+        if length == 0:
+            raise ValueError('Empty request body')
+        return json.loads(self.rfile.read(length))
+
+    def __send_json(self, status, content):
+        body = json.dumps(content).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # Unix socket clients have no (host, port) address
+        return self.client_address[0] if type(self.client_address) == tuple else 'unix'
+
+
+class UnixHTTPServer(socketserver.UnixStreamServer, HTTPServer):
+
+    def server_bind(self):
+        # HTTPServer.server_bind expects a (host, port) address
+        socketserver.UnixStreamServer.server_bind(self)
+        self.server_name = 'localhost'
+        self.server_port = 0
+
+
+def create_server(service, host='127.0.0.1', port=8765, socket_path=None):
+    """
+    Return the HTTP server of the service, listening on host:port or on the Unix socket socket_path if given
+    """
+    if socket_path is not None:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = UnixHTTPServer(socket_path, AttackRequestHandler)
+    else:
+        server = HTTPServer((host, port), AttackRequestHandler)
+    server.service = service
+    return server
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description='Serve CANtack attacks on datasets kept in memory')
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('-p', '--port', type=int, default=8765)
+    parser.add_argument('-s', '--socket', type=str, default=None, help='Listen on this Unix socket instead of host:port')
+    parser.add_argument('--preload', type=str, nargs='*', default=[], help='Datasets to load at start (vehicle names or csv paths)')
+    args = parser.parse_args()
+
+    service = AttackService()
+    for dataset_field in args.preload:
+        service.load(dataset_field)
+
+    server = create_server(service, host=args.host, port=args.port, socket_path=args.socket)
+    print('Serving on %s' % (args.socket if args.socket is not None else '%s:%d' % (args.host, args.port)))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if args.socket is not None and os.path.exists(args.socket):
+            os.remove(args.socket)
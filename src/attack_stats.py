@@ -0,0 +1,336 @@
+from attack_conflicts import attack_span
+from id_utils import id_to_hex
+from time_utils import ns_to_seconds
+import numpy as np
+import pandas as pd
+import os
+
+"""
+    Statistics of an EnsambleAttack build kept up to date while the attacks are applied.
+
+    Every attack only changes the frames in its time span (see Attack.get_span), so its changes are found comparing
+    the frames of the span before and after it: frames are matched by (Time, Id, Can#), unmatched frames of the span
+    before are dropped, unmatched frames after are added, matched frames with a different payload, dlc or flag are
+    changed. The counters of the whole dataset (tampered frames by id, added and dropped frames) and a record of every
+    attack are updated from them, so that the statistics never scan the vulnerable dataset.
+
+    The (Time, Id, Can#) of the frames every attack added or changed, with their rank among the frames with the same key,
+    are kept too, to find them in the vulnerable dataset once built (see attack_table and attack_labels), e.g. for
+    evaluations to jump to the tampered regions.
+"""
+
+FRAME_VALUES = ['Dlc', 'Payload', 'IsTampered']
+ATTACK_TABLE_SUFFIX = '.attacks.csv'
+ATTACK_TABLE_COLUMNS = ['AttackId', 'Name', 'AttackType', 'Ids', 'FirstTime', 'LastTime', 'FirstRow', 'LastRow',
+                        'N_added_rows', 'N_dropped_rows', 'N_changed_rows', 'N_tampered_rows']
+
+
+class AttackStats(object):
+    n_rows = 0
+    is_sorted = True
+
+    def __init__(self, dataset=None):
+        """
+        Parameters
+        ----------
+        dataset: pandas.Dataframe, optional
+            The dataset the attacks are applied to. Without it the counters start from zero, and hold the changes of the
+            attacks (e.g. of a part of the attacks, merged later with merge)
+        """
+        self.tampered = dict()
+        self.dropped = dict()
+        self.records = list()
+        self.touched = dict()
+        if dataset is not None:
+            self.n_rows = dataset.shape[0]
+            times = dataset['Time'].to_numpy()
+            self.is_sorted = bool(np.all(times[1:] >= times[:-1]))
+            ids, counts = np.unique(dataset['Id'].to_numpy()[dataset['IsTampered'].to_numpy() == 1], return_counts=True)
+            self.tampered = dict(zip(ids.tolist(), counts.tolist()))
+
+    def window(self, dataset, attack):
+        """
+        Return the frames of the dataset the attack (or the list of attacks applied at once) can change, as a couple
+        (time spans of every attack, copy of the frames in their union), to be given to update once applied
+        """
+        attacks = attack if type(attack) == list else [attack]
+        spans = list()
+        for x in attacks:
+            try:
+                spans.append(attack_span(x, dataset, self.dropped))
+            except (AssertionError, KeyError, TypeError, ValueError, IndexError):
+                spans.append([(-np.inf, np.inf)])
+        return spans, _frames(dataset, [x for y in spans for x in y], self.is_sorted).copy()
+
+    def update(self, window, dataset, position, config, attack):
+        """
+        Update the counters with the changes of an attack and record them. The changes of attacks applied at once
+        (position, config and attack being lists) are recorded for the last of them whose ids and spans hold the frame
+        (the first one for dropped frames), the last attack if none does
+
+        Parameters
+        ----------
+        window: couple
+            The frames the attack could change, as returned by window before applying it
+
+        dataset: pandas.Dataframe
+            The dataset with the attack applied
+
+        position: integer
+            The position of the attack in the configuration
+
+        config: dict
+            The configuration of the attack
+
+        attack: Attack
+            The applied attack
+        """
+        positions, configs, attacks = (position, config, attack) if type(attack) == list else ([position], [config], [attack])
+        spans, before = window
+        after = _frames(dataset, [x for y in spans for x in y], self.is_sorted)
+        matched_before, matched_after, dropped, added = match_frames(before, after)
+        changed = np.zeros(matched_before.shape[0], dtype=bool)
+        for column in [x for x in FRAME_VALUES if x in before.columns]:
+            changed |= before[column].to_numpy()[matched_before] != after[column].to_numpy()[matched_after]
+
+        is_tampered_before = before['IsTampered'].to_numpy() == 1
+        is_tampered_after = after['IsTampered'].to_numpy() == 1
+        _count(self.tampered, after['Id'].to_numpy()[is_tampered_after])
+        _count(self.tampered, before['Id'].to_numpy()[is_tampered_before], -1)
+        _count(self.dropped, before['Id'].to_numpy()[dropped])
+        self.n_rows += added.shape[0] - dropped.shape[0]
+
+        owner_before, owner_after = _owners(before, attacks, spans), _owners(after, attacks, spans)
+        owner_dropped = _owners(before.iloc[dropped], attacks, spans, first=True)
+        touched = np.concatenate([added, matched_after[changed]])
+        times, groups = after['Time'].to_numpy().astype(np.int64), _group(after)
+        ranks = _ranks(times, groups)
+        for k in range(len(attacks)):
+            attack_added, attack_dropped = added[owner_after[added] == k], dropped[owner_dropped == k]
+            attack_touched = touched[owner_after[touched] == k]
+            self.touched[positions[k]] = (times[attack_touched], groups[attack_touched], ranks[attack_touched])
+            attack_times = np.concatenate([before['Time'].to_numpy()[attack_dropped], times[attack_touched]])
+            self.records.append({'position': positions[k],
+                                 'name': configs[k].get('name'),
+                                 'attack_type': attacks[k].attack_type,
+                                 'ids': [id_to_hex(x) for x in sorted(attacks[k].get_ids())],
+                                 'first_time': int(attack_times.min()) if attack_times.shape[0] > 0 else None,
+                                 'last_time': int(attack_times.max()) if attack_times.shape[0] > 0 else None,
+                                 'n_added_rows': int(attack_added.shape[0]),
+                                 'n_dropped_rows': int(attack_dropped.shape[0]),
+                                 'n_changed_rows': int(np.sum(changed & (owner_after[matched_after] == k))),
+                                 'n_tampered_rows': int(np.sum(is_tampered_after & (owner_after == k))) - int(np.sum(is_tampered_before & (owner_before == k)))})
+
+    def merge(self, other):
+        """
+        Add the changes recorded by other, an AttackStats created without dataset
+        """
+        for counters, other_counters in ((self.tampered, other.tampered), (self.dropped, other.dropped)):
+            for _id, count in other_counters.items():
+                counters[_id] = counters.get(_id, 0) + count
+        self.n_rows += other.n_rows
+        self.records = sorted(self.records + other.records, key=lambda x: x['position'])
+        self.touched.update(other.touched)
+
+    def tampered_ids(self):
+        """
+        Return the integer ids with tampered frames
+        """
+        return [x for x, count in self.tampered.items() if count > 0]
+
+    def get_stats(self, original_rows):
+        """
+        Return the statistics as in Attack.get_stats, original_rows being the number of frames of the original dataset,
+        with the dropped frames and the changes of every attack (times in seconds)
+        """
+        stats = dict()
+        stats['Tampered_ids'] = [id_to_hex(x) for x in self.tampered_ids()]
+        stats['N_of_tampered_ids'] = len(stats['Tampered_ids'])
+        stats['N_tampered_rows'] = sum(x for x in self.tampered.values() if x > 0)
+        stats['N_added_rows'] = self.n_rows - original_rows
+        stats['N_dropped_rows'] = sum(self.dropped.values())
+        stats['Attacks'] = [dict(x, first_time=_seconds(x['first_time']), last_time=_seconds(x['last_time'])) for x in self.records]
+        return stats
+
+    def attack_table(self, dataset):
+        """
+        Return the table of the applied attacks, a row per attack: its position in the configuration (AttackId), name,
+        type, ids, first and last time of the frames it added, dropped or changed (in seconds), the positions of the
+        first and last frames of the dataset in that interval (FirstRow, LastRow, when the dataset is sorted by time) and
+        its counters
+
+        Parameters
+        ----------
+        dataset: pandas.Dataframe
+            The vulnerable dataset, with all the attacks applied
+        """
+        times = dataset['Time'].to_numpy()
+        rows = list()
+        for record in self.records:
+            first_row, last_row = None, None
+            if self.is_sorted and record['first_time'] is not None:
+                first_row = int(np.searchsorted(times, record['first_time'], side='left'))
+                last_row = int(np.searchsorted(times, record['last_time'], side='right')) - 1
+            rows.append({'AttackId': record['position'],
+                         'Name': record['name'],
+                         'AttackType': record['attack_type'],
+                         'Ids': ' '.join(record['ids']),
+                         'FirstTime': _seconds(record['first_time']),
+                         'LastTime': _seconds(record['last_time']),
+                         'FirstRow': first_row,
+                         'LastRow': last_row,
+                         'N_added_rows': record['n_added_rows'],
+                         'N_dropped_rows': record['n_dropped_rows'],
+                         'N_changed_rows': record['n_changed_rows'],
+                         'N_tampered_rows': record['n_tampered_rows']})
+        table = pd.DataFrame(rows, columns=ATTACK_TABLE_COLUMNS)
+        return table.astype({'FirstRow': 'Int64', 'LastRow': 'Int64'})
+
+    def attack_labels(self, dataset):
+        """
+        Return the position of the attack that last added or changed every frame of the dataset (the vulnerable
+        dataset, with all the attacks applied), -1 for the frames no attack touched
+        """
+        labels = np.full(dataset.shape[0], -1, dtype=np.int64)
+        if len(self.touched) == 0:
+            return labels
+        # Frames are found by (Time, Id, Can#) and their rank among the frames with the same key, as in match_frames
+        times, groups = dataset['Time'].to_numpy().astype(np.int64), _group(dataset)
+        keys = pd.MultiIndex.from_arrays([times, groups, _ranks(times, groups)])
+        for position in sorted(self.touched.keys()):
+            found = keys.get_indexer(pd.MultiIndex.from_arrays(list(self.touched[position])))
+            # Frames dropped by a later attack are not found
+            labels[found[found >= 0]] = position
+        return labels
+
+    def to_state(self):
+        # Json serializable state, stored in checkpoints
+        return {'n_rows': self.n_rows,
+                'is_sorted': self.is_sorted,
+                'tampered': list(self.tampered.items()),
+                'dropped': list(self.dropped.items()),
+                'records': self.records}
+
+    def to_arrays(self):
+        # The frames touched by every attack, stored next to the state
+        return dict(('touched_%d' % x, np.stack(y)) for x, y in self.touched.items())
+
+    @staticmethod
+    def from_state(state, arrays=None):
+        stats = AttackStats()
+        stats.n_rows = state['n_rows']
+        stats.is_sorted = state['is_sorted']
+        stats.tampered = dict((x, y) for x, y in state['tampered'])
+        stats.dropped = dict((x, y) for x, y in state['dropped'])
+        stats.records = state['records']
+        for name, touched in (arrays if arrays is not None else dict()).items():
+            if name.startswith('touched_'):
+                stats.touched[int(name[len('touched_'):])] = tuple(touched)
+        return stats
+
+
+def attack_table_path(path):
+    """
+    Return the path of the attack table exported with the vulnerable dataset in path
+    """
+    return os.path.splitext(path)[0] + ATTACK_TABLE_SUFFIX
+
+
+def match_frames(before, after):
+    """
+    Match the frames of before and after by (Time, Id, Can#), the k-th frame with a key in before with the k-th one in
+    after. Return the positions of the matched frames in before and in after, of the unmatched ones in before and in after
+    """
+    n_before = before.shape[0]
+    times = np.concatenate([before['Time'].to_numpy(), after['Time'].to_numpy()]).astype(np.int64)
+    groups = np.concatenate([_group(before), _group(after)])
+    tags = np.repeat(np.array([0, 1], dtype=np.int8), [n_before, after.shape[0]])
+    if times.shape[0] == 0:
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty, empty, empty
+
+    # Sorted by key, the frames of before first within a key
+    order = np.lexsort((tags, groups, times))
+    times, groups, tags = times[order], groups[order], tags[order]
+    new_key = np.ones(times.shape[0], dtype=bool)
+    new_key[1:] = (times[1:] != times[:-1]) | (groups[1:] != groups[:-1])
+    new_run = new_key.copy()
+    new_run[1:] |= tags[1:] != tags[:-1]
+    key = np.cumsum(new_key) - 1
+    key_start = np.flatnonzero(new_key)
+    run_start = np.flatnonzero(new_run)
+    rank = np.arange(times.shape[0]) - run_start[np.cumsum(new_run) - 1]
+    n_keys = key_start.shape[0]
+    counts_before = np.bincount(key[tags == 0], minlength=n_keys)
+    counts_after = np.bincount(key[tags == 1], minlength=n_keys)
+
+    is_before = tags == 0
+    matched = rank < np.where(is_before, counts_after[key], counts_before[key])
+    matched_before = np.flatnonzero(matched & is_before)
+    # The frames of after of a key follow the ones of before
+    partners = key_start[key[matched_before]] + counts_before[key[matched_before]] + rank[matched_before]
+    return (order[matched_before],
+            order[partners] - n_before,
+            np.sort(order[~matched & is_before]),
+            np.sort(order[~matched & ~is_before] - n_before))
+
+
+def _group(frames):
+    # Id and Can# of the frames as a single integer
+    return frames['Id'].to_numpy().astype(np.int64) * 256 + frames['Can#'].to_numpy().astype(np.int64)
+
+
+def _ranks(times, groups):
+    # The rank of every frame among the frames with the same (Time, Id, Can#), in the order of the frames
+    order = np.lexsort((groups, times))
+    times, groups = times[order], groups[order]
+    new_key = np.ones(times.shape[0], dtype=bool)
+    new_key[1:] = (times[1:] != times[:-1]) | (groups[1:] != groups[:-1])
+    key_start = np.flatnonzero(new_key)
+    ranks = np.empty(times.shape[0], dtype=np.int64)
+    ranks[order] = np.arange(times.shape[0]) - key_start[np.cumsum(new_key) - 1]
+    return ranks
+
+
+def _owners(frames, attacks, spans, first=False):
+    # The position in attacks of the last (first) attack whose ids and spans hold every frame, the last attack if none
+    # does
+    owners = np.full(frames.shape[0], len(attacks) - 1, dtype=np.int64)
+    if len(attacks) == 1:
+        return owners
+    times, ids = frames['Time'].to_numpy(), frames['Id'].to_numpy()
+    order = list(enumerate(zip(attacks, spans)))
+    for k, (attack, attack_spans) in (order[::-1] if first else order):
+        held = np.isin(ids, list(attack.get_ids()))
+        in_spans = np.zeros(frames.shape[0], dtype=bool)
+        for start, end in attack_spans:
+            in_spans |= (times >= start) & (times <= end)
+        owners[held & in_spans] = k
+    return owners
+
+
+def _count(counters, ids, sign=1):
+    for _id, count in zip(*np.unique(ids, return_counts=True)):
+        counters[int(_id)] = counters.get(int(_id), 0) + sign * int(count)
+
+
+def _frames(dataset, spans, is_sorted):
+    # The frames of the dataset in the time spans, all of them if the dataset is not sorted by time
+    if not is_sorted:
+        return dataset
+    times = dataset['Time'].to_numpy()
+    ranges = list()
+    for span in sorted(spans):
+        start = 0 if span[0] == -np.inf else int(np.searchsorted(times, span[0], side='left'))
+        end = times.shape[0] if span[1] == np.inf else int(np.searchsorted(times, span[1], side='right'))
+        if len(ranges) > 0 and start <= ranges[-1][1]:
+            ranges[-1] = (ranges[-1][0], max(end, ranges[-1][1]))
+        else:
+            ranges.append((start, end))
+    if len(ranges) == 1:
+        return dataset.iloc[ranges[0][0]:ranges[0][1]]
+    return dataset.iloc[np.concatenate([np.arange(start, end) for start, end in ranges])]
+
+
+def _seconds(time):
+    return ns_to_seconds(time) if time is not None else None
@@ -1,14 +1,43 @@
 from enum import Enum
 from abc import ABC, abstractmethod
 from dataset_loader import load_dataset
-from read import read, SIGN_TYPE
 from enums.implementation_type import ImplementationType
 import pandas as pd
 import numpy as np
-import plotly.express as px
-import plotly.graph_objects as go
-import webbrowser
 from utils import Logger
+from payload_utils import signal_values
+from dataset_cache import LazyDataset
+from id_utils import id_to_int, id_to_hex, ids_to_hex
+from time_utils import ns_to_seconds, seconds_to_ns
+from attack_context import AttackContext
+
+EXPORT_FLOAT_FORMAT = '%.6f'
+
+
+class InvalidAttackError(ValueError):
+    """
+        An attack configuration failing validation (missing or invalid parameters)
+    """
+    pass
+
+
+def _min_max_downsample(values, max_points):
+    # Indices of the min and max of max_points / 2 equally sized buckets, in order
+    n = values.shape[0]
+    if n <= max_points:
+        return np.arange(n)
+    bucket_size = int(np.ceil(n / (max_points // 2)))
+    n_buckets = int(np.ceil(n / bucket_size))
+    padded = np.concatenate([values.astype(np.float64), np.full(n_buckets * bucket_size - n, np.nan)]).reshape(n_buckets, bucket_size)
+    offsets = np.arange(n_buckets) * bucket_size
+    indices = np.concatenate([offsets + np.nanargmin(padded, axis=1), offsets + np.nanargmax(padded, axis=1)])
+    return np.unique(indices[indices < n])
+
+def to_export_frame(dataset):
+    """
+        Return the dataset as exported: ids as hexadecimal strings and timestamps in seconds, as in the raw traces
+    """
+    return dataset.assign(Id=ids_to_hex(dataset['Id']), Time=ns_to_seconds(dataset['Time'].to_numpy()))
 
 """
     Basic abastract class for attacck
@@ -20,9 +49,17 @@ class Attack(ABC):
 
     attack_name = None
     parameters = None
+    context = None
 
-    def __init__(self):
+    def __init__(self, context=None):
+        """
+        Parameters
+        ----------
+        context: AttackContext, optional
+            Values of the original dataset shared by the attacks of a run (per id average intervals, index, signals)
+        """
         super().__init__()
+        self.context = context
 
     @property
     def vulnerable_dataset(self):
@@ -41,24 +78,80 @@ class Attack(ABC):
     def build_dataset(self):
         pass
 
+    def get_average_interval(self, dataset):
+        """
+        Return the average inter-arrival time in seconds the injection rate refers to: the average_interval parameter
+        if given, otherwise the one of the id in the original dataset (None if the id has less than two frames)
+        """
+        if self.parameters.get('average_interval') is not None:
+            return self.parameters['average_interval']
+        if self.context is None:
+            self.context = AttackContext(dataset)
+        return self.context.average_interval(self.parameters['id'])
+
+    def get_id_rows(self, dataset):
+        """
+        Return the frames of the attacked id in the original dataset, with the Time and Dlc columns the spans need
+        """
+        if self.context is None:
+            self.context = AttackContext(dataset)
+        return self.context.id_rows(self.parameters['id'], columns=['Time', 'Dlc'])
+
+    def get_ids(self):
+        """
+        Return the integer ids of the frames the attack reads or changes
+        """
+        return {id_to_int(self.parameters['id'])}
+
+    def get_span(self, dataset):
+        """
+        Return the (start, end) times in nanoseconds of the frames the attack reads or changes in the dataset (a list
+        of them if they are disjoint), None if they cannot be bounded. Attacks on different ids and spans can be
+        applied independently (see attack_conflicts)
+        """
+        return None
+
+    def get_masquerade(self, dataset):
+        """
+        Return the masquerades the attack applies on the dataset, as the (id, beginning_time_delta, replacements)
+        arguments of masquerade_batch (an empty list if it changes nothing), None if it does not masquerade frames.
+        Consecutive masquerade attacks are applied at once by EnsambleAttack
+        """
+        return None
+
+    def get_start_time(self, dataset, time_delta):
+        # Timestamp of the dataset time delta (in seconds) the attack parameters refer to
+        return int(dataset['Time'].iloc[0]) + seconds_to_ns(time_delta)
+
     def get_tampered_rows(self):
         return self.vulnerable_dataset[self.vulnerable_dataset['IsTampered'] == 1]
 
     def get_original_rows(self):
         return self.vulnerable_dataset[self.vulnerable_dataset['IsTampered'] == 0]
     
+    def get_tampered_ids(self):
+        """
+        Return the integer ids with tampered frames in the vulnerable dataset
+        """
+        return self.get_tampered_rows()['Id'].unique().tolist()
+
     def get_stats(self, verbose=False):
         stats = dict()
 
         tampered_rows = self.get_tampered_rows()
         stats['N_applied_attack'] = self.applied_attack
-        stats['Tampered_ids'] = list(set(tampered_rows['Id'].tolist()))
+        stats['Tampered_ids'] = [id_to_hex(x) for x in tampered_rows['Id'].unique()]
         stats['N_of_tampered_ids'] = len(stats['Tampered_ids'])
         stats['N_tampered_rows'] = tampered_rows.shape[0]
         stats['N_added_rows'] = self.vulnerable_dataset.shape[0] - self.original_dataset.shape[0]
         
         if verbose:
-            print("""
+            self.print_stats(stats)
+        
+        return stats
+
+    def print_stats(self, stats):
+        print("""
                 %d attaccks were applied
                 %d ids were tampered
                 %d rows were tampered (out of %d)
@@ -68,72 +161,114 @@ class Attack(ABC):
                     stats['N_tampered_rows'], self.vulnerable_dataset.shape[0],
                     stats['N_added_rows']
                     )) 
-        
-        return stats
 
-    def visualize_changes(self, export=True):
-        stats = self.get_stats()
-        tampered_ids = stats['Tampered_ids']
+    def visualize_changes(self, export=True, path='graphs.html', max_points=2000, read_max_frames=100000, open_browser=True):
+        """
+        Plot, for every tampered id, its signals around the tampered frames in the original and in the vulnerable dataset
+
+        Parameters
+        ----------
+        export: bool, optional
+            If True all the graphs are written to a single html report, otherwise every graph is shown
+
+        path: string, optional
+            The path of the html report
+
+        max_points: integer, optional
+            The maximum number of points of every line, longer lines are downsampled keeping the min and max of each bucket
+
+        read_max_frames: integer, optional
+            The maximum number of frames of every id used by READ to find the signals, taken around the tampered ones
+
+        open_browser: bool, optional
+            Open the report in the browser once written
+        """
+        # Plotting dependencies are heavy and only needed here
+        import plotly.graph_objects as go
+        import webbrowser
+        from read import read, SIGN_TYPE
+
+        tampered_ids = self.get_tampered_ids()
+
+        # Split both datasets by id once, restricted to the tampered ids. A lazy original dataset is read later, window by window
+        is_lazy = type(self.original_dataset) == LazyDataset
+        if not is_lazy:
+            original_rows = self.original_dataset.loc[self.original_dataset['Id'].isin(tampered_ids), ['Time', 'Id', 'Payload']]
+            original_indices = original_rows.groupby('Id', sort=False).indices
+        vulnerable_rows = self.vulnerable_dataset.loc[self.vulnerable_dataset['Id'].isin(tampered_ids), ['Time', 'Id', 'Dlc', 'Payload', 'IsTampered']]
+        vulnerable_indices = vulnerable_rows.groupby('Id', sort=False).indices
+
+        # Find optimal visualition range and the frames READ runs on
+        windows = dict()
+        read_traces = list()
+        for tampered_id in tampered_ids:
+            id_rows = vulnerable_rows.iloc[vulnerable_indices[tampered_id]]
+            times = id_rows['Time'].to_numpy()
+            tampered_positions = np.flatnonzero(id_rows['IsTampered'].to_numpy() == 1)
+            first_tampered_timestamp = times[tampered_positions[0]]
+            last_tampered_timestamp = times[tampered_positions[-1]]
+            delta_timestamp = last_tampered_timestamp - first_tampered_timestamp
+            if delta_timestamp == 0 and len(times) > 1:
+                delta_timestamp = 10 * (times[-1] - times[0]) // (len(times) - 1)
+            windows[tampered_id] = (first_tampered_timestamp - delta_timestamp, last_tampered_timestamp + delta_timestamp)
+
+            center = (tampered_positions[0] + tampered_positions[-1]) // 2
+            read_start = max(0, center - read_max_frames // 2)
+            read_traces.append(id_rows.iloc[read_start:read_start + read_max_frames])
 
         print('Running read...')
-        read_signals = read(self.vulnerable_dataset[self.vulnerable_dataset['Id'].isin(tampered_ids)])
+        read_signals = read(pd.concat(read_traces), verbose=False)
         print('..done')
 
-
+        figs = list()
         for tampered_id in tampered_ids:
             signals = read_signals[tampered_id]
-            print("Found %d signals for id %s" % (len(signals),tampered_id))
-            figs = list()
-            original_dataset_id = self.original_dataset[self.original_dataset['Id'] == tampered_id]
-            tampered_dataset_id = self.vulnerable_dataset[self.vulnerable_dataset['Id'] == tampered_id]
+            print("Found %d signals for id %s" % (len(signals), id_to_hex(tampered_id)))
+            range_x = windows[tampered_id]
+
+            if is_lazy:
+                original_id = self.original_dataset.filter(time_range=range_x, ids=[tampered_id], columns=['Time', 'Id', 'Payload'])
+            else:
+                original_id = original_rows.iloc[original_indices[tampered_id]] if tampered_id in original_indices else original_rows.iloc[0:0]
+                original_id = original_id[original_id['Time'].between(range_x[0], range_x[1])]
+            tampered_id_rows = vulnerable_rows.iloc[vulnerable_indices[tampered_id]]
+            tampered_id_rows = tampered_id_rows[tampered_id_rows['Time'].between(range_x[0], range_x[1])]
+            just_tampered_rows = tampered_id_rows[tampered_id_rows['IsTampered'] == 1]
+
             for sign in signals:
                 if sign[2] in [SIGN_TYPE.BINARY, SIGN_TYPE.CRC]:
                     continue
-                
-                original_dataset_sign = original_dataset_id.copy(deep=True)
-                original_dataset_sign['Payload'] = original_dataset_sign.apply(lambda x: int(x.Payload[sign[0]:sign[1]], 2), axis=1)
-                original_dataset_sign['Type'] = ['Original_signal' for _ in range(original_dataset_sign.shape[0])]
-                original_dataset_sign.drop(columns=['Can#','Dlc', 'Id', 'IsTampered'])
-                
-                tampered_dataset_sign = tampered_dataset_id.copy(deep=True)
-                tampered_dataset_sign['Payload'] = tampered_dataset_sign.apply(lambda x: int(x.Payload[sign[0]:sign[1]], 2), axis=1)
-                tampered_dataset_sign['Type'] = ['Tampered_signal' for _ in range(tampered_dataset_sign.shape[0])]
-                tampered_dataset_sign.drop(columns=['Can#','Dlc', 'Id'])
-
-                just_tampered_rows = tampered_dataset_sign[tampered_dataset_sign['IsTampered'] == 1].copy(deep=True)
-                just_tampered_rows['Type'] = ['Tampered_packets' for _ in range(just_tampered_rows.shape[0])]
-                just_tampered_rows.drop(columns=['IsTampered'])
-                tampered_dataset_sign.drop(columns=['IsTampered'])
-                
-                df = pd.concat([original_dataset_sign, tampered_dataset_sign, just_tampered_rows])
-                
-                # Find optimal visualition range
-                first_tampered_timestamp = just_tampered_rows['Time'].tolist()[0]
-                last_tampered_timestamp = just_tampered_rows['Time'].tolist()[-1]
-                delta_timestamp = last_tampered_timestamp - first_tampered_timestamp
-                range_x = (first_tampered_timestamp - delta_timestamp, last_tampered_timestamp + delta_timestamp)
-
-                fig = px.line(df, x='Time',
-                                    y='Payload',
-                                    color='Type',
-                                    title='Signal (%d, %d) of type: %s appearances for id %s' % (sign[0], sign[1], sign[2], tampered_id),
-                                    range_x= range_x
-                                    )
+
+                fig = go.Figure()
+                for name, rows, mode in [('Original_signal', original_id, 'lines'),
+                                            ('Tampered_signal', tampered_id_rows, 'lines'),
+                                            ('Tampered_packets', just_tampered_rows, 'markers')]:
+                    times = ns_to_seconds(rows['Time'].to_numpy())
+                    values = signal_values(rows['Payload'].to_numpy(), sign[0], sign[1])
+                    kept = _min_max_downsample(values, max_points)
+                    fig.add_trace(go.Scattergl(x=times[kept], y=values[kept], mode=mode, name=name))
+                fig.update_layout(title='Signal (%d, %d) of type: %s appearances for id %s' % (sign[0], sign[1], sign[2], id_to_hex(tampered_id)),
+                                    xaxis={'range': [ns_to_seconds(x) for x in range_x], 'title': 'Time (s)'},
+                                    yaxis={'title': 'Payload'})
                 if export:
                     figs.append(fig)
                 else:
                     fig.show()
-            if export:
-                filename = 'graphs_%s.html' %(tampered_id)
-                with open(filename, 'w') as f:
-                    for fig in figs:
-                        f.write(fig.to_html(full_html=True, include_plotlyjs='cdn'))
-                webbrowser.open(filename, new=1)
+
+        if export:
+            with open(path, 'w') as f:
+                f.write('<html><head><meta charset="utf-8" /></head><body>\n')
+                for i, fig in enumerate(figs):
+                    f.write(fig.to_html(full_html=False, include_plotlyjs='cdn' if i == 0 else False))
+                f.write('</body></html>\n')
+            print('Graphs written to %s' % path)
+            if open_browser:
+                webbrowser.open(path, new=1)
 
     def export_dataset(self, path='vulnerable_dataset.csv', verbose=True):
         self.get_stats(verbose=verbose)
         print('Exporting..')
-        self.vulnerable_dataset.to_csv(path)
+        to_export_frame(self.vulnerable_dataset).to_csv(path, float_format=EXPORT_FLOAT_FORMAT)
         print('..Done') 
 
 if __name__ == "__main__":
@@ -142,6 +277,6 @@ if __name__ == "__main__":
     fIA = Fuzzy_injection_attack()
     time_delta = 1000
     id = '0F0'
-    time = dataset['Time'][0] + time_delta
+    time = dataset['Time'][0] + seconds_to_ns(time_delta)
     fIA.build_dataset(dataset, id, 1000, 200, ImplementationType.MASQUERADE, False)
     fIA.visualize_changes(export=True)
\ No newline at end of file
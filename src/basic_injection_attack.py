@@ -3,8 +3,9 @@ import numpy as np
 from dataset_loader import load_dataset, ColumnHeader
 from basic_attack import Attack
 from enums.implementation_type import ImplementationType
-from injection_function import inject_function
-from masquerade_function import masquerade_function
+from injection_function import inject_function, injection_span
+from masquerade_function import masquerade_batch, masquerade_span
+from id_utils import id_to_int
 
 class Basic_injection_attack(Attack):
 
@@ -35,7 +36,11 @@ class Basic_injection_attack(Attack):
         **kwargs:
             injection_rate: integer
                 The rate of injection of packets with refer to the average packet inter-arrival time of the id, not used for masquerade attacks
+
+            context: AttackContext, optional
+                Shared values of the run, the average interval of the id is taken from it when average_interval is not given
         """
+        super().__init__(context=kwargs.get('context'))
         assert type(payload) == str
         assert type(beginning_time_delta) == int or type(beginning_time_delta) == float
         assert type(injected_packets) == int
@@ -59,6 +64,8 @@ class Basic_injection_attack(Attack):
         if attack_type == ImplementationType.INJECTION:
             if 'injection_rate' not in kwargs or kwargs['injection_rate'] is None:
                 raise ValueError('Injection rate needed for basic injection attack')
+            if kwargs['injection_rate'] <= 0:
+                raise ValueError('Injection rate must be positive')
 
             if 'average_interval' not in kwargs or kwargs['average_interval'] is None:
                 self.parameters['average_interval'] = None
@@ -76,29 +83,30 @@ class Basic_injection_attack(Attack):
                                 average_interval=average_interval
                                 )
 
-    def __with_masquearade(self, dataset, id, payloads, beginning_time_delta, injected_packets):
-        
-        length = len(payloads[0])
-        
+    def __masquerades(self):
         replacements = {
-            (0, length) : payloads
+            (0, len(self.parameters['payload'])) : [self.parameters['payload']] * self.parameters['injected_packets']
         }
-       
-        return masquerade_function (dataset,
-                                    id=id,
-                                    beginning_time_delta=beginning_time_delta,
-                                    replacements=replacements
-        )
+        return [(self.parameters['id'], self.parameters['beginning_time_delta'], replacements)]
+
+    def __check_payload(self, dataset):
+        id_dlcs = dataset.loc[dataset['Id'] == id_to_int(self.parameters['id']), 'Dlc']
+        dlc = int(id_dlcs.iloc[0] if id_dlcs.shape[0] > 0 else dataset['Dlc'].iloc[0])
+        if len(self.parameters['payload']) != dlc * 8:
+            raise ValueError('The dataset payloads length must be the same of the substituting ones (%d)' % (dlc*8))
+
+    def get_masquerade(self, dataset):
+        if self.parameters['implementation_type'] != ImplementationType.MASQUERADE:
+            return None
+        self.__check_payload(dataset)
+        return self.__masquerades()
 
     def build_dataset(self, dataset):
         """
         Build and return the dataset
         """
         assert type(dataset) == pd.DataFrame
-    
-        dlc = dataset['Dlc'].tolist()[0]
-        if len(self.parameters['payload']) != dlc * 8:
-            raise ValueError('The dataset payloads length must be the same of the substituting ones (%d)' % dlc*8)
+        self.__check_payload(dataset)
 
         if self.original_dataset is None:
             self.original_dataset = dataset
@@ -112,16 +120,19 @@ class Basic_injection_attack(Attack):
                                                             beginning_time_delta=self.parameters['beginning_time_delta'], 
                                                             injected_packets=self.parameters['injected_packets'], 
                                                             injection_rate = self.parameters['injection_rate'],
-                                                            average_interval = self.parameters['average_interval'])
+                                                            average_interval = self.get_average_interval(dataset))
         else:
-            self.vulnerable_dataset = self.__with_masquearade(dataset=dataset, 
-                                                                id = self.parameters['id'],
-                                                                payloads=payloads, 
-                                                                beginning_time_delta=self.parameters['beginning_time_delta'], 
-                                                                injected_packets=self.parameters['injected_packets'])
+            self.vulnerable_dataset = masquerade_batch(dataset, self.__masquerades())
 
         return self.vulnerable_dataset
 
+    def get_span(self, dataset):
+        start = self.get_start_time(dataset, self.parameters['beginning_time_delta'])
+        if self.parameters['implementation_type'] == ImplementationType.INJECTION:
+            return injection_span(self.get_id_rows(dataset), self.parameters['id'], start, self.parameters['injected_packets'],
+                                    self.parameters['injection_rate'], self.get_average_interval(dataset), payload_length=len(self.parameters['payload']))
+        return masquerade_span(self.get_id_rows(dataset), start, self.parameters['injected_packets'])
+
     def toJSON(self):
         dict_representation = dict()
 
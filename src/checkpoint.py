@@ -0,0 +1,84 @@
+from dataset_cache import write_columnar, read_columnar
+import numpy as np
+import json, os, shutil
+
+"""
+    Checkpoints of an EnsambleAttack build, to resume a long configuration after a failure.
+
+    A checkpoint is a folder holding the dataset built so far in the columnar cache format (see dataset_cache) and a
+    state.json with the number of attacks already processed, the seed of the build, the skipped attacks and a digest of
+    the attacks processed, which must match the configuration the build is resumed with. Arrays of the state (e.g. the
+    frames touched by every attack, see AttackStats) are stored next to it in an arrays.npz.
+"""
+
+STATE_FILE = 'state.json'
+ARRAYS_FILE = 'arrays.npz'
+DATASET_FOLDER = 'dataset'
+INDEX_COLUMN = '_index'
+
+
+class Checkpoint(object):
+    path = None
+    every = 100
+
+    def __init__(self, path, every=100):
+        """
+        Parameters
+        ----------
+        path: string
+            The folder of the checkpoint
+
+        every: integer, optional
+            A checkpoint is written every this many attacks
+        """
+        assert type(path) == str
+        assert type(every) == int and every > 0
+        self.path = path
+        self.every = every
+
+    def exists(self):
+        return os.path.isfile(os.path.join(self.path, STATE_FILE))
+
+    def save(self, dataset, state, arrays=None):
+        """
+        Write the dataset, the state (a json serializable dict) and the arrays (a dict of numpy arrays by name). The
+        checkpoint is written aside and moved in place at the end, so that the previous one is kept if writing fails
+        """
+        tmp_path = self.path + '.tmp'
+        if os.path.exists(tmp_path):
+            shutil.rmtree(tmp_path)
+        os.makedirs(tmp_path)
+        # Attacks drop frames without resetting the index, which is kept as a column
+        write_columnar(dataset.rename_axis(INDEX_COLUMN).reset_index(), os.path.join(tmp_path, DATASET_FOLDER))
+        with open(os.path.join(tmp_path, STATE_FILE), 'w') as f:
+            json.dump(state, f, indent=4)
+        if arrays is not None:
+            np.savez(os.path.join(tmp_path, ARRAYS_FILE), **arrays)
+
+        if os.path.exists(self.path):
+            shutil.rmtree(self.path)
+        os.rename(tmp_path, self.path)
+
+    def load(self):
+        """
+        Return the dataset, the state and the arrays of the checkpoint
+        """
+        with open(os.path.join(self.path, STATE_FILE)) as f:
+            state = json.load(f)
+        dataset = read_columnar(os.path.join(self.path, DATASET_FOLDER)).set_index(INDEX_COLUMN).rename_axis(None)
+        arrays = dict()
+        if os.path.isfile(os.path.join(self.path, ARRAYS_FILE)):
+            with np.load(os.path.join(self.path, ARRAYS_FILE)) as f:
+                arrays = {x: f[x] for x in f.files}
+        return dataset, state, arrays
+
+    def remove(self):
+        if os.path.exists(self.path):
+            shutil.rmtree(self.path)
+
+
+def update_digest(digest, attack):
+    """
+    Update the hashlib digest (e.g. hashlib.sha256()) with the configuration of an attack
+    """
+    digest.update(json.dumps(attack, sort_keys=True, default=str).encode())
@@ -0,0 +1,105 @@
+import json, os, errno
+
+"""
+    Attack configurations can be stored either as a single JSON document
+
+        {"dataset": "...", "attacks": [{...}, {...}]}
+
+    or as JSON Lines (.jsonl), written incrementally by AttackConfGenerator: an optional header line holding the
+    dataset followed by one attack per line
+
+        {"dataset": "..."}
+        {"name": "...", "attack_type": "...", "parameters": {...}}
+"""
+
+JSONL_EXTENSIONS = ('.jsonl', '.ndjson')
+
+
+def is_jsonl(path):
+    return os.path.splitext(path)[1].lower() in JSONL_EXTENSIONS
+
+
+def iter_jsonl_attacks(path):
+    """
+        Lazily yield the attacks of a JSON Lines configuration, one at a time.
+        Header lines (the ones without an attack_type) and empty lines are skipped.
+    """
+    with open(path) as f:
+        for line_number, line in enumerate(f, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                raise ValueError('Invalid JSON at line %d of %s' % (line_number, path))
+            if 'attack_type' not in entry:
+                continue
+            yield entry
+
+
+def read_jsonl_header(path):
+    # The header, if any, is the first non empty line
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            entry = json.loads(line)
+            return entry if 'attack_type' not in entry else {}
+    return {}
+
+
+def load_config(path):
+    """
+        Return the dataset and the attacks of a configuration file.
+
+        Parameters
+        ----------
+        path: string
+            Path of a .json or .jsonl configuration file
+
+        Returns
+        -------
+        (dataset, attacks)
+            The dataset field (None if missing) and the attacks: a list for JSON files, a lazy iterator for JSON Lines files
+    """
+    if not os.path.isfile(path):
+        raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), path)
+
+    if is_jsonl(path):
+        return read_jsonl_header(path).get('dataset'), iter_jsonl_attacks(path)
+
+    with open(path) as f:
+        data = json.load(f)
+    return data.get('dataset'), data['attacks']
+
+
+class JsonlAttackWriter(object):
+    """
+        Incrementally write attacks to a JSON Lines configuration file
+    """
+    path = None
+    n_attacks = 0
+
+    def __init__(self, path, dataset=None):
+        assert type(path) == str
+        self.path = path
+        self.n_attacks = 0
+        self.__file = open(path, 'w')
+        if dataset is not None:
+            self.__file.write(json.dumps({'dataset': dataset}) + '\n')
+
+    def write(self, attack):
+        self.__file.write(json.dumps(attack) + '\n')
+        self.n_attacks += 1
+
+    def close(self):
+        if not self.__file.closed:
+            self.__file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,335 @@
+import json, os, shutil
+import pandas as pd
+import numpy as np
+from id_utils import id_to_int, ID_DTYPE
+
+"""
+    Columnar on-disk cache of the traces.
+
+    A cached trace is a folder with one .npy file per column plus a meta.json describing them. String columns are
+    stored as fixed width bytes so that every column can be memory mapped.
+
+    Rows are also grouped in row groups of ROW_GROUP_SIZE frames, for which the min/max Time and the ids present are
+    stored, so that LazyDataset can skip the row groups a time range or id filter cannot match.
+"""
+
+CACHE_VERSION = 4
+META_FILE = 'meta.json'
+ROW_GROUP_SIZE = 1 << 16
+ROW_GROUP_TIMES_FILE = 'row_group_times.npy'
+ROW_GROUP_IDS_FILE = 'row_group_ids.npy'
+
+
+def is_cached(path, source=None):
+    """
+        Whether path holds a cache of the current version. If source is given, the cache must also have been written
+        from it (see write_columnar)
+    """
+    meta_path = os.path.join(path, META_FILE)
+    if not os.path.isfile(meta_path):
+        return False
+    with open(meta_path) as f:
+        meta = json.load(f)
+    return meta.get('version') == CACHE_VERSION and (source is None or meta.get('source') == source)
+
+
+def source_signature(path):
+    # Identifies the version of a source file, to invalidate the caches written from an older one
+    stat = os.stat(path)
+    return {'path': os.path.abspath(path), 'size': stat.st_size, 'mtime': stat.st_mtime}
+
+
+def write_columnar(trace, path, source=None):
+    """
+        Write the trace to the columnar cache folder path. The folder is written aside and moved in place at the end,
+        so that a partially written cache is never read.
+
+        source, if given, is stored in the metadata and checked by is_cached (e.g. the source_signature of a csv)
+    """
+    assert type(trace) == pd.DataFrame
+    tmp_path = path + '.tmp'
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+
+    columns = list()
+    for column in trace.columns:
+        values = trace[column].to_numpy()
+        is_string = values.dtype == object
+        if is_string:
+            width = max(int(trace[column].str.len().max()), 1) if trace.shape[0] > 0 else 1
+            values = values.astype('S%d' % width)
+        np.save(os.path.join(tmp_path, '%s.npy' % _file_name(column)), values, allow_pickle=False)
+        columns.append({'name': column, 'file': '%s.npy' % _file_name(column), 'string': bool(is_string)})
+
+    meta = {'version': CACHE_VERSION, 'n_rows': int(trace.shape[0]), 'columns': columns, 'source': source}
+    meta.update(_write_row_groups(trace, tmp_path))
+    with open(os.path.join(tmp_path, META_FILE), 'w') as f:
+        json.dump(meta, f, indent=4)
+
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.rename(tmp_path, path)
+
+
+def _write_row_groups(trace, path):
+    # Per row group min/max Time and presence matrix of the ids, return the metadata describing them
+    n = trace.shape[0]
+    n_groups = (n + ROW_GROUP_SIZE - 1) // ROW_GROUP_SIZE
+    starts = np.arange(n_groups) * ROW_GROUP_SIZE
+
+    times = trace['Time'].to_numpy()
+    group_times = np.zeros((n_groups, 2), dtype=times.dtype)
+    if n > 0:
+        group_times[:, 0] = np.minimum.reduceat(times, starts)
+        group_times[:, 1] = np.maximum.reduceat(times, starts)
+    np.save(os.path.join(path, ROW_GROUP_TIMES_FILE), group_times, allow_pickle=False)
+
+    codes, ids = pd.factorize(trace['Id'])
+    group_ids = np.zeros((n_groups, len(ids)), dtype=bool)
+    known = codes >= 0
+    group_ids[np.flatnonzero(known) // ROW_GROUP_SIZE, codes[known]] = True
+    np.save(os.path.join(path, ROW_GROUP_IDS_FILE), group_ids, allow_pickle=False)
+
+    return {
+        'row_group_size': ROW_GROUP_SIZE,
+        'time_sorted': bool(np.all(np.diff(times) >= 0)),
+        'ids': [int(x) for x in ids]
+    }
+
+
+def read_columnar(path, columns=None, mmap=False):
+    """
+    Return the trace stored in the columnar cache folder path as a pandas dataframe
+
+    Parameters
+    ----------
+    columns: list(string), optional
+        Read only these columns
+
+    mmap: bool, optional
+        Memory map the numeric columns instead of reading them
+    """
+    with open(os.path.join(path, META_FILE)) as f:
+        meta = json.load(f)
+
+    data = dict()
+    for column in meta['columns']:
+        if columns is not None and column['name'] not in columns:
+            continue
+        values = np.load(os.path.join(path, column['file']), mmap_mode='r' if mmap else None, allow_pickle=False)
+        if column['string']:
+            values = _decode(values)
+        data[column['name']] = values
+    return pd.DataFrame(data)
+
+
+class LazyDataset(object):
+    """
+        Handle on one or more cached traces (e.g. the experiments of a vehicle, in order) that reads from disk only
+        the frames matching a time range and/or id filter.
+
+        The columns are memory mapped: the row group statistics select the row groups that can match, then (if the
+        trace is sorted by time) a binary search on Time narrows them, and only the matching rows are read. The
+        returned dataframes are indexed by the position of the frames in the whole trace, as the dataframe returned
+        by to_pandas.
+    """
+    paths = None
+    add_tampered_column = None
+
+    def __init__(self, paths, add_tampered_column=True):
+        """
+        Parameters
+        ----------
+        paths: string or list(string)
+            The columnar cache folders, concatenated in order
+
+        add_tampered_column: bool, optional
+            Add an IsTampered column of 0s to the returned dataframes, as load_dataset does
+        """
+        if type(paths) == str:
+            paths = [paths]
+        assert type(paths) == list and len(paths) > 0
+        assert type(add_tampered_column) == bool
+        self.paths = paths
+        self.add_tampered_column = add_tampered_column
+        self.__parts = [_CachedPart(path) for path in paths]
+
+    @property
+    def columns(self):
+        columns = [c['name'] for c in self.__parts[0].meta['columns']]
+        if self.add_tampered_column and 'IsTampered' not in columns:
+            columns.append('IsTampered')
+        return columns
+
+    @property
+    def shape(self):
+        return (len(self), len(self.columns))
+
+    def __len__(self):
+        return sum(part.n_rows for part in self.__parts)
+
+    def ids(self):
+        """
+            Return the ids present in the trace
+        """
+        ids = list()
+        for part in self.__parts:
+            ids += [x for x in part.meta['ids'] if x not in ids]
+        return ids
+
+    def first_time(self):
+        """
+            Return the timestamp of the first frame of the trace
+        """
+        part = [part for part in self.__parts if part.n_rows > 0][0]
+        return part.column('Time')[0].item()
+
+    def filter(self, time_range=None, ids=None, columns=None):
+        """
+        Return the frames with time in time_range and id in ids as a pandas dataframe
+
+        Parameters
+        ----------
+        time_range: couple(integer, integer), optional
+            The inclusive time range of the frames, in nanoseconds as the Time column
+
+        ids: list(string or integer), optional
+            The ids of the frames, as hexadecimal strings or integer arbitration ids
+
+        columns: list(string), optional
+            Read only these columns, all of them by default
+        """
+        columns = self.columns if columns is None else list(columns)
+        assert all(c in self.columns for c in columns)
+        if time_range is not None:
+            assert len(time_range) == 2 and time_range[0] <= time_range[1]
+        if ids is not None:
+            ids = [id_to_int(x) for x in ids]
+
+        frames = list()
+        offset = 0
+        for part in self.__parts:
+            positions = part.select(time_range, ids)
+            frames.append(part.take(positions, columns, offset))
+            offset += part.n_rows
+        return pd.concat(frames) if len(frames) > 1 else frames[0]
+
+    def rows(self, start, end, columns=None):
+        """
+            Return the frames from position start to end (excluded) of the whole trace as a pandas dataframe, e.g. to
+            read it in chunks
+        """
+        columns = self.columns if columns is None else list(columns)
+        frames = list()
+        offset = 0
+        for part in self.__parts:
+            first, last = max(start - offset, 0), min(end - offset, part.n_rows)
+            if first < last:
+                frames.append(part.take(np.arange(first, last), columns, offset))
+            offset += part.n_rows
+        if len(frames) == 0:
+            return self.__parts[0].take(np.zeros(0, dtype=np.int64), columns, 0)
+        return pd.concat(frames) if len(frames) > 1 else frames[0]
+
+    def to_pandas(self, columns=None):
+        """
+            Return the whole trace as a pandas dataframe
+        """
+        columns = self.columns if columns is None else list(columns)
+        frames = [part.take(None, columns, 0) for part in self.__parts]
+        return pd.concat(frames, ignore_index=True) if len(frames) > 1 else frames[0]
+
+
+class _CachedPart(object):
+    # A single cache folder of a LazyDataset, with its columns memory mapped on first use
+
+    def __init__(self, path):
+        with open(os.path.join(path, META_FILE)) as f:
+            self.meta = json.load(f)
+        if self.meta.get('version') != CACHE_VERSION:
+            raise ValueError('%s is not a columnar cache of version %d' % (path, CACHE_VERSION))
+        self.path = path
+        self.n_rows = self.meta['n_rows']
+        self.group_size = self.meta['row_group_size']
+        self.group_times = np.load(os.path.join(path, ROW_GROUP_TIMES_FILE), allow_pickle=False)
+        self.group_ids = np.load(os.path.join(path, ROW_GROUP_IDS_FILE), allow_pickle=False)
+        self.id_codes = {x: i for i, x in enumerate(self.meta['ids'])}
+        self.__columns = {c['name']: c for c in self.meta['columns']}
+        self.__mapped = dict()
+
+    def column(self, name):
+        if name not in self.__mapped:
+            self.__mapped[name] = np.load(os.path.join(self.path, self.__columns[name]['file']), mmap_mode='r', allow_pickle=False)
+        return self.__mapped[name]
+
+    def select(self, time_range, ids):
+        """
+            Return the positions of the frames matching the filters, None for all of them
+        """
+        if time_range is None and ids is None:
+            return None
+
+        groups = np.ones(self.group_times.shape[0], dtype=bool)
+        if time_range is not None:
+            groups &= (self.group_times[:, 1] >= time_range[0]) & (self.group_times[:, 0] <= time_range[1])
+        if ids is not None:
+            codes = [self.id_codes[x] for x in ids if x in self.id_codes]
+            groups &= self.group_ids[:, codes].any(axis=1) if len(codes) > 0 else False
+        selected = np.flatnonzero(groups)
+        if selected.shape[0] == 0:
+            return np.zeros(0, dtype=np.int64)
+
+        # Contiguous runs of selected row groups are scanned together
+        breaks = np.flatnonzero(np.diff(selected) != 1)
+        run_starts = selected[np.concatenate([[0], breaks + 1])]
+        run_ends = selected[np.concatenate([breaks, [selected.shape[0] - 1]])] + 1
+
+        times = self.column('Time')
+        id_values = np.array(ids, dtype=ID_DTYPE) if ids is not None else None
+        positions = list()
+        for group_start, group_end in zip(run_starts, run_ends):
+            start = int(group_start) * self.group_size
+            end = min(int(group_end) * self.group_size, self.n_rows)
+            mask = np.ones(end - start, dtype=bool)
+            if time_range is not None:
+                if self.meta['time_sorted']:
+                    # Binary search on the mapped column, only a few pages are read
+                    first = start + int(np.searchsorted(times[start:end], time_range[0], side='left'))
+                    last = start + int(np.searchsorted(times[start:end], time_range[1], side='right'))
+                    start, end = first, last
+                    mask = np.ones(max(end - start, 0), dtype=bool)
+                else:
+                    block = times[start:end]
+                    mask &= (block >= time_range[0]) & (block <= time_range[1])
+            if end <= start:
+                continue
+            if id_values is not None:
+                mask &= np.isin(self.column('Id')[start:end], id_values)
+            positions.append(start + np.flatnonzero(mask))
+        return np.concatenate(positions) if len(positions) > 0 else np.zeros(0, dtype=np.int64)
+
+    def take(self, positions, columns, offset):
+        # Read the given rows (all if positions is None) of the columns as a dataframe indexed by offset + position
+        n = self.n_rows if positions is None else positions.shape[0]
+        data = dict()
+        for name in columns:
+            if name not in self.__columns:
+                # IsTampered added on the fly
+                data[name] = np.zeros(n, dtype=np.uint8)
+                continue
+            values = self.column(name)
+            values = np.array(values) if positions is None else values[positions]
+            data[name] = _decode(values) if self.__columns[name]['string'] else values
+        index = np.arange(n) if positions is None else positions
+        return pd.DataFrame(data, index=pd.Index(index + offset))
+
+
+def _decode(values):
+    # Fixed width bytes -> Python strings, as read_csv returns them
+    return values.astype('U%d' % values.dtype.itemsize).astype(object)
+
+
+def _file_name(column):
+    # Column names like 'Can#' are not safe file names everywhere
+    return ''.join(c if c.isalnum() else '_' for c in column)
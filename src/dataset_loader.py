@@ -1,10 +1,22 @@
 from enum import Enum
 from datetime import datetime
 from utils import Logger
-import requests, os, tarfile
+from id_utils import ids_to_int
+from time_utils import timestamps_to_ns, NS_PER_SECOND
+from payload_utils import dlc_to_length
+from dataset_cache import is_cached, read_columnar, write_columnar, source_signature, LazyDataset
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import hashlib, os, shutil, tarfile
 import pandas as pd
 import numpy as np
 
+# Base url of the ReCAN data, it can be replaced by a local mirror (a folder, a file:// or an http(s):// url with the same
+#  structure) through the base_url argument of load_dataset or the CANTACK_DATASET_URL environment variable
+DEFAULT_BASE_URL = 'https://github.com/Cyberdefence-Lab-Murcia/ReCAN/raw/master/Data'
+DOWNLOAD_CHUNK_SIZE = 1 << 20
+CSV_CHUNK_ROWS = 1 << 20
+HEADER_LIST = ['Time', 'Can#', 'Id', 'Dlc', 'Payload']
+
 class DEIBVehicle(Enum):
     ALFA_GIULIA = "C-1-AlfaRomeo-Giulia"
     OPEL_CORSA = "C-2-Opel-Corsa"
@@ -28,9 +40,11 @@ class ColumnHeader(Enum):
         PAYLOAD = 'Payload'
         TAMPERED = 'IsTampered'
 
-def load_dataset(vehicle=DEIBVehicle.ALFA_GIULIA, exp=1, to_datetime=False, add_tampered_column=True, verbose=True, path=None, dataset_folder='./datasets/'):
+def load_dataset(vehicle=DEIBVehicle.ALFA_GIULIA, exp=1, to_datetime=False, add_tampered_column=True, verbose=True, path=None, dataset_folder='./datasets/', base_url=None, checksums=None, workers=None, use_cache=True, lazy=False):
     """
     Return the target dataset as panda dataframe
+    Time is in int64 nanoseconds from 1st January 1970 (see time_utils), Ids are uint32 arbitration ids (see id_utils,
+    EXTENDED_ID_FLAG marks the extended ones), Can# and Dlc are uint8 and IsTampered is a uint8 flag
     If the argument `vehicle` isn't passed, ALFA_GIULIA will be used.
     If the argument `exp` isn't passed, 1 will be used.
 
@@ -42,7 +56,24 @@ def load_dataset(vehicle=DEIBVehicle.ALFA_GIULIA, exp=1, to_datetime=False, add_
         The vehicle's dataset you want to retrieve 
 
     exp: integer, optional
-        The experiment number
+        The experiment number, or 'all' for all the experiments of the vehicle
+
+    base_url: string, optional
+        The base url of the ReCAN data (GitHub by default, or CANTACK_DATASET_URL if set). A local folder, file:// or
+        http(s):// mirror with the same structure can be used
+
+    checksums: dict(string -> string), optional
+        Expected sha256 of the archives, by archive url. If not given, a <archive url>.sha256 file is looked for on the mirror
+
+    workers: integer, optional
+        The number of concurrent downloads and of the processes extracting and parsing the archives, by default the number of cpus
+
+    use_cache: bool, optional
+        Keep the parsed experiments in a columnar cache inside dataset_folder, so that later loads skip the parsing
+
+    lazy: bool, optional
+        Return a LazyDataset on the columnar cache instead of a dataframe, whose time range and id filters only read
+        the matching frames from disk. A csv given by path is cached inside dataset_folder too
     """
     assert type(vehicle) == DEIBVehicle
     assert type(add_tampered_column) == bool
@@ -53,72 +84,238 @@ def load_dataset(vehicle=DEIBVehicle.ALFA_GIULIA, exp=1, to_datetime=False, add_
         assert type(exp) == int
         assert exp > 0
 
+    if lazy and not use_cache:
+        raise ValueError('A lazy dataset is read from the columnar cache, use_cache must be True')
+    if lazy and to_datetime:
+        raise ValueError('Timestamps of a lazy dataset cannot be converted to datetime')
+
     logger = Logger(verbose=verbose)
 
     if not os.path.exists(dataset_folder):
         os.mkdir(dataset_folder)
 
-    header_list = ['Time', 'Can#', 'Id', 'Dlc', 'Payload']
-    csv_file_path = dataset_folder + '/raw.csv'
-
     if path is None:
-        
-        target_paths = list()
-        traces = list()
+        if base_url is None:
+            base_url = os.environ.get('CANTACK_DATASET_URL', DEFAULT_BASE_URL)
+        if workers is None:
+            workers = os.cpu_count() or 1
 
-        exps = [exp] if exp != 'all' else [x for x in range(1, max_exp[vehicle])]
+        exps = [exp] if exp != 'all' else [x for x in range(1, max_exp[vehicle] + 1)]
 
+        archives = list()
         for exp in exps:
-            dataset_url = 'https://github.com/Cyberdefence-Lab-Murcia/ReCAN/raw/master/Data/%s/Exp-%d/raw.tar.gz' % (vehicle.value, exp)
+            dataset_url = '%s/%s/Exp-%d/raw.tar.gz' % (base_url.rstrip('/'), vehicle.value, exp)
             if vehicle == DEIBVehicle.ALFA_GIULIA and exp == 3:                     # For compliancy with strange specific structure
                 dataset_url = dataset_url.replace('raw.tar.gz', 'raw.csv.tar.gz')
-            target_path = dataset_folder + '%s_exp%d.tar.gz' % (vehicle.value, exp)
-            target_paths.append(target_path)
+            target_path = os.path.join(dataset_folder, '%s_exp%d.tar.gz' % (vehicle.value, exp))
+            cache_path = os.path.join(dataset_folder, '%s_exp%d.cache' % (vehicle.value, exp))
             logger.print('%s(exp %d) selected' % (vehicle.value, exp))
-            if not os.path.exists(target_path):
-                response = requests.get(dataset_url, stream=True)
-                logger.print('Getting file from GitHub..')
-                if response.status_code == 200:
-                    with open(target_path, 'wb') as f:
-                        f.write(response.raw.read())
-                        logger.print('..done')
-                elif response.status_code == 404:
-                    print('No experiment with the given id_exp(%d) for vehicle: %s' % (exp, vehicle.value))
-                    print('Url was: %s' % dataset_url)
-                    exit
-                else:
-                    print(response.status_code, 'An error occured during dataset retrieval')
+            archives.append((dataset_url, target_path, cache_path))
+
+        # Download concurrently what is neither cached nor already downloaded, archives already on disk are fetched again
+        #  if they do not match their checksum
+        to_fetch = list()
+        for url, target, cache in archives:
+            if use_cache and is_cached(cache):
+                continue
+            if os.path.exists(target):
+                sha256 = checksums.get(url) if checksums is not None else None
+                sha256 = sha256 if sha256 is not None else published_sha256(url)
+                if sha256 is None or file_sha256(target).lower() == sha256.lower():
+                    continue
+                logger.print('%s does not match its checksum, fetching it again' % target)
+                os.remove(target)
+            to_fetch.append((url, target))
+        if len(to_fetch) > 0:
+            logger.print('Getting %d file(s) from %s..' % (len(to_fetch), base_url))
+            with ThreadPoolExecutor(max_workers=min(workers, len(to_fetch))) as executor:
+                futures = [executor.submit(fetch_file, url, target, None if checksums is None else checksums.get(url)) for url, target in to_fetch]
+                for future in futures:
+                    future.result()
+            logger.print('..done')
 
+        # Extract and parse in parallel processes, each one writing its experiment to the columnar cache
+        to_ingest = [(target, cache) for _, target, cache in archives if not is_cached(cache)] if use_cache else []
+        if len(to_ingest) > 0:
             logger.print('Extracting..')
-            filename = 'raw.csv' if exp != 3 else './raw.csv'
-            a_trace = pd.read_csv(
-                tarfile.open(target_path, 'r').extractfile(filename),
-                sep=',',
-                names=header_list  
-            )
+            if workers > 1 and len(to_ingest) > 1:
+                with ProcessPoolExecutor(max_workers=min(workers, len(to_ingest))) as executor:
+                    futures = [executor.submit(ingest_archive, target, cache) for target, cache in to_ingest]
+                    for future in futures:
+                        future.result()
+            else:
+                for target, cache in to_ingest:
+                    ingest_archive(target, cache)
             logger.print('..done')
-            traces.append(a_trace)
 
-        trace = pd.concat(traces)
+        if lazy:
+            return LazyDataset([cache for _, _, cache in archives], add_tampered_column=add_tampered_column)
+        if use_cache:
+            traces = [read_columnar(cache) for _, _, cache in archives]
+        else:
+            traces = [read_archive(target) for _, target, _ in archives]
+        trace = pd.concat(traces, ignore_index=True) if len(traces) > 1 else traces[0]
 
     else:
         assert type(path) == str
         logger.print('Reading dataset from file..')
         csv_file_path = path
-        trace = pd.read_csv(csv_file_path, names=header_list)
+        if lazy:
+            cache_path = os.path.join(dataset_folder, '%s.cache' % os.path.splitext(os.path.basename(csv_file_path))[0])
+            signature = source_signature(csv_file_path)
+            if not is_cached(cache_path, source=signature):
+                trace = read_csv_trace(csv_file_path)
+                write_columnar(trace, cache_path, source=signature)
+            logger.print('..done')
+            return LazyDataset(cache_path, add_tampered_column=add_tampered_column)
+        trace = read_csv_trace(csv_file_path)
         logger.print('..done')
     
     if to_datetime:
         logger.print("Converting timestamps..")
-        trace['Time'] =  trace['Time'].apply(lambda x: datetime.fromtimestamp(x))
+        trace['Time'] =  trace['Time'].apply(lambda x: datetime.fromtimestamp(x / NS_PER_SECOND))
         logger.print("..done")
 
     # Add IsTampered column if necessary
     if add_tampered_column:
-        trace['IsTampered'] = [0 for _ in range(trace.shape[0])]  
+        trace['IsTampered'] = np.zeros(trace.shape[0], dtype=np.uint8)
     
     return trace
 
+
+def fetch_file(url, target_path, sha256=None, chunk_size=DOWNLOAD_CHUNK_SIZE):
+    """
+    Download url to target_path, resuming a previous partial download, and verify its sha256
+
+    Parameters
+    ----------
+    url: string
+        An http(s):// or file:// url, or a local path
+
+    sha256: string, optional
+        The expected checksum. If not given, <url>.sha256 is used when the mirror provides it
+    """
+    part_path = target_path + '.part'
+    if url.startswith('file://') or '://' not in url:
+        local_path = url[len('file://'):] if url.startswith('file://') else url
+        if not os.path.exists(local_path):
+            raise ValueError('No experiment archive at %s' % url)
+        shutil.copyfile(local_path, part_path)
+    else:
+        import requests
+        # Resume from the bytes already on disk, if the server supports ranges
+        resume_from = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        headers = {'Range': 'bytes=%d-' % resume_from} if resume_from > 0 else {}
+        with requests.get(url, stream=True, headers=headers) as response:
+            if response.status_code == 404:
+                raise ValueError('No experiment archive at %s' % url)
+            if response.status_code == 416:
+                # The partial file is already complete
+                pass
+            elif response.status_code in (200, 206):
+                mode = 'ab' if response.status_code == 206 else 'wb'
+                with open(part_path, mode) as f:
+                    for chunk in response.iter_content(chunk_size=chunk_size):
+                        f.write(chunk)
+            else:
+                raise ValueError('An error occured during dataset retrieval (%d): %s' % (response.status_code, url))
+
+    if sha256 is None:
+        sha256 = published_sha256(url)
+    if sha256 is not None:
+        digest = file_sha256(part_path)
+        if digest.lower() != sha256.lower():
+            os.remove(part_path)
+            raise ValueError('Checksum mismatch for %s: expected %s, got %s' % (url, sha256, digest))
+    os.replace(part_path, target_path)
+
+
+def published_sha256(url):
+    """
+    Return the sha256 of the archive at url published by the mirror in <url>.sha256, None if there is none
+    """
+    if url.startswith('file://') or '://' not in url:
+        local_path = (url[len('file://'):] if url.startswith('file://') else url) + '.sha256'
+        if not os.path.exists(local_path):
+            return None
+        with open(local_path) as f:
+            return f.read().split()[0]
+    import requests
+    response = requests.get(url + '.sha256')
+    return response.text.split()[0] if response.status_code == 200 else None
+
+
+def file_sha256(path, chunk_size=DOWNLOAD_CHUNK_SIZE):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def read_archive(target_path):
+    """
+        Return the raw csv contained in an experiment archive as a dataframe
+    """
+    with tarfile.open(target_path, 'r') as tar:
+        # Archives store either raw.csv or ./raw.csv
+        member = [m for m in tar.getmembers() if m.isfile() and m.name.endswith('raw.csv')][0]
+        return read_csv_trace(tar.extractfile(member))
+
+
+def read_csv_trace(file):
+    """
+        Return a raw csv trace (path or file object) as a dataframe with compact dtypes
+    """
+    trace = pd.read_csv(file, sep=',', names=HEADER_LIST, dtype={'Can#': np.uint8, 'Id': str, 'Dlc': np.uint8, 'Payload': str})
+    trace['Time'] = timestamps_to_ns(trace['Time'])
+    trace['Id'] = ids_to_int(trace['Id'])
+    trace['Dlc'] = data_lengths(trace['Dlc'].to_numpy(), trace['Payload'].to_numpy())
+    return trace
+
+
+def data_lengths(dlc, payloads):
+    """
+        Return the Dlc column as the number of bytes of the payloads: CAN FD traces may give the DLC codes 9 to 15 of
+        payloads of 12 to 64 bytes, they are replaced by the lengths when the payloads are that long
+    """
+    coded = np.flatnonzero((dlc > 8) & (dlc <= 15))
+    if coded.shape[0] == 0:
+        return dlc
+    lengths = dlc_to_length(dlc[coded])
+    payload_bits = np.fromiter(map(len, payloads[coded]), dtype=np.int64, count=coded.shape[0])
+    is_code = payload_bits == lengths.astype(np.int64) * 8
+    dlc = dlc.copy()
+    dlc[coded[is_code]] = lengths[is_code]
+    return dlc
+
+
+def read_csv_chunks(path, chunk_rows=CSV_CHUNK_ROWS):
+    """
+        Yield a csv trace in chunks of chunk_rows frames, as dataframes with the compact dtypes of read_csv_trace. Both
+        raw traces and exported vulnerable datasets (with header, index and IsTampered column) are read
+    """
+    with open(path) as f:
+        is_exported = 'Time' in f.readline().strip().split(',')
+    dtypes = {'Can#': np.uint8, 'Id': str, 'Dlc': np.uint8, 'Payload': str}
+    if is_exported:
+        chunks = pd.read_csv(path, index_col=0, chunksize=chunk_rows, dtype=dict(dtypes, IsTampered=np.uint8))
+    else:
+        chunks = pd.read_csv(path, sep=',', names=HEADER_LIST, chunksize=chunk_rows, dtype=dtypes)
+    for trace in chunks:
+        trace['Time'] = timestamps_to_ns(trace['Time'])
+        trace['Id'] = ids_to_int(trace['Id'])
+        if not is_exported:
+            trace['Dlc'] = data_lengths(trace['Dlc'].to_numpy(), trace['Payload'].to_numpy())
+        yield trace.reset_index(drop=True)
+
+
+def ingest_archive(target_path, cache_path):
+    # Run in a worker process: parse an experiment archive straight into the columnar cache
+    write_columnar(read_archive(target_path), cache_path)
+    return cache_path
+
+
 if __name__ == "__main__":
     trace = load_dataset(path='/home/alenichel/Downloads/raw.csv')
     print('Total line: %d' %(len(trace)))
\ No newline at end of file
@@ -0,0 +1,221 @@
+from attack_stats import match_frames
+from dataset_cache import LazyDataset, write_columnar, read_columnar
+import hashlib, json, os, shutil
+import numpy as np
+import pandas as pd
+
+"""
+    Delta export of a vulnerable dataset against the base trace it was built from.
+
+    A delta is a folder holding only the frames the attacks deleted (their positions in the base trace), modified
+    (their positions and new values) and inserted (their values and the position of the base frame they precede), with
+    a fingerprint of the base trace. read_delta rebuilds the vulnerable dataset reading the base trace in chunks and
+    merging the delta into them, so that many vulnerable copies of the same trace are stored as their changes.
+
+    The changes are looked for in the time intervals of the applied attacks (see AttackStats.records) only, matching
+    the frames of the base trace and of the vulnerable dataset by (Time, Id, Can#) (see attack_stats.match_frames).
+"""
+
+DELTA_VERSION = 1
+META_FILE = 'meta.json'
+DELETED_FILE = 'deleted.npy'
+MODIFIED_FOLDER = 'modified'
+INSERTED_FOLDER = 'inserted'
+ROW_COLUMN = '_row'
+CHUNK_ROWS = 1 << 20
+
+
+def write_delta(base, dataset, path, intervals=None):
+    """
+    Write the delta of the dataset against the base trace to the folder path. The folder is written aside and moved
+    in place at the end
+
+    Parameters
+    ----------
+    base: pandas.Dataframe or LazyDataset
+        The base trace, without the attacks
+
+    dataset: pandas.Dataframe
+        The vulnerable dataset
+
+    intervals: list(couple(integer, integer)), optional
+        Time intervals in nanoseconds holding all the changes (e.g. the first and last times of the applied attacks).
+        By default the whole traces are compared
+    """
+    assert type(base) in (pd.DataFrame, LazyDataset)
+    assert type(dataset) == pd.DataFrame
+    columns = list(dataset.columns)
+    assert all(x in base.columns for x in columns)
+
+    deleted, modified, inserted = list(), list(), list()
+    for (base_start, base_end), (start, end) in _ranges(base, dataset, intervals):
+        before = _rows(base, base_start, base_end, columns)
+        after = dataset.iloc[start:end].reset_index(drop=True)
+        changes = _diff(before, after)
+        deleted.append(changes[0] + base_start)
+        modified.append(changes[1].assign(**{ROW_COLUMN: changes[1][ROW_COLUMN] + base_start}))
+        inserted.append(changes[2].assign(**{ROW_COLUMN: changes[2][ROW_COLUMN] + base_start}))
+
+    tmp_path = path + '.tmp'
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+    np.save(os.path.join(tmp_path, DELETED_FILE), np.concatenate(deleted).astype(np.int64), allow_pickle=False)
+    write_columnar(pd.concat(modified, ignore_index=True), os.path.join(tmp_path, MODIFIED_FOLDER))
+    write_columnar(pd.concat(inserted, ignore_index=True), os.path.join(tmp_path, INSERTED_FOLDER))
+    meta = {'version': DELTA_VERSION,
+            'columns': columns,
+            'n_base_rows': _n_rows(base),
+            'n_rows': int(dataset.shape[0]),
+            'fingerprint': base_fingerprint(base, columns)}
+    with open(os.path.join(tmp_path, META_FILE), 'w') as f:
+        json.dump(meta, f, indent=4)
+
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.rename(tmp_path, path)
+
+
+def read_delta(path, base, chunk_rows=CHUNK_ROWS, verify=True):
+    """
+    Rebuild the vulnerable dataset of the delta in path, yielding it in chunks of about chunk_rows frames indexed by
+    their position
+
+    Parameters
+    ----------
+    base: pandas.Dataframe or LazyDataset
+        The base trace the delta was written against
+
+    verify: bool, optional
+        Check the fingerprint of the base trace while reading it, a ValueError is raised after the last chunk if it
+        does not match
+    """
+    assert type(base) in (pd.DataFrame, LazyDataset)
+    assert type(chunk_rows) == int and chunk_rows > 0
+    with open(os.path.join(path, META_FILE)) as f:
+        meta = json.load(f)
+    if meta.get('version') != DELTA_VERSION:
+        raise ValueError('%s is not a delta of version %d' % (path, DELTA_VERSION))
+    n_base = _n_rows(base)
+    if n_base != meta['n_base_rows']:
+        raise ValueError('The base trace has %d frames, the delta %s was written against %d' % (n_base, path, meta['n_base_rows']))
+
+    columns = meta['columns']
+    deleted = np.sort(np.load(os.path.join(path, DELETED_FILE), allow_pickle=False))
+    modified = read_columnar(os.path.join(path, MODIFIED_FOLDER))
+    inserted = read_columnar(os.path.join(path, INSERTED_FOLDER))
+    modified_rows = modified[ROW_COLUMN].to_numpy()
+    inserted_rows = inserted[ROW_COLUMN].to_numpy()
+    digest = hashlib.sha256()
+
+    offset = 0
+    starts = list(range(0, n_base, chunk_rows)) or [0]
+    for start in starts:
+        end = min(start + chunk_rows, n_base)
+        frames = _rows(base, start, end, columns)
+        if verify:
+            digest.update(_hash(frames))
+
+        # Modified frames replace the base ones
+        first, last = np.searchsorted(modified_rows, [start, end])
+        if last > first:
+            positions = modified_rows[first:last] - start
+            for column in columns:
+                values = frames[column].to_numpy().copy()
+                values[positions] = modified[column].to_numpy()[first:last]
+                frames[column] = values
+        keep = np.ones(end - start, dtype=bool)
+        keep[deleted[np.searchsorted(deleted, start):np.searchsorted(deleted, end)] - start] = False
+
+        # Inserted frames go before the base frame of their row, the ones of the last row after the last frame
+        first, last = np.searchsorted(inserted_rows, [start, end if end < n_base else n_base + 1])
+        anchors = np.concatenate([inserted_rows[first:last], np.arange(start, end)[keep]])
+        kinds = np.repeat(np.array([0, 1], dtype=np.int8), [last - first, int(keep.sum())])
+        order = np.lexsort((np.arange(anchors.shape[0]), kinds, anchors))
+        chunk = pd.concat([inserted.iloc[first:last][columns], frames[keep]], ignore_index=True).iloc[order]
+        chunk.index = pd.RangeIndex(offset, offset + chunk.shape[0])
+        offset += chunk.shape[0]
+        yield chunk
+
+    if verify and digest.hexdigest() != meta['fingerprint']:
+        raise ValueError('The base trace does not match the one the delta %s was written against' % path)
+
+
+def apply_delta(path, base, chunk_rows=CHUNK_ROWS, verify=True):
+    """
+    Return the vulnerable dataset of the delta in path as a whole (see read_delta)
+    """
+    return pd.concat(list(read_delta(path, base, chunk_rows=chunk_rows, verify=verify)))
+
+
+def base_fingerprint(base, columns=None, chunk_rows=CHUNK_ROWS):
+    """
+    Return the fingerprint of the trace, hashed from the values of its columns (all by default) read in chunks
+    """
+    columns = list(base.columns) if columns is None else columns
+    digest = hashlib.sha256()
+    for start in range(0, _n_rows(base), chunk_rows):
+        digest.update(_hash(_rows(base, start, min(start + chunk_rows, _n_rows(base)), columns)))
+    return digest.hexdigest()
+
+
+def _diff(before, after):
+    # Return the positions of the deleted frames of before, the modified frames and the inserted frames of after with
+    # the position in before they replace or precede, in the ROW_COLUMN
+    matched_before, matched_after, deleted, added = match_frames(before, after)
+    order = np.argsort(matched_after, kind='stable')
+    matched_before, matched_after = matched_before[order], matched_after[order]
+    if np.any(np.diff(matched_before) < 0):
+        # Frames moved, the whole range is replaced
+        matched_before, matched_after = np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        deleted, added = np.arange(before.shape[0]), np.arange(after.shape[0])
+
+    changed = np.zeros(matched_before.shape[0], dtype=bool)
+    for column in after.columns:
+        changed |= before[column].to_numpy()[matched_before] != after[column].to_numpy()[matched_after]
+    modified = after.iloc[matched_after[changed]].assign(**{ROW_COLUMN: matched_before[changed]})
+
+    following = np.searchsorted(matched_after, added)
+    rows = np.append(matched_before, before.shape[0])[following]
+    inserted = after.iloc[added].assign(**{ROW_COLUMN: rows})
+    return deleted, modified, inserted
+
+
+def _ranges(base, dataset, intervals):
+    # Couples of (base positions, dataset positions) ranges holding the intervals, the frames between them are the same
+    n_base, n = _n_rows(base), dataset.shape[0]
+    base_times = base.to_pandas(columns=['Time'])['Time'].to_numpy() if type(base) == LazyDataset else base['Time'].to_numpy()
+    times = dataset['Time'].to_numpy()
+    is_sorted = bool(np.all(base_times[1:] >= base_times[:-1])) and bool(np.all(times[1:] >= times[:-1]))
+    if intervals is None or not is_sorted:
+        return [((0, n_base), (0, n))]
+
+    ranges = list()
+    for interval in sorted(intervals):
+        base_range = (int(np.searchsorted(base_times, interval[0], side='left')), int(np.searchsorted(base_times, interval[1], side='right')))
+        dataset_range = (int(np.searchsorted(times, interval[0], side='left')), int(np.searchsorted(times, interval[1], side='right')))
+        if len(ranges) > 0 and (base_range[0] <= ranges[-1][0][1] or dataset_range[0] <= ranges[-1][1][1]):
+            ranges[-1] = ((ranges[-1][0][0], max(base_range[1], ranges[-1][0][1])), (ranges[-1][1][0], max(dataset_range[1], ranges[-1][1][1])))
+        else:
+            ranges.append((base_range, dataset_range))
+
+    # The unchanged frames between the ranges must be as many in both
+    gaps = [(0, 0)] + [(x[0][1], x[1][1]) for x in ranges]
+    nexts = [(x[0][0], x[1][0]) for x in ranges] + [(n_base, n)]
+    if any(b[0] - a[0] != b[1] - a[1] for a, b in zip(gaps, nexts)):
+        raise ValueError('The dataset has changes outside the given intervals')
+    return ranges
+
+
+def _rows(base, start, end, columns):
+    # The frames of the trace from position start to end, indexed from 0
+    frames = base.rows(start, end, columns) if type(base) == LazyDataset else base.iloc[start:end][columns]
+    return frames.reset_index(drop=True)
+
+
+def _n_rows(base):
+    return len(base) if type(base) == LazyDataset else int(base.shape[0])
+
+
+def _hash(frames):
+    return pd.util.hash_pandas_object(frames, index=False).to_numpy().tobytes()
@@ -2,7 +2,9 @@ import pandas as pd
 import numpy as np
 from dataset_loader import load_dataset, ColumnHeader
 from basic_attack import Attack
-from injection_function import inject_function
+from injection_function import inject_function, injection_span, frame_time_ns
+from id_utils import is_extended
+from time_utils import seconds_to_ns, ns_to_seconds
 
 MIN_FRAME_LENGTH = 47
 MIN_EXTENDED_FRAME_LENGTH = 67
@@ -10,8 +12,8 @@ MIN_EXTENDED_FRAME_LENGTH = 67
 class Dos_attack(Attack):
     attack_parameters = dict()
 
-    def __init__(self, injection_time_delta, duration, bus_speed=0.5e6, percentage_bus=100 , _id = '000', payload='00000000'):
-        super().__init__()
+    def __init__(self, injection_time_delta, duration, bus_speed=0.5e6, percentage_bus=100 , _id = '000', payload='00000000', context=None, data_bus_speed=None):
+        super().__init__(context=context)
         assert injection_time_delta > 0
         assert duration > 0
         #Check the payload is in binary
@@ -31,6 +33,7 @@ class Dos_attack(Attack):
         self.parameters['injection_time_delta'] = injection_time_delta
         self.parameters['duration'] = duration
         self.parameters['bus_speed'] = bus_speed
+        self.parameters['data_bus_speed'] = data_bus_speed
         self.parameters['percentage_bus'] = percentage_bus
         self.parameters['id'] = _id
         self.parameters['payload'] = payload
@@ -54,6 +57,9 @@ class Dos_attack(Attack):
             The duration of the attack in seconds
         bus_speed: int
             The bus speed in bps.
+        data_bus_speed: int, optional
+            The bit rate of the data phase of CAN FD frames in bps, the bus is a CAN FD bus with bit rate switching if given. Payloads
+            longer than 8 bytes are sent in CAN FD frames anyway
         percentage_bus: float
             The percentage of the attack, being 100 the bus totally saturated bus with the injection of the new packets
         
@@ -63,15 +69,39 @@ class Dos_attack(Attack):
 
         payload: string, optional
             The payload of the injected packets as hexadecimal string, not really important for this attack, we may decide to not have this parameter
+
+        context: AttackContext, optional
+            Shared values of the run, the average interval of the id is taken from it
         
     """
         assert type(dataset) == pd.DataFrame
 
-        indices = dataset.index
         id = self.parameters['id']
         payload = self.parameters['payload']
+        injection_rate, injected_packets = self.__injection(dataset)
+        payloads=[payload]*injected_packets
+
+        self.vulnerable_dataset = inject_function(dataset, id, payloads, self.parameters['injection_time_delta'], injection_rate, bus_speed = self.parameters['bus_speed'],
+                                                    check_bus = True, data_bus_speed = self.parameters['data_bus_speed'])
+
+        return self.vulnerable_dataset
+
+    def get_span(self, dataset):
+        # The injected frames and the frames around them checked against the bus load
+        injection_rate, injected_packets = self.__injection(dataset)
+        start = self.get_start_time(dataset, self.parameters['injection_time_delta'])
+        return injection_span(self.get_id_rows(dataset), self.parameters['id'], start, injected_packets, injection_rate,
+                                payload_length=len(self.parameters['payload']), bus_speed=self.parameters['bus_speed'], data_bus_speed=self.parameters['data_bus_speed'])
 
-        if len(id) <= 3:
+    def __injection(self, dataset):
+        # Return the injection rate (as a percentage of the bus) and the number of packets of the DoS
+        id = self.parameters['id']
+        payload = self.parameters['payload']
+
+        if len(payload) > 64 or self.parameters['data_bus_speed'] is not None:
+            # CAN FD frame
+            packet_time = ns_to_seconds(frame_time_ns(np.ceil(len(payload) / 8), is_extended(id), self.parameters['bus_speed'], self.parameters['data_bus_speed']))
+        elif not is_extended(id):
             packet_length = len(payload)  + MIN_FRAME_LENGTH
             packet_time = (packet_length) / self.parameters['bus_speed']
         else:
@@ -79,23 +109,17 @@ class Dos_attack(Attack):
             packet_time = (packet_length) / self.parameters['bus_speed']
 
         packet_interarrival=packet_time*(self.parameters['percentage_bus']/100)
-        dataset_id=dataset.loc[(dataset['Id']==id) & (dataset['IsTampered'] == 0)]
-        if dataset_id.shape[0]==0:
+        # Average interval of the id in the original dataset, taken from the shared context
+        average_interval = self.get_average_interval(dataset)
+        if average_interval is None:
             injection_rate=self.parameters['percentage_bus']
         else:
-            indices_id=dataset_id.index
-            interval = dataset_id['Time'][indices_id[-1]] - dataset_id['Time'][indices_id[0]]
-            average_interval = interval / (len(indices) - 1)
             injection_rate=int(np.round((average_interval/packet_interarrival-1)*100))
 
         #Compute the number of injected packets in the period.
         # The +1 is done in order to fill the entire duration of the DoS
         injected_packets=np.ceil(self.parameters['duration']/packet_interarrival)+1
-        payloads=[payload]*int(injected_packets)
-
-        self.vulnerable_dataset = inject_function(dataset, id, payloads, self.parameters['injection_time_delta'], injection_rate, bus_speed = self.parameters['bus_speed'], check_bus = True)
-
-        return self.vulnerable_dataset
+        return injection_rate, int(injected_packets)
 
 if __name__ == "__main__":
     time_delta = 900
@@ -105,9 +129,9 @@ if __name__ == "__main__":
 
     dataset = load_dataset()
     a =dos_a.build_dataset(dataset, time_delta, duration)
-    error_dataset=dos_a.vulnerable_dataset[((dos_a.vulnerable_dataset['Time'] > time) & (dos_a.vulnerable_dataset['Time'] < time+duration)) & (dos_a.vulnerable_dataset['Id']!="000") ]
+    error_dataset=dos_a.vulnerable_dataset[((dos_a.vulnerable_dataset['Time'] > seconds_to_ns(time)) & (dos_a.vulnerable_dataset['Time'] < seconds_to_ns(time+duration))) & (dos_a.vulnerable_dataset['Id']!=0) ]
     #dos_a.visualize_changes(export=True)
-    changed_data_set=dos_a.vulnerable_dataset[((dos_a.vulnerable_dataset['Time'] > time) & (dos_a.vulnerable_dataset['Time'] < time+duration))]
+    changed_data_set=dos_a.vulnerable_dataset[((dos_a.vulnerable_dataset['Time'] > seconds_to_ns(time)) & (dos_a.vulnerable_dataset['Time'] < seconds_to_ns(time+duration)))]
     error=error_dataset.shape[0]/changed_data_set.shape[0]
     print('The error is of %f' % error)
 
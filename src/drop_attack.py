@@ -2,12 +2,13 @@ import pandas as pd
 import numpy as np
 from dataset_loader import load_dataset, ColumnHeader
 from basic_attack import Attack
+from drop_function import drop_function
 
 class Drop_attack(Attack):
 
     attack_parameters = dict()
 
-    def __init__(self, _id, beginning_time_delta, dropped_packets):
+    def __init__(self, _id, beginning_time_delta, dropped_packets, context=None):
         """
         Initialize the object
 
@@ -23,11 +24,16 @@ class Drop_attack(Attack):
 
         dropped_packets: integer
             The number of dropped packets
+
+        context: AttackContext, optional
+            Shared values of the run
         """
-        super().__init__()
+        super().__init__(context=context)
         assert type(_id) == str
         assert type(beginning_time_delta) == int or type(beginning_time_delta) == float
         assert type(dropped_packets) == int
+        if dropped_packets < 0:
+            raise ValueError('Dropped packets must be a non negative number')
 
         self.attack_type = 'DROP'
         self.name = 'drop%s' % id(self)
@@ -48,23 +54,24 @@ class Drop_attack(Attack):
         """
         assert type(dataset) == pd.DataFrame
 
-        index = dataset.index
-        initial_timestamp = dataset['Time'][index[0]] + self.parameters['beginning_time_delta']
-
-        dataset = dataset.drop(dataset.loc[(dataset['Time'] > initial_timestamp) & (dataset['Id'] == self.parameters['id'])][0:self.parameters['dropped_packets']].index)
-        try:
-            next_packet_index = dataset.loc[(dataset['Id'] == self.parameters['id']) & (dataset['Time'] > initial_timestamp)].index[0]
-            dataset['IsTampered'][next_packet_index] = 1
-        except:
-            pass
-
-        self.vulnerable_dataset = dataset
-
-        # Reset index to correct values without the dropped packets
-        self.vulnerable_dataset.index = pd.RangeIndex(0, len(self.vulnerable_dataset.index))
-        
+        self.vulnerable_dataset = drop_function(dataset, [self.get_drop()])
         return self.vulnerable_dataset
 
+    def get_drop(self):
+        """
+        Return the drop as the (id, beginning_time_delta, dropped_packets) arguments of drop_function. Consecutive drop
+        attacks are applied at once by EnsambleAttack
+        """
+        return (self.parameters['id'], self.parameters['beginning_time_delta'], self.parameters['dropped_packets'])
+
+    def get_span(self, dataset):
+        # The dropped frames and the next one of the id, which is marked as tampered
+        start = self.get_start_time(dataset, self.parameters['beginning_time_delta'])
+        times = self.get_id_rows(dataset)['Time'].to_numpy()
+        times = times[times > start]
+        end = times[min(self.parameters['dropped_packets'], len(times) - 1)] if len(times) > 0 else start
+        return (start, int(end))
+
     def toJSON(self):
         dict_representation = dict()
         dict_representation['name'] = self.name
@@ -0,0 +1,76 @@
+from id_utils import id_to_int
+from time_utils import seconds_to_ns
+import pandas as pd
+import numpy as np
+
+def drop_function(dataset, drops):
+    """
+        Return the dataset without the packets dropped by the given drops, as applying them in order: every drop removes the first
+        dropped_packets packets of its id after its beginning, and marks as tampered the next packet of the id left in the dataset.
+
+        The packets of every id are found once, the dropped and marked ones of all the drops are collected on their positions and the
+        dataset is compacted in a single pass, with the tampered flags set. The returned dataset is a new one, indexed from 0.
+
+        Parameters
+        ----------
+        dataset: pandas.Dataframe
+            The original dataset
+
+        drops: list(triple(string, float, integer))
+            The id (as an hexadecimal string), beginning_time_delta (the time difference in seconds between the timestamp of the first message
+            in the dataset and the beginning of the drop) and number of dropped packets of every drop
+    """
+    assert type(dataset) == pd.DataFrame
+    assert type(drops) == list
+
+    times = dataset['Time'].to_numpy()
+    ids = dataset['Id'].to_numpy()
+    removed = np.zeros(dataset.shape[0], dtype=bool)
+    marked = list()
+    id_frames = dict()
+    # The first packet left, which the beginning of the next drops refers to
+    first = 0
+    for id, beginning_time_delta, dropped_packets in drops:
+        assert type(dropped_packets) == int
+        id_value = id_to_int(id)
+        if id_value not in id_frames:
+            positions = np.flatnonzero(ids == id_value)
+            id_times = times[positions]
+            id_frames[id_value] = (positions, id_times, bool(np.all(id_times[1:] >= id_times[:-1])))
+        positions, id_times, is_sorted = id_frames[id_value]
+
+        # The packets of the id after the beginning of the drop, in order
+        while first < removed.shape[0] - 1 and removed[first]:
+            first += 1
+        initial_timestamp = times[first] + seconds_to_ns(beginning_time_delta)
+        if is_sorted:
+            following = positions[np.searchsorted(id_times, initial_timestamp, side='right'):]
+        else:
+            following = positions[id_times > initial_timestamp]
+        left = _first_left(following, removed, dropped_packets + 1)
+        removed[left[:dropped_packets]] = True
+        if left.shape[0] > dropped_packets:
+            marked.append(left[dropped_packets])
+
+    kept = ~removed
+    columns = dict()
+    for column in dataset.columns:
+        values = dataset[column].to_numpy()
+        if column == 'IsTampered' and len(marked) > 0:
+            values = values.copy()
+            values[marked] = 1
+        columns[column] = values[kept]
+    return pd.DataFrame(columns)
+
+def _first_left(positions, removed, n):
+    # The first n positions not removed yet, looking at growing slices of positions
+    found = list()
+    n_found = 0
+    start, size = 0, max(n, 1)
+    while n_found < n and start < positions.shape[0]:
+        block = positions[start:start + size]
+        block = block[~removed[block]]
+        found.append(block)
+        n_found += block.shape[0]
+        start, size = start + size, size * 2
+    return np.concatenate(found)[:n] if len(found) > 0 else np.zeros(0, dtype=np.int64)
@@ -1,12 +1,12 @@
 import pandas as pd
 import numpy as np
-import random
 from dataset_loader import load_dataset, ColumnHeader
 from basic_attack import Attack
 from enums.implementation_type import ImplementationType
-from injection_function import inject_function
-from masquerade_function import masquerade_function
-from read import read, SIGN_TYPE
+from injection_function import inject_function, injection_span
+from masquerade_function import masquerade_batch, masquerade_span
+from id_utils import id_to_int
+from payload_utils import bits_to_payloads, payloads_to_matrix, MAX_PAYLOAD_BYTES
 
 class Fuzzy_injection_attack(Attack):
 
@@ -34,13 +34,17 @@ class Fuzzy_injection_attack(Attack):
             injection_rate: integer
                 The rate of injection of packets with refer to the average packet inter-arrival time of the id. Not used for masquerade attacks.
 
-            bit_ranges: list(couple(int, int))
-                The edges of the original payload to substitute, ignored for smart_fuzzying
+            bit_ranges: list(couple(int, int)), optional
+                The edges of the original payload to substitute, ignored for smart_fuzzying (by default the whole payload)
 
             seed: int
                 Seed for the random generator
+
+            context: AttackContext, optional
+                Shared values of the run, the average interval of the id and the signals found by READ for smart_fuzzying
+                are taken from it
         """
-        super().__init__()
+        super().__init__(context=kwargs.get('context'))
         assert type(_id) == str
         assert type(beginning_time_delta) == int or type(beginning_time_delta) == float
         assert type(injected_packets) == int
@@ -53,7 +57,7 @@ class Fuzzy_injection_attack(Attack):
 
         if 'seed' in kwargs and kwargs['seed'] is not None:
             assert type(kwargs['seed']) == int
-            random.seed(kwargs['seed'])
+            np.random.seed(kwargs['seed'])
             self.parameters['seed'] = kwargs['seed']
 
         self.parameters['id'] = _id
@@ -62,18 +66,20 @@ class Fuzzy_injection_attack(Attack):
         self.parameters['implementation_type'] = attack_type.value
         self.parameters['smart_fuzzying'] = smart_fuzzying
         if 'intervals' in kwargs:
-            self.parameters['intervals'] = kwargs['intervals']
+            # Intervals coming from a JSON configuration are lists
+            self.parameters['intervals'] = [tuple(x) for x in kwargs['intervals']]
 
         if 'intervals' not in kwargs and 'bit_ranges' in kwargs and kwargs['bit_ranges'] is not None:
                 assert type(kwargs['bit_ranges']) == list
                 assert all(list(map(type, x)) == [int, int] for x in kwargs['bit_ranges']) 
-                self.parameters['intervals'] = kwargs['bit_ranges']
-        elif 'intervals' not in kwargs and not smart_fuzzying:
-            self.parameters['intervals'] = [(0, packet_length)]
+                # Bit ranges coming from a JSON configuration are lists
+                self.parameters['intervals'] = [tuple(x) for x in kwargs['bit_ranges']]
 
         if attack_type == ImplementationType.INJECTION:
             if 'injection_rate' not in kwargs or kwargs['injection_rate'] is None:
                 raise ValueError('Injection rate needed for fuzzy injection attack')
+            if kwargs['injection_rate'] <= 0:
+                raise ValueError('Injection rate must be positive')
             self.parameters['injection_rate'] = kwargs['injection_rate']
 
             if 'average_interval' not in kwargs or kwargs['average_interval'] is None:
@@ -89,11 +95,36 @@ class Fuzzy_injection_attack(Attack):
                                 injection_rate,
                                 average_interval=average_interval)
 
-    def __with_masquearade(self, dataset, id, beginning_time_delta, replacements):
-        return masquerade_function(dataset,
-                                    id,
-                                    beginning_time_delta,
-                                    replacements)
+    def __replacements(self, id_dataset):
+        # The random bits of every interval of the injected packets, by interval, as (injected_packets, bits) 0/1 matrices
+        if id_dataset.shape[0] == 0:
+            raise ValueError('No messages with the given id (%s) in the dataset' % self.parameters['id'])
+
+        if 'intervals' not in self.parameters and self.parameters['smart_fuzzying']:
+            if self.context is not None:
+                signals = self.context.signals(self.parameters['id'])
+            else:
+                from read import read
+                signals = read(id_dataset, verbose=False)[id_to_int(self.parameters['id'])]
+            self.parameters['intervals'] = list()
+            for sig in signals:
+                self.parameters['intervals'].append((sig[0], sig[1]))
+        elif 'intervals' not in self.parameters:
+            # Without bit ranges the whole payload is fuzzed
+            self.parameters['intervals'] = [(0, int(id_dataset['Dlc'].iloc[0]) * 8)]
+
+        replacements = {}
+        for interval in self.parameters['intervals']:
+            if interval[1] < interval[0]:
+                raise ValueError('Starting bit has to be lower than ending bit for each given bit range')
+            replacements[interval] = np.random.randint(0, 2, size=(self.parameters['injected_packets'], interval[1] - interval[0]), dtype=np.uint8)
+        return replacements
+
+    def get_masquerade(self, dataset):
+        if self.parameters['implementation_type'] != ImplementationType.MASQUERADE:
+            return None
+        replacements = self.__replacements(dataset[dataset['Id'] == id_to_int(self.parameters['id'])])
+        return [(self.parameters['id'], self.parameters['beginning_time_delta'], replacements)] if len(replacements.keys()) > 0 else []
 
     def build_dataset(self, dataset):
         """
@@ -107,26 +138,9 @@ class Fuzzy_injection_attack(Attack):
         assert type(dataset) == pd.DataFrame
 
         self.original_dataset = dataset
-        id_dataset = dataset[dataset['Id'] == self.parameters['id']]
+        id_dataset = dataset[dataset['Id'] == id_to_int(self.parameters['id'])]
         indices = id_dataset.index
-        packet_length = id_dataset['Dlc'][indices[0]] * 8
-
-        if 'intervals' not in self.parameters and self.parameters['smart_fuzzying']:
-            signals = read(id_dataset, verbose=False)[self.parameters['id']]
-            self.parameters['intervals'] = list()
-            for sig in signals:
-                self.parameters['intervals'].append((sig[0], sig[1]))
-
-        replacements = {}
-
-        for i in range(self.parameters['injected_packets']):
-            for interval in self.parameters['intervals']:
-                if not interval in replacements:
-                    replacements[interval] = []
-                fuzzy_bits = interval[1] - interval[0]
-                rand_num = random.getrandbits(fuzzy_bits)
-                rand_bits = bin(rand_num)[2:].zfill(fuzzy_bits)
-                replacements[interval].append(rand_bits)
+        replacements = self.__replacements(id_dataset)
         
         if len(replacements.keys()) == 0:
             return dataset
@@ -137,12 +151,20 @@ class Fuzzy_injection_attack(Attack):
             n_of_packets = len(list(replacements.values())[0]) 
             payloads = []
 
-            # As injection_func takes full payloads as input, reconstruct them
-            for i in range(n_of_packets):
-                payload = base_payload
+            # As injection_func takes full payloads as input, reconstruct them, on the byte matrix of the first payload if it holds all the intervals
+            if len(base_payload) % 8 == 0 and len(base_payload) <= MAX_PAYLOAD_BYTES * 8 and max(x[1] for x in replacements.keys()) <= len(base_payload):
+                matrix = payloads_to_matrix([base_payload]).take(np.zeros(n_of_packets, dtype=np.int64))
                 for interval in replacements.keys():
-                    payload = replacements[interval][i].join([payload[:interval[0]], payload[interval[1]:]])
-                payloads.append(payload)
+                    if interval[1] > interval[0]:
+                        matrix.set_bits(interval[0], interval[1], replacements[interval])
+                payloads = matrix.to_payloads().tolist()
+            else:
+                replacing = {interval: bits_to_payloads(bits) for interval, bits in replacements.items()}
+                for i in range(n_of_packets):
+                    payload = base_payload
+                    for interval in replacements.keys():
+                        payload = replacing[interval][i].join([payload[:interval[0]], payload[interval[1]:]])
+                    payloads.append(payload)
 
             self.vulnerable_dataset = self.__with_injection(dataset,
                                                             self.parameters['id'],
@@ -150,15 +172,22 @@ class Fuzzy_injection_attack(Attack):
                                                             self.parameters['beginning_time_delta'],
                                                             self.parameters['injected_packets'],
                                                             self.parameters['injection_rate'],
-                                                            self.parameters['average_interval'])
+                                                            self.get_average_interval(dataset))
         else:
-            self.vulnerable_dataset = self.__with_masquearade(dataset,
-                                                                self.parameters['id'],
-                                                                self.parameters['beginning_time_delta'],
-                                                                replacements)
+            self.vulnerable_dataset = masquerade_batch(dataset, [(self.parameters['id'], self.parameters['beginning_time_delta'], replacements)])
 
         return self.vulnerable_dataset
 
+    def get_span(self, dataset):
+        start = self.get_start_time(dataset, self.parameters['beginning_time_delta'])
+        id_rows = self.get_id_rows(dataset)
+        if self.parameters['implementation_type'] == ImplementationType.INJECTION:
+            span = injection_span(id_rows, self.parameters['id'], start, self.parameters['injected_packets'],
+                                    self.parameters['injection_rate'], self.get_average_interval(dataset))
+            # The injected payloads are built on the first payload of the id
+            return [(int(id_rows['Time'].iloc[0]),) * 2, span] if id_rows.shape[0] > 0 else span
+        return masquerade_span(id_rows, start, self.parameters['injected_packets'])
+
     def toJSON(self):
         dict_representation = dict()
         dict_representation['name'] = self.name
@@ -178,7 +207,7 @@ if __name__ == "__main__":
     time = 0
     injection_rate = 20
 
-    random.seed(123)
+    np.random.seed(123)
     fuz2 = Fuzzy_injection_attack( _id, time_delta, 5, ImplementationType.MASQUERADE, False)
     df2 = fuz2.build_dataset(df2)
     
@@ -0,0 +1,59 @@
+import numpy as np
+import pandas as pd
+
+"""
+    Arbitration ids are stored in the datasets as uint32, with EXTENDED_ID_FLAG set for the 29 bits ids of extended
+    frames (as SocketCAN does). The hexadecimal strings of the raw traces and of the configurations are converted only
+    at the edges: when loading, when reading the attack parameters and when exporting.
+"""
+
+ID_DTYPE = np.uint32
+EXTENDED_ID_FLAG = 0x80000000
+MAX_STANDARD_ID = 0x7FF
+
+
+def id_to_int(_id):
+    """
+    Return the integer arbitration id of an hexadecimal string id, integer ids are returned unchanged.
+    Ids written with more than 3 digits or greater than 0x7FF are extended ids
+    """
+    if isinstance(_id, (int, np.integer)):
+        return int(_id)
+    value = int(_id, 16)
+    digits = _id[2:] if _id[:2].lower() == '0x' else _id
+    if len(digits.strip()) > 3 or value > MAX_STANDARD_ID:
+        value |= EXTENDED_ID_FLAG
+    return value
+
+
+def id_to_hex(_id):
+    """
+    Return the hexadecimal string of an integer arbitration id, 3 digits for standard ids and 8 for extended ones
+    """
+    value = id_to_int(_id)
+    if value & EXTENDED_ID_FLAG:
+        return '%08X' % (value & ~EXTENDED_ID_FLAG)
+    return '%03X' % value
+
+
+def is_extended(_id):
+    return bool(id_to_int(_id) & EXTENDED_ID_FLAG)
+
+
+def ids_to_int(ids):
+    """
+    Return the integer arbitration ids (ID_DTYPE array) of a list, numpy array or pandas Series of hexadecimal string ids
+    """
+    # Every distinct id is converted once
+    codes, uniques = pd.factorize(np.asarray(ids, dtype=object))
+    values = np.array([id_to_int(x) for x in uniques], dtype=ID_DTYPE)
+    return values[codes]
+
+
+def ids_to_hex(ids):
+    """
+    Return the hexadecimal string ids (object array) of a list, numpy array or pandas Series of integer ids
+    """
+    codes, uniques = pd.factorize(np.asarray(ids))
+    values = np.array([id_to_hex(x) for x in uniques], dtype=object)
+    return values[codes]
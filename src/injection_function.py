@@ -1,4 +1,6 @@
 from dataset_loader import load_dataset
+from id_utils import id_to_int, EXTENDED_ID_FLAG
+from time_utils import seconds_to_ns, ns_to_seconds, NS_PER_SECOND
 import pandas as pd
 import numpy as np
 import warnings
@@ -6,18 +8,53 @@ import warnings
 #Values of the frames counting the bits between packets (inter-arrival)
 MIN_FRAME_LENGTH = 47
 MIN_EXTENDED_FRAME_LENGTH = 67
-THRESHOLD_ERROR = 0.000005
+# CAN FD frames: the bits sent at the nominal bit rate (arbitration, ACK, EOF and interframe space) and the ones of the
+# data phase besides the data (ESI, DLC, stuff count and CRC, longer past 16 bytes), sent at the data bit rate if switched
+FD_FRAME_LENGTH = 30
+FD_EXTENDED_FRAME_LENGTH = 49
+FD_DATA_PHASE_LENGTH = 26
+FD_LONG_DATA_PHASE_LENGTH = 30
+COMPACT_COLUMNS = ['Time', 'Can#', 'Id', 'Dlc', 'IsTampered']
+
+
+def frame_time_ns(dlc, extended, bus_speed, data_bus_speed=None):
+    # Transmission time of a frame in integer nanoseconds, dlc being the number of bytes of the payload. Frames longer
+    # than 8 bytes, or all of them on a bus with a data bit rate, are CAN FD frames
+    if int(dlc) <= 8 and data_bus_speed is None:
+        frame_length = int(dlc) * 8 + (MIN_EXTENDED_FRAME_LENGTH if extended else MIN_FRAME_LENGTH)
+        return int(round(frame_length * NS_PER_SECOND / bus_speed))
+    data_length = int(dlc) * 8 + (FD_DATA_PHASE_LENGTH if int(dlc) <= 16 else FD_LONG_DATA_PHASE_LENGTH)
+    frame_time = (FD_EXTENDED_FRAME_LENGTH if extended else FD_FRAME_LENGTH) / bus_speed
+    frame_time += data_length / (data_bus_speed if data_bus_speed is not None else bus_speed)
+    return int(round(frame_time * NS_PER_SECOND))
 
 
 def calculate_average_interval(dataset, id):
-    id_times = dataset.loc[dataset['Id'] == id, 'Time']
+    # Average inter-arrival time of the id in seconds
+    id_times = dataset.loc[dataset['Id'] == id_to_int(id), 'Time']
     ind = id_times.index
     if len(ind) > 1:
         interval_id = id_times[ind[-1]] - id_times[ind[0]]
-        return interval_id/(len(id_times)-1)
+        return ns_to_seconds(interval_id)/(len(id_times)-1)
 
 
-def inject_function(dataset, id, payloads, beginning_time_delta, injection_rate, average_interval = None, check_bus = False, bus_speed = 1e6):
+def injection_span(id_rows, id, start, injected_packets, injection_rate, average_interval=None, payload_length=64, bus_speed=1e6, data_bus_speed=None):
+    """
+        Return the (start, end) times in nanoseconds of the frames an inject_function beginning at start can add or
+        drop, id_rows being the frames of the id in the dataset
+    """
+    dlc = int(id_rows['Dlc'].iloc[0]) if id_rows.shape[0] > 0 else int(np.ceil(payload_length/8))
+    packet_time = frame_time_ns(dlc, id_to_int(id) & EXTENDED_ID_FLAG, bus_speed, data_bus_speed)
+    if average_interval is None:
+        injection_period = packet_time*(100/injection_rate) if injection_rate > 0 else packet_time
+    else:
+        injection_period = seconds_to_ns(average_interval)/injection_rate
+    injection_period = max(injection_period, packet_time)
+    # The noise on the injection times (standard deviation of period/500) stays well within one period
+    return (int(start - injection_period), int(start + injected_packets*injection_period + packet_time))
+
+
+def inject_function(dataset, id, payloads, beginning_time_delta, injection_rate, average_interval = None, check_bus = False, bus_speed = 1e6, data_bus_speed = None):
     """
         Return the original dataset with the addition of the specified packets
 
@@ -35,16 +72,23 @@ def inject_function(dataset, id, payloads, beginning_time_delta, injection_rate,
         payloads: list[string]
             The payloads of the injected packets as binary strings, the number of injected packets is defined by the length of the list
 
-        beginning_time_delta: int
-            The time difference in milliseconds between the timestamp of the first message in the dataset (in seconds from 1st January 1970) and
+        beginning_time_delta: float
+            The time difference in seconds between the timestamp of the first message in the dataset (in seconds from 1st January 1970) and
             the beginning of the injection
         
         injection_rate: integer
             The rate of injection of packets with refer to the average packet inter-arrival time of the id. In case of not having packets with such
             id in the database, it is the percentage of the bus to be filled
+
+        average_interval: float, optional
+            The average inter-arrival time of the id in seconds
             
         bus_speed: float
             The bus speed in bps.
+
+        data_bus_speed: float, optional
+            The bit rate of the data phase of CAN FD frames in bps, all the frames are CAN FD frames if given. By default the frames
+            longer than 8 bytes are CAN FD frames sent at bus_speed
             
     """
     #Checks the inputs
@@ -54,6 +98,7 @@ def inject_function(dataset, id, payloads, beginning_time_delta, injection_rate,
     assert type(beginning_time_delta) == int or type(beginning_time_delta) == float
     assert beginning_time_delta > 0
     assert type(bus_speed) == int or type(bus_speed) == float
+    assert data_bus_speed is None or type(data_bus_speed) == int or type(data_bus_speed) == float
 
     for payload in payloads:
         try:
@@ -61,7 +106,7 @@ def inject_function(dataset, id, payloads, beginning_time_delta, injection_rate,
         except ValueError:
             raise ValueError('Payload must be base 2 encoded')
     try:
-        int(id,16)
+        id_value = id_to_int(id)
     except ValueError:
         raise ValueError('Id must be base 16 encoded')
 
@@ -71,11 +116,11 @@ def inject_function(dataset, id, payloads, beginning_time_delta, injection_rate,
     # Number of injected packets
     injected_packets = len(payloads)
     # Get the average interval between packets of the Id and the period of injected messages from it
-    id_dataset = dataset[(dataset['Id'] == id)]
+    id_dataset = dataset[(dataset['Id'] == id_value)]
     #See if there are packets with this id in the dataset
     if id_dataset.shape[0]==0:
         warnings.warn('There is no id:%s in the initial dataset. The injection rate is going to behave as the percentage of the bus to be filled with injected messages' % id)
-        Dlc=np.ceil(len(payloads[0])/8)
+        Dlc = int(np.ceil(len(payloads[0])/8))
         # Injected on the can of the first. TODO: make the user decide which can use
         can_num = dataset['Can#'].tolist()[0]
     else:
@@ -83,39 +128,34 @@ def inject_function(dataset, id, payloads, beginning_time_delta, injection_rate,
         Dlc = id_dataset['Dlc'].tolist()[0]
         can_num = id_dataset['Can#'].tolist()[0]
 
-    if len(id)==3:
-        packet_length=Dlc*8+MIN_FRAME_LENGTH
-    else:
-        packet_length=Dlc*8+MIN_EXTENDED_FRAME_LENGTH
-
-    packet_time = packet_length/bus_speed
+    # Times are in integer nanoseconds, as the Time column
+    packet_time = frame_time_ns(Dlc, id_value & EXTENDED_ID_FLAG, bus_speed, data_bus_speed)
 
     if average_interval is None:
         injection_period = packet_time*(100/injection_rate)
     else:
-        injection_period = average_interval/injection_rate
+        injection_period = seconds_to_ns(average_interval)/injection_rate
 
     #Check the maximum injection rate
     if injection_period<packet_time:
         injection_period=packet_time
-        real_injection_rate=(average_interval/injection_period)
+        real_injection_rate=((seconds_to_ns(average_interval) if average_interval is not None else packet_time*100)/injection_period)
         warnings.warn('The injection rate is higher than the available throughput. The maximum injection rate is %d' % real_injection_rate)
 
 
     init_ind=dataset.index
     interval = dataset['Time'][init_ind[-1]] - dataset['Time'][init_ind[0]]
-    if beginning_time_delta > interval:
-        raise ValueError('Beginning time delta must be lower than the covered period from the dataset (%d)' % interval)
+    if seconds_to_ns(beginning_time_delta) > interval:
+        raise ValueError('Beginning time delta must be lower than the covered period from the dataset (%d)' % ns_to_seconds(interval))
 
     # Calculate timestamps of the injected messages adding a white noise to the expected injection times
-    initial_timestamp = dataset['Time'][init_ind[0]] + beginning_time_delta
-    final_timestamp = initial_timestamp + injection_period * (injected_packets - 1)
-    new_timestamps = np.linspace(initial_timestamp, final_timestamp, num=injected_packets)
+    initial_timestamp = dataset['Time'][init_ind[0]] + seconds_to_ns(beginning_time_delta)
+    new_timestamps = initial_timestamp + np.round(np.arange(injected_packets) * injection_period).astype(np.int64)
 
     # TODO: define standard deviation better
     std = injection_period/500
     noise = np.random.normal(0, std, injected_packets)
-    new_timestamps = np.add(new_timestamps, noise)
+    new_timestamps = new_timestamps + np.round(noise).astype(np.int64)
 
     # Separate not affected messages not to have to sort the whole dataset
     previous_messages = dataset[dataset['Time'] <= new_timestamps.tolist()[0]]
@@ -130,15 +170,19 @@ def inject_function(dataset, id, payloads, beginning_time_delta, injection_rate,
     # Add injected messages to the dictionary and to the current DataFrame
     data_dictionary = {'Time': new_timestamps, 
                         'Can#': can_num,
-                        'Id': id, 
+                        'Id': id_value, 
                         'Dlc': Dlc, 
                         'Payload': payloads,
                         'IsTampered': 1}
+    # Keep the compact dtypes of the dataset, appending int64 columns would upcast them
+    injected_messages = pd.DataFrame.from_dict(data_dictionary)
+    injected_messages = injected_messages.astype({c: dataset[c].dtype for c in COMPACT_COLUMNS if c in dataset.columns})
 
-    current_messages = current_messages.append(pd.DataFrame.from_dict(data_dictionary), ignore_index=True)
+    current_messages = current_messages.append(injected_messages, ignore_index=True)
 
     # As the injected messages were appended, sort by timestamp to obtain the correct order
-    current_messages.sort_values(by='Time', inplace=True)
+    # The sort is stable, on equal timestamps the injected messages follow the ones already in the dataset
+    current_messages.sort_values(by='Time', inplace=True, kind='mergesort')
 
     #Put new indices for later check of the throughput
     current_messages= current_messages.reset_index(drop=True)
@@ -156,7 +200,7 @@ def inject_function(dataset, id, payloads, beginning_time_delta, injection_rate,
     indices_window=current_messages.index
 
     last_quit=False
-    # Check drop the ones for the time interval wrong, this perfoms an error of 0.076% due to float limitations
+    # Check drop the ones for the time interval wrong
     if check_bus:
         for j in range(1,len(arrival_pack)):
 
@@ -166,15 +210,12 @@ def inject_function(dataset, id, payloads, beginning_time_delta, injection_rate,
                 if ((tampered_m[j] == 0) & (tampered_m[prev] == 0)):
                     continue
                 #Packet_time of the current packet
-                if len(id_windows[prev]) == 3:
-                    packet_time = ((size_packets[prev] * 8 + MIN_FRAME_LENGTH) / bus_speed)
-                else:
-                    packet_time = ((size_packets[prev] * 8 + MIN_EXTENDED_FRAME_LENGTH) / bus_speed)
+                packet_time = frame_time_ns(size_packets[prev], id_windows[prev] & EXTENDED_ID_FLAG, bus_speed, data_bus_speed)
 
                 inter_arrival = arrival_pack[j] - arrival_pack[prev]
 
-                if inter_arrival < (packet_time-THRESHOLD_ERROR):
-                    if (int(id_windows[j], 16) >= int(id_windows[prev], 16)):
+                if inter_arrival < packet_time:
+                    if id_windows[j] >= id_windows[prev]:
                         indices_to_drop.append(indices_window[j])
                         last_quit = True
                     else:
@@ -182,14 +223,11 @@ def inject_function(dataset, id, payloads, beginning_time_delta, injection_rate,
                 continue
             if ((tampered_m[j]==0) & (tampered_m[j-1]==0) ):
                 continue
-            if len(id_windows[j-1]) == 3:
-                packet_time = ((size_packets[j-1] * 8 + MIN_FRAME_LENGTH) / bus_speed)
-            else:
-                packet_time = ((size_packets[j-1] * 8 + MIN_EXTENDED_FRAME_LENGTH) / bus_speed)
+            packet_time = frame_time_ns(size_packets[j-1], id_windows[j-1] & EXTENDED_ID_FLAG, bus_speed, data_bus_speed)
             inter_arrival=arrival_pack[j]-arrival_pack[j-1]
-            if inter_arrival<(packet_time-THRESHOLD_ERROR):
+            if inter_arrival<packet_time:
                 # Drop the packet with the id higher
-                if(int(id_windows[j],16)>=int(id_windows[j-1],16)):
+                if id_windows[j] >= id_windows[j-1]:
                     indices_to_drop.append(indices_window[j])
                     last_quit=True
                     prev=j-1
@@ -225,14 +263,14 @@ if __name__ == "__main__":
     print("redicted packet transmission time: " + str(packet_time))
 
     # Average inter-arrival time (0.379ms)
-    inter = (dataset['Time'][dataset.shape[0] -1] - dataset['Time'][0])/(dataset.shape[0] - 1)
+    inter = ns_to_seconds(dataset['Time'][dataset.shape[0] -1] - dataset['Time'][0])/(dataset.shape[0] - 1)
     print("Average inter-arrival time: " + str(inter))
 
     id = '0F0'
 
     # The period for id 0F0 is 10ms
-    indices = dataset[dataset['Id'] == id].index
-    inter = (dataset[dataset['Id'] == id]['Time'][indices[-1]] - dataset[dataset['Id'] == id]['Time'][indices[0]])/(len(indices)-1)
+    indices = dataset[dataset['Id'] == id_to_int(id)].index
+    inter = ns_to_seconds(dataset['Time'][indices[-1]] - dataset['Time'][indices[0]])/(len(indices)-1)
     print("Average inter-arrival time for Id " + id + ": " + str(inter))
 
     # To succeed in the attack we need an injection rate between 20 and 100
@@ -246,7 +284,7 @@ if __name__ == "__main__":
     payload = 'FFFFFFFFFFFFFFFF'
     payloads = [bin(int(payload, 16))[2:]]*30
     id="0F0"
-    time = dataset['Time'][0] + injection_time_delta
+    time = dataset['Time'][0] + seconds_to_ns(injection_time_delta)
 
     res = inject_function(dataset,
                             id, 
@@ -255,4 +293,4 @@ if __name__ == "__main__":
                             1,
                             bus_speed = FREQUENCY)
 
-    print(res.loc[(res['Time'] > time) & (res['Id'] == id)])
\ No newline at end of file
+    print(res.loc[(res['Time'] > time) & (res['Id'] == id_to_int(id))])
\ No newline at end of file
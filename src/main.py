@@ -1,169 +1,981 @@
 from dataset_loader import load_dataset
-from basic_attack import Attack
+from basic_attack import Attack, InvalidAttackError, to_export_frame, EXPORT_FLOAT_FORMAT
 from basic_injection_attack import Basic_injection_attack
 from dos_attack import Dos_attack
 from drop_attack import Drop_attack
 from fuzzy_injection import Fuzzy_injection_attack
 from replay_attack import Replay_attack, Replacement, ReplacementType
 from progressive_injection_attack import Progressive_injection_attack
-from injection_function import calculate_average_interval
+from masquerade_function import masquerade_batch
+from drop_function import drop_function
 from enums.implementation_type import ImplementationType
 from enums.attack_type import AttackType
 from argparse import ArgumentParser
 from pathlib import Path
 from enum import Enum
 from dataset_loader import DEIBVehicle
-from tqdm import tqdm
-import json, os, errno
+from config_loader import load_config
+from profiler import StageProfiler
+from attack_context import AttackContext
+from attack_conflicts import attack_spans, conflict_groups, time_segments
+from checkpoint import Checkpoint, update_digest
+from result_cache import ResultCache, dataset_key, attack_key
+from attack_stats import AttackStats, attack_table_path
+from delta_export import write_delta
+from id_utils import id_to_int
+from concurrent.futures import ProcessPoolExecutor
+import copy, glob, hashlib, inspect, json, multiprocessing, os, errno, random, time, traceback, warnings
+import numpy as np
 import pandas as pd
 
+# Errors of an attack failing validation (InvalidAttackError) or not applicable to the dataset, the attack is skipped.
+#  Any other error is raised
+ATTACK_ERRORS = (ValueError,)
+
+
 class EnsambleAttack(Attack):
-    def __init__(self):
-        super().__init__()
+    profiler = None
+    source = None
+    workers = 1
+    seed = None
+    checkpoint = None
+    resume = False
+    cache = None
+    skipped_attacks = None
+    running_stats = None
+
+    def __init__(self, profiler=None, source=None, context=None, workers=1, seed=None, checkpoint=None, resume=False, cache=None):
+        """
+        Parameters
+        ----------
+        profiler: StageProfiler, optional
+            If given, the time and memory of every single attack are recorded
+
+        source: LazyDataset, optional
+            The original trace on disk (see load_dataset(lazy=True)). If given, it is the original dataset of the
+            statistics and graphs. Replay attacks sniff from the dataset being built all the same
+
+        context: AttackContext, optional
+            Values of the original dataset shared by the attacks (e.g. by all the configurations of a batch on the
+            same dataset). By default a new one is created on the dataset given to build_dataset
+
+        workers: integer, optional
+            The number of processes applying the attacks in parallel. Independent groups of attacks (see
+            attack_conflicts) are split in time segments, every worker gets only the frames of its segment. The result
+            is the same as applying the attacks one at a time
+
+        seed: integer, optional
+            Seed of the random generators, every attack is seeded with seed + its position so that the result does not
+            depend on the order the attacks are applied in. By default it is drawn from numpy's random generator
+
+        checkpoint: Checkpoint, optional
+            Where the dataset built so far is written every checkpoint.every attacks. It is removed once all the
+            attacks are applied. Attacks are then applied one at a time
+
+        resume: bool, optional
+            Continue from the checkpoint, if any, instead of starting from the first attack. The seed of the
+            checkpointed build is used
+
+        cache: ResultCache, optional
+            Where the intermediate results are stored, a build with the same seed starts from the last result stored
+            for the unchanged attacks at the beginning of the configuration. Lazy configurations are read at once.
+            Attacks are then applied one at a time
+        """
+        super().__init__(context=context)
+        assert type(workers) == int and workers > 0
+        self.profiler = profiler if profiler is not None else StageProfiler(enabled=False)
+        self.source = source
+        self.workers = workers
+        self.seed = seed
+        self.checkpoint = checkpoint
+        self.resume = resume
+        self.cache = cache
+        self.skipped_attacks = list()
 
     def build_dataset(self, dataset, attacks):
+        """
+        Apply the attacks in order and return the vulnerable dataset
+
+        Parameters
+        ----------
+        dataset: pandas.Dataframe
+            The original dataset
+
+        attacks: list or iterator of dict
+            The attacks configurations. An iterator (e.g. from a JSON Lines configuration) is consumed lazily, attack by attack.
+            Attacks failing validation or not applicable to the dataset are skipped, and listed in skipped_attacks
+        """
         assert type(dataset) == pd.DataFrame
-        assert type(attacks) == list
 
         if self.original_dataset is None:
-            self.original_dataset = dataset
+            self.original_dataset = self.source if self.source is not None else dataset
+        if self.context is None:
+            self.context = AttackContext(dataset)
+        self.running_stats = AttackStats(dataset)
 
-        id_average_interval = dict()
+        # The values needed by the attacks of configuration lists are computed before starting, for lazy configurations
+        # as they are consumed
+        if type(attacks) == list:
+            with self.profiler.stage('average_intervals'):
+                for attack in attacks:
+                    try:
+                        self.__prepare(attack)
+                    except ATTACK_ERRORS:
+                        # Reported when the attack is applied
+                        pass
 
-        for attack in attacks:
-            if 'parameters' in attack and 'id' in attack['parameters'] and 'implementation_type' in attack['parameters'] and attack['parameters']['implementation_type'] == ImplementationType.INJECTION:
-                if not 'injection_rate' in attack['parameters']:
-                    raise ValueError('Injection rate is needed for INJECTION implementation type')
-                id = attack['parameters']['id']
-                if id not in id_average_interval:
-                    avg = calculate_average_interval(dataset, id)
-                    if avg is not None:
-                        id_average_interval[id] = avg
+        seed = self.seed if self.seed is not None else int(np.random.randint(0, 2**31))
+        cache = self.cache
+        if cache is not None and self.seed is None:
+            warnings.warn('Results are cached only for builds with a given seed')
+            cache = None
+        if self.workers > 1 and (self.checkpoint is not None or cache is not None):
+            warnings.warn('Attacks are applied one at a time when checkpointing or caching the results')
+        elif self.workers > 1 and type(attacks) == list and len(attacks) > 1:
+            with self.profiler.stage('conflicts'):
+                segments = self.__time_segments(dataset, attacks)
+            if len(segments) > 1:
+                with self.profiler.stage('parallel_attacks', n_segments=len(segments)):
+                    self.__build_parallel(dataset, attacks, segments, seed)
+                return self.vulnerable_dataset
 
+        from tqdm import tqdm
+        cursor = 0
+        digest = hashlib.sha256()
+        checkpoint_digest = None
+        keys = None
+        if self.resume and self.checkpoint is not None:
+            if self.checkpoint.exists():
+                state = self.__restore(self.checkpoint)
+                cursor, seed, checkpoint_digest = state['cursor'], state['seed'], state['digest']
+                print('Resuming from attack %d' % cursor)
+            else:
+                warnings.warn('No checkpoint in %s, starting from the first attack' % self.checkpoint.path)
+        if cache is not None:
+            attacks = list(attacks)
+            keys = [dataset_key(dataset)]
+            for i, attack in enumerate(attacks):
+                keys.append(attack_key(keys[-1], attack, (seed + i) % 2**32))
+            # The last stored result, at the end of the configuration or every cache.every attacks
+            for position in [len(attacks)] + list(range(len(attacks) // cache.every * cache.every, cursor, -cache.every)):
+                entry = cache.get(keys[position]) if position > cursor else None
+                if entry is not None:
+                    cursor = self.__restore(entry)['cursor']
+                    print('Reusing the cached result of the first %d attacks' % cursor)
+                    break
         print('Attacks in progress...')
 
-        for i in tqdm(range(len(attacks))):
-            attack = attacks[i]
+        # Consecutive masquerade (or drop) attacks, applied at once before the next attack of another kind or the next
+        # checkpoint
+        pending = list()
+        i = -1
+        for i, attack in enumerate(tqdm(attacks, total=len(attacks) if type(attacks) == list else None)):
+            update_digest(digest, attack)
+            if i < cursor:
+                if i == cursor - 1 and checkpoint_digest is not None and digest.hexdigest() != checkpoint_digest:
+                    raise ValueError('The checkpoint in %s was written for a different configuration' % self.checkpoint.path)
+                continue
+            if len(pending) > 0 and _batch_kind(attack) != _batch_kind(pending[0][1]):
+                self.__apply_pending(dataset, pending, seed)
             dataset = self.vulnerable_dataset if self.vulnerable_dataset is not None else dataset
-            attack_type = AttackType(attack['attack_type'].upper())
-            parameters = attack['parameters']
-            parameters['_id'] = parameters['id']
-            parameters.pop('id', None)
-
-            #  Payload can be either base 2 or base 16 encoded.
-            #  Automatically convert a payload to base 2 if needed
-            if 'payload' in parameters.keys() and parameters['payload'][:2] == '0x':
+            if _batch_kind(attack) is not None:
+                pending.append((i, attack))
+            else:
                 try:
-                    hex_len = len(parameters['payload']) - 2
-                    parameters['payload'] = bin(int(parameters['payload'],16))[2:].zfill(hex_len*4)
-                except ValueError:
+                    self.__prepare(attack)
+                    attack_type = AttackType(attack['attack_type'].upper())
+                    with self.profiler.stage('attack', index=i, name=attack.get('name'), attack_type=attack_type.value, id=attack['parameters'].get('id')):
+                        _seed_attack(seed, i)
+                        attacked_dataset = self.__apply_attack(dataset, attack, i, self.running_stats)
+                except ATTACK_ERRORS as e:
+                    self.skipped_attacks.append(_skipped_attack(i, attack, e))
+                    attacked_dataset = None
+                if attacked_dataset is not None:
+                    self.vulnerable_dataset = attacked_dataset
+            is_checkpoint = self.checkpoint is not None and (i + 1) % self.checkpoint.every == 0
+            is_cached = keys is not None and ((i + 1) % cache.every == 0 or i + 1 == len(attacks))
+            if is_checkpoint or is_cached:
+                self.__apply_pending(dataset, pending, seed)
+            current = self.vulnerable_dataset if self.vulnerable_dataset is not None else dataset
+            if is_checkpoint:
+                self.checkpoint.save(current, self.__state(i + 1, digest, seed), arrays=self.running_stats.to_arrays())
+            if is_cached:
+                cache.put(keys[i + 1], current, self.__state(i + 1, digest, seed), arrays=self.running_stats.to_arrays())
+        self.__apply_pending(self.vulnerable_dataset if self.vulnerable_dataset is not None else dataset, pending, seed)
+
+        if i + 1 < cursor:
+            raise ValueError('The checkpoint in %s was written for a different configuration' % self.checkpoint.path)
+        if self.checkpoint is not None:
+            self.checkpoint.remove()
+        if len(self.skipped_attacks) > 0:
+            print('%d attack(s) skipped' % len(self.skipped_attacks))
+        return self.vulnerable_dataset
+
+    def get_stats(self, verbose=False):
+        if self.running_stats is None:
+            stats = super().get_stats(verbose=verbose)
+        else:
+            # Maintained while applying the attacks, without scanning the vulnerable dataset
+            stats = {'N_applied_attack': self.applied_attack}
+            stats.update(self.running_stats.get_stats(self.original_dataset.shape[0]))
+            if verbose:
+                self.print_stats(stats)
+        stats['Skipped_attacks'] = self.skipped_attacks
+        return stats
+
+    def get_tampered_ids(self):
+        return self.running_stats.tampered_ids() if self.running_stats is not None else super().get_tampered_ids()
+
+    def get_attack_table(self):
+        """
+        Return the table of the applied attacks (see AttackStats.attack_table), with the positions of their frames in
+        the vulnerable dataset
+        """
+        return self.running_stats.attack_table(self.vulnerable_dataset)
+
+    def get_attack_ids(self):
+        """
+        Return the position in the configuration of the attack that last added or changed every frame of the vulnerable
+        dataset, as a categorical series (missing for the frames no attack touched)
+        """
+        labels = self.running_stats.attack_labels(self.vulnerable_dataset)
+        positions = sorted(x['position'] for x in self.running_stats.records)
+        codes = np.searchsorted(positions, labels) if len(positions) > 0 else labels
+        codes[labels < 0] = -1
+        return pd.Series(pd.Categorical.from_codes(codes, categories=positions), index=self.vulnerable_dataset.index)
+
+    def export_dataset(self, path='vulnerable_dataset.csv', verbose=True, attack_ids=False):
+        """
+        Export the vulnerable dataset, and the table of the applied attacks next to it (<path without extension>.attacks.csv)
+
+        Parameters
+        ----------
+        attack_ids: bool, optional
+            Add an AttackId column with the attack that last added or changed every frame (see get_attack_ids)
+        """
+        if self.running_stats is None:
+            return super().export_dataset(path=path, verbose=verbose)
+        self.get_stats(verbose=verbose)
+        print('Exporting..')
+        exported = to_export_frame(self.vulnerable_dataset)
+        if attack_ids:
+            exported['AttackId'] = self.get_attack_ids()
+        exported.to_csv(path, float_format=EXPORT_FLOAT_FORMAT)
+        self.get_attack_table().to_csv(attack_table_path(path), index=False, float_format=EXPORT_FLOAT_FORMAT)
+        print('..Done')
+
+    def export_delta(self, path='vulnerable.delta', base=None, verbose=True):
+        """
+        Export only the frames the attacks inserted, modified and deleted, to be merged onto the base trace by
+        delta_export.read_delta, and the table of the applied attacks next to them
+
+        Parameters
+        ----------
+        base: pandas.Dataframe or LazyDataset, optional
+            The base trace, unchanged. By default the source of the build
+        """
+        base = base if base is not None else self.source
+        if base is None:
+            raise ValueError('A delta is exported against the base trace, which must be given when there is no source')
+        # The changes of every attack lie between the first and last time it changed
+        intervals = None
+        if self.running_stats is not None:
+            intervals = [(x['first_time'], x['last_time']) for x in self.running_stats.records if x['first_time'] is not None]
+        self.get_stats(verbose=verbose)
+        print('Exporting delta..')
+        write_delta(base, self.vulnerable_dataset, path, intervals=intervals)
+        if self.running_stats is not None:
+            self.get_attack_table().to_csv(attack_table_path(path), index=False, float_format=EXPORT_FLOAT_FORMAT)
+        print('..Done')
+
+    def __state(self, cursor, digest, seed):
+        # State of the build after cursor attacks, stored with the dataset in checkpoints and cached results
+        return {'cursor': cursor,
+                'digest': digest.hexdigest(),
+                'seed': seed,
+                'applied_attack': self.applied_attack,
+                'attacked': self.vulnerable_dataset is not None,
+                'skipped_attacks': self.skipped_attacks,
+                'stats': self.running_stats.to_state()}
+
+    def __restore(self, checkpoint):
+        # Restore the build stored in the checkpoint, return its state
+        dataset, state, arrays = checkpoint.load()
+        self.applied_attack = state['applied_attack']
+        self.skipped_attacks = state['skipped_attacks']
+        self.running_stats = AttackStats.from_state(state['stats'], arrays)
+        if state['attacked']:
+            self._vulnerable_dataset = dataset
+        return state
+
+    def __time_segments(self, dataset, attacks):
+        # Time segments of the dataset with the attacks applied on each of them, a single one if the dataset does not
+        # allow to split them
+        times = dataset['Time'].to_numpy()
+        if not dataset.index.equals(pd.RangeIndex(dataset.shape[0])) or np.any(times[1:] < times[:-1]):
+            warnings.warn('Attacks are applied in parallel only on datasets sorted by time with a default index, applying them one at a time')
+            return [(list(range(len(attacks))), None)]
+        attack_objects = list()
+        for attack in attacks:
+            try:
+                attack_objects.append(self.__create_attack(attack))
+            except ATTACK_ERRORS:
+                # Skipped when applied
+                attack_objects.append(None)
+        spans = attack_spans(attack_objects, dataset)
+        groups = conflict_groups(attack_objects, spans)
+        return [(positions, self.__segment_frames(dataset, attack_objects, spans, positions)) for positions, _ in time_segments(groups, spans, self.workers)]
+
+    def __segment_frames(self, dataset, attack_objects, spans, positions):
+        # Positions of the frames needed by the attacks of a segment: the ones in their spans (plus one on each side),
+        # as a list of (start, end) ranges, and the first frame of the dataset and of every attacked id, which the time
+        # deltas and the injected frames refer to
+        times = dataset['Time'].to_numpy()
+        n = times.shape[0]
+        ranges = list()
+        for span in [x for i in positions if spans[i] is not None for x in spans[i]]:
+            start = 0 if span[0] == -np.inf else max(int(np.searchsorted(times, span[0], side='left')) - 1, 0)
+            end = n if span[1] == np.inf else min(int(np.searchsorted(times, span[1], side='right')) + 1, n)
+            ranges.append((start, end))
+        anchors = [0]
+        id_indices = self.context.id_indices()
+        for i in positions:
+            if attack_objects[i] is not None:
+                anchors += [int(id_indices[x][0]) for x in attack_objects[i].get_ids() if x in id_indices]
+        return ranges, anchors
+
+    def __build_parallel(self, dataset, attacks, segments, seed):
+        print('Attacks in progress (%d time segments)...' % len(segments))
+        _parallel.update({'ensamble': self, 'dataset': dataset, 'attacks': attacks, 'seed': seed})
+        try:
+            if 'fork' in multiprocessing.get_all_start_methods():
+                with ProcessPoolExecutor(max_workers=min(self.workers, len(segments)), mp_context=multiprocessing.get_context('fork')) as executor:
+                    results = list(executor.map(_build_segment, segments))
+            else:
+                warnings.warn('Processes cannot be forked on this platform, time segments are built one at a time')
+                results = [_build_segment(segment) for segment in segments]
+        finally:
+            _parallel.clear()
+
+        # Stitch the segments: base frames not dropped by any segment, with the changes of the segment owning them,
+        # and the added frames
+        n = dataset.shape[0]
+        kept = np.ones(n, dtype=bool)
+        kept[np.concatenate([r[1] for r in results])] = False
+        merged = dataset.assign(_source=-1, _seq=np.arange(n))
+        for _, _, changed, _, _, _ in results:
+            for column in dataset.columns:
+                merged.loc[changed['_seq'].to_numpy(dtype=np.int64), column] = changed[column].to_numpy()
+        merged = pd.concat([merged[kept]] + [r[3] for r in results], ignore_index=True)
+
+        # On equal timestamps the base frames come first, then the frames of the attacks in order, as when applying
+        # them one at a time
+        order = np.lexsort((merged['_seq'].to_numpy(), merged['_source'].to_numpy(), merged['Time'].to_numpy()))
+        merged = merged.iloc[order].drop(columns=['_source', '_seq']).reset_index(drop=True)
+        merged = merged.astype(dataset.dtypes.to_dict())
+
+        self.skipped_attacks += sorted((x for r in results for x in r[4]), key=lambda x: x['position'])
+        for r in results:
+            self.running_stats.merge(r[5])
+        applied = sum(r[0] for r in results)
+        if applied > 0:
+            self._vulnerable_dataset = merged
+            self.applied_attack += applied
+
+    def _build_segment(self, dataset, attacks, positions, frames, seed):
+        """
+        Apply the attacks at the given positions, in order, on the frames of the dataset they need (see
+        __segment_frames) and return how the dataset changed: the number of applied attacks, the positions of the
+        dropped frames, the changed frames, the added frames, the skipped attacks and the AttackStats of the changes.
+        Frames carry their origin in the _source (-1 for the dataset, the attack position otherwise) and _seq
+        (position in the dataset, or among the frames added by the attack) columns
+        """
+        ranges, anchors = frames
+        frame_positions = np.unique(np.concatenate([np.asarray(anchors, dtype=np.int64)] + [np.arange(start, end, dtype=np.int64) for start, end in ranges]))
+        current = dataset.iloc[frame_positions].assign(_source=-1, _seq=frame_positions).reset_index(drop=True)
+        applied = 0
+        skipped_attacks = list()
+        stats = AttackStats()
+        for group in _batches(attacks, positions):
+            if len(group) > 1:
+                attacked_dataset, n_applied, skipped = self.__apply_group(current, [(x, attacks[x]) for x in group], seed, stats)
+                skipped_attacks.extend(skipped)
+                if attacked_dataset is not None:
+                    current = attacked_dataset
+                    applied += n_applied
+                continue
+            i = group[0]
+            try:
+                self.__prepare(attacks[i])
+                _seed_attack(seed, i)
+                attacked_dataset = self.__apply_attack(current, attacks[i], i, stats)
+            except ATTACK_ERRORS as e:
+                skipped_attacks.append(_skipped_attack(i, attacks[i], e))
+                continue
+            if attacked_dataset is None:
+                continue
+            added = attacked_dataset['_source'].isna().to_numpy()
+            if added.any():
+                attacked_dataset.loc[added, '_source'] = i
+                attacked_dataset.loc[added, '_seq'] = np.arange(added.sum())
+            current = attacked_dataset
+            applied += 1
+
+        is_base = current['_source'].to_numpy() == -1
+        base_rows = current[is_base]
+        present = base_rows['_seq'].to_numpy(dtype=np.int64)
+        changed = np.zeros(present.shape[0], dtype=bool)
+        for column in dataset.columns:
+            changed |= base_rows[column].to_numpy() != dataset[column].to_numpy()[present]
+        return applied, np.setdiff1d(frame_positions, present), base_rows[changed], current[~is_base], skipped_attacks, stats
+
+    def __apply_pending(self, dataset, pending, seed):
+        # Apply the pending attacks of the sequential build and empty the list
+        if len(pending) == 0:
+            return
+        dataset = self.vulnerable_dataset if self.vulnerable_dataset is not None else dataset
+        position, attack = pending[0]
+        if len(pending) == 1:
+            stage = self.profiler.stage('attack', index=position, name=attack.get('name'), attack_type=attack['attack_type'].upper(), id=attack['parameters'].get('id'))
+        else:
+            stage = self.profiler.stage('attacks', index=position, n_attacks=len(pending), attack_type=_batch_kind(attack))
+        with stage:
+            attacked_dataset, applied, skipped = self.__apply_group(dataset, pending, seed, self.running_stats)
+        self.skipped_attacks.extend(skipped)
+        if attacked_dataset is not None:
+            self._vulnerable_dataset = attacked_dataset
+            self.applied_attack += applied
+        del pending[:]
+
+    def __apply_group(self, dataset, group, seed, stats):
+        # Apply the consecutive masquerade (or drop) attacks of the group, (position, configuration) couples, with a
+        # single masquerade_batch (drop_function) call. Return the dataset (None if no attack was applied), the number
+        # of applied attacks and the skipped ones. Their changes are added to the AttackStats over the union of their
+        # spans
+        if len(group) == 1:
+            return self.__apply_one_by_one(dataset, group, seed, stats)
+        is_drop = _batch_kind(group[0][1]) == AttackType.DROP.value
+        applied, arguments, skipped = list(), list(), list()
+        for position, attack in group:
+            try:
+                self.__prepare(attack)
+                _seed_attack(seed, position)
+                attack_object = self.__create_attack(attack)
+                if attack_object is None:
                     continue
-            
-            if 'payloads' in parameters.keys():
+                arguments.extend([attack_object.get_drop()] if is_drop else attack_object.get_masquerade(dataset))
+            except ATTACK_ERRORS as e:
+                skipped.append(_skipped_attack(position, attack, e))
+                continue
+            applied.append((position, attack, attack_object))
+        if len(applied) == 0:
+            return None, 0, skipped
+
+        window = stats.window(dataset, [x[2] for x in applied])
+        try:
+            attacked_dataset = drop_function(dataset, arguments) if is_drop else masquerade_batch(dataset, arguments)
+        except ATTACK_ERRORS:
+            # A masquerade not applicable to the dataset, which is checked before changing it: the attacks are applied
+            # one at a time to skip only that one
+            return self.__apply_one_by_one(dataset, group, seed, stats)
+        stats.update(window, attacked_dataset, [x[0] for x in applied], [x[1] for x in applied], [x[2] for x in applied])
+        return attacked_dataset, len(applied), skipped
+
+    def __apply_one_by_one(self, dataset, group, seed, stats):
+        # Apply the attacks of the group one at a time, returning as __apply_group
+        attacked_dataset, applied, skipped = None, 0, list()
+        for position, attack in group:
+            try:
+                self.__prepare(attack)
+                _seed_attack(seed, position)
+                result = self.__apply_attack(attacked_dataset if attacked_dataset is not None else dataset, attack, position, stats)
+            except ATTACK_ERRORS as e:
+                skipped.append(_skipped_attack(position, attack, e))
+                continue
+            if result is not None:
+                attacked_dataset = result
+                applied += 1
+        return attacked_dataset, applied, skipped
+
+    def __apply_attack(self, dataset, attack, position, stats):
+        # Return the dataset with the attack at the given position applied, None if the attack has to be skipped.
+        # Its changes are added to the AttackStats
+        attack_object = self.__create_attack(attack)
+        if attack_object is None:
+            return None
+        window = stats.window(dataset, attack_object)
+        attacked_dataset = attack_object.build_dataset(dataset)
+        if attacked_dataset is not None:
+            stats.update(window, attacked_dataset, position, attack, attack_object)
+        return attacked_dataset
+
+    def __create_attack(self, attack):
+        # Return the Attack object of the configuration, None if the attack has to be skipped
+        _check_attack(attack)
+        attack = copy.deepcopy(attack)
+        attack_type = AttackType(attack['attack_type'].upper())
+        parameters = attack['parameters']
+        if 'id' in parameters:
+            parameters['_id'] = parameters.pop('id')
+        parameters['context'] = self.context
+
+        #  Payload can be either base 2 or base 16 encoded.
+        #  Automatically convert a payload to base 2 if needed
+        if 'payload' in parameters.keys() and parameters['payload'][:2] == '0x':
+            try:
+                hex_len = len(parameters['payload']) - 2
+                parameters['payload'] = bin(int(parameters['payload'],16))[2:].zfill(hex_len*4)
+            except ValueError:
+                return None
+        
+        if 'payloads' in parameters.keys():
+            try:
+                hex_len = len(parameters['payloads'][0]) - 2
+                parameters['payloads'] = [(bin(int(x,16))[2:].zfill(hex_len*4) if x[:2] == '0x' else x)for x in  parameters['payloads']]
+
+            except ValueError:
+                return None
+        
+        if attack_type == AttackType.BASIC:
+            parameters['attack_type'] = ImplementationType(_required(parameters, 'implementation_type'))
+            return _new_attack(Basic_injection_attack, parameters)
+
+        elif attack_type == AttackType.DOS:
+            return _new_attack(Dos_attack, parameters)
+
+        elif attack_type == AttackType.DROP:
+            return _new_attack(Drop_attack, parameters)
+
+        elif attack_type == AttackType.FUZZY:
+            parameters['attack_type'] = ImplementationType(_required(parameters, 'implementation_type'))
+            return _new_attack(Fuzzy_injection_attack, parameters)
+        
+        elif attack_type == AttackType.PROGRESSIVE:
+            parameters['attack_type'] = ImplementationType(_required(parameters, 'implementation_type'))
+            return _new_attack(Progressive_injection_attack, parameters)
+
+        elif attack_type == AttackType.REPLAY: 
+            parameters['attack_type'] = ImplementationType(_required(parameters, 'implementation_type'))
+            # Parse replacement dictionary if needed
+            if 'replacements' in parameters:
+                replacements = {}
+                reps = parameters['replacements']
+                for rep in reps:
+                    rep_type = ReplacementType(_required(rep, 'replacement_type'))
+                    if not 'parameters' in rep:
+                        rep['parameters'] = {}
+                    else:
+                        # Convert hex payloads to binary
+                        replacements_parameters = rep['parameters']
+                        if 'payloads' in replacements_parameters:
+                            if type(replacements_parameters['payloads']) == str and replacements_parameters['payloads'][:2] == '0x':
+                                hex_len = len(replacements_parameters['payloads']) - 2
+                                rep['parameters']['payloads'] = bin(int(replacements_parameters['payloads'],16))[2:].zfill(hex_len*4)
+                            elif type(replacements_parameters['payloads']) == list:
+                                hex_len = len(replacements_parameters['payloads'][0]) - 2
+                                rep['parameters']['payloads'] = [(bin(int(x,16))[2:].zfill(hex_len*4) if x[:2] == '0x' else x)for x in replacements_parameters['payloads']]
+                    replacements[(_required(rep, 'start'), _required(rep, 'end'))] = _new_attack(Replacement, dict(rep.get('parameters', {}), replacement_type=rep_type))
+
+                parameters['replacements'] = replacements
+
+            return _new_attack(Replay_attack, parameters)
+
+        else:
+            raise ValueError('Invalid attack type ' + attack_type)
+
+    def __prepare(self, attack):
+        # Validate the attack and compute the values of the context it needs before any attack changes the dataset
+        _check_attack(attack)
+        if 'parameters' in attack and 'id' in attack['parameters'] and 'implementation_type' in attack['parameters'] and attack['parameters']['implementation_type'] == ImplementationType.INJECTION:
+            if not 'injection_rate' in attack['parameters']:
+                raise ValueError('Injection rate is needed for INJECTION implementation type')
+        _warm_attack(self.context, attack)
+
+
+def _check_attack(attack):
+    # Raise an InvalidAttackError if the configuration does not have the fields of an attack
+    if type(attack) != dict:
+        raise InvalidAttackError('An attack must be a dict')
+    if type(attack.get('attack_type')) != str:
+        raise InvalidAttackError('The attack_type of the attack is missing')
+    if type(attack.get('parameters')) != dict:
+        raise InvalidAttackError('The parameters of the attack are missing')
+
+
+def _required(parameters, name):
+    # The value of a required parameter, an InvalidAttackError if it is missing
+    if name not in parameters:
+        raise InvalidAttackError('The parameter %s is missing' % name)
+    return parameters[name]
+
+
+def _new_attack(attack_class, parameters):
+    # Create the attack (or replacement) from its parameters: wrong parameters, or parameters failing the checks of the
+    # constructor, raise an InvalidAttackError
+    try:
+        inspect.signature(attack_class).bind(**parameters)
+    except TypeError as e:
+        raise InvalidAttackError('Invalid parameters for %s: %s' % (attack_class.__name__, e))
+    try:
+        return attack_class(**parameters)
+    except AssertionError as e:
+        raise InvalidAttackError('Invalid parameters for %s%s' % (attack_class.__name__, ': %s' % e if str(e) else '')) from e
+
+
+def _skipped_attack(position, attack, error):
+    # Report an attack that could not be applied, return its record in skipped_attacks
+    name = attack.get('name') if type(attack) == dict else None
+    record = {'position': position, 'name': name, 'error': '%s: %s' % (type(error).__name__, error)}
+    warnings.warn('Attack %d (%s) skipped: %s' % (position, name, record['error']))
+    return record
+
+
+def _batch_kind(attack):
+    # MASQUERADE or DROP for the attacks applied at once with the consecutive ones of the same kind, None otherwise
+    if type(attack) != dict or type(attack.get('attack_type')) != str or type(attack.get('parameters')) != dict:
+        return None
+    attack_type = attack['attack_type'].upper()
+    if attack_type == AttackType.DROP.value:
+        return AttackType.DROP.value
+    if attack_type in (AttackType.BASIC.value, AttackType.FUZZY.value, AttackType.PROGRESSIVE.value) and \
+            attack['parameters'].get('implementation_type') == ImplementationType.MASQUERADE.value:
+        return ImplementationType.MASQUERADE.value
+    return None
+
+
+def _batches(attacks, positions):
+    # The positions split in runs of consecutive masquerade (or drop) attacks, the other attacks alone
+    batches = list()
+    for i in positions:
+        kind = _batch_kind(attacks[i])
+        if kind is not None and len(batches) > 0 and _batch_kind(attacks[batches[-1][-1]]) == kind:
+            batches[-1].append(i)
+        else:
+            batches.append([i])
+    return batches
+
+
+def _seed_attack(seed, position):
+    # Seed the random generators for the attack at the given position of the configuration
+    attack_seed = (seed + position) % 2**32
+    np.random.seed(attack_seed)
+    random.seed(attack_seed)
+
+
+# State of the parallel build, inherited by the forked workers
+_parallel = dict()
+
+
+def _build_segment(segment):
+    positions, frames = segment
+    return _parallel['ensamble']._build_segment(_parallel['dataset'], _parallel['attacks'], positions, frames, _parallel['seed'])
+
+
+def load_source(dataset_field, lazy=True):
+    """
+        Return the dataset referenced by the dataset field of a configuration: a ReCAN vehicle or a csv path. A lazy
+        dataset by default (see load_dataset), a dataframe if lazy is False
+    """
+    try:
+        dataset_name = DEIBVehicle(dataset_field)
+    except ValueError:
+        # When importing from an external dataset, 
+        #  be sure that indexes are sequential starting from 0
+        return load_dataset(path=dataset_field, lazy=lazy)
+    return load_dataset(dataset_name, lazy=lazy)
+
+
+def load_base(dataset_field, lazy=False):
+    """
+        Return the source and the dataframe of the dataset field of a configuration. The attacks work on the whole
+        trace in memory: the source is None unless lazy, then the trace is read through the columnar cache (for a csv
+        written inside ./datasets) and the source is kept for the graphs and the delta export
+    """
+    if not lazy:
+        return None, load_source(dataset_field, lazy=False)
+    source = load_source(dataset_field)
+    return source, source.to_pandas()
+
+
+def find_configs(pattern):
+    """
+        Return the configuration files of a folder (.json and .jsonl files) or matching a glob pattern, sorted
+    """
+    if os.path.isdir(pattern):
+        paths = [os.path.join(pattern, x) for x in os.listdir(pattern)]
+        paths = [x for x in paths if os.path.isfile(x) and os.path.splitext(x)[1].lower() in ('.json', '.jsonl', '.ndjson')]
+    else:
+        paths = glob.glob(pattern)
+    return sorted(paths)
+
+
+def watch_config(path, build, interval=1.0):
+    """
+        Call build() once and then every time the configuration file at path is saved, until interrupted. A failing
+        build is reported and the next save waited for
+    """
+    last_mtime = None
+    try:
+        while True:
+            mtime = os.stat(path).st_mtime if os.path.exists(path) else None
+            if mtime is not None and mtime != last_mtime:
+                last_mtime = mtime
                 try:
-                    hex_len = len(parameters['payloads'][0]) - 2
-                    parameters['payloads'] = [(bin(int(x,16))[2:].zfill(hex_len*4) if x[:2] == '0x' else x)for x in  parameters['payloads']]
+                    build()
+                except Exception:
+                    traceback.print_exc()
+                print('Watching %s for changes (Ctrl+C to stop)..' % path)
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        pass
 
-                except ValueError:
-                    continue
-            
-            if attack_type == AttackType.BASIC:
-                parameters['attack_type'] = ImplementationType(parameters['implementation_type'])
-                bia = Basic_injection_attack(**parameters)
-                dataset = bia.build_dataset(dataset)
-
-            elif attack_type == AttackType.DOS:
-                dos = Dos_attack(**parameters)
-                dataset = dos.build_dataset(dataset)
-
-            elif attack_type == AttackType.DROP:
-                drop = Drop_attack(**parameters)
-                dataset = drop.build_dataset(dataset)
-
-            elif attack_type == AttackType.FUZZY:
-                parameters['attack_type'] = ImplementationType(parameters['implementation_type'])
-                fuz = Fuzzy_injection_attack(**parameters)
-                dataset = fuz.build_dataset(dataset)
-            
-            elif attack_type == AttackType.PROGRESSIVE:
-                parameters['attack_type'] = ImplementationType(parameters['implementation_type'])
-                prog = Progressive_injection_attack(**parameters)          
-                dataset = prog.build_dataset(dataset)
-
-            elif attack_type == AttackType.REPLAY: 
-                parameters['attack_type'] = ImplementationType(parameters['implementation_type'])
-                # Parse replacement dictionary if needed
-                if 'replacements' in parameters:
-                    replacements = {}
-                    reps = parameters['replacements']
-                    for rep in reps:
-                        rep_type = ReplacementType(rep['replacement_type'])
-                        if not 'parameters' in rep:
-                            rep['parameters'] = {}
-                        else:
-                            # Convert hex payloads to binary
-                            replacements_parameters = rep['parameters']
-                            if 'payloads' in replacements_parameters:
-                                if type(replacements_parameters['payloads']) == str and replacements_parameters['payloads'][:2] == '0x':
-                                    hex_len = len(replacements_parameters['payloads']) - 2
-                                    rep['parameters']['payloads'] = bin(int(replacements_parameters['payloads'],16))[2:].zfill(hex_len*4)
-                                elif type(replacements_parameters['payloads']) == list:
-                                    hex_len = len(replacements_parameters['payloads'][0]) - 2
-                                    rep['parameters']['payloads'] = [(bin(int(x,16))[2:].zfill(hex_len*4) if x[:2] == '0x' else x)for x in replacements_parameters['payloads']]
-                        replacements[(rep['start'], rep['end'])] = Replacement(rep_type, **rep['parameters'])
-
-                    parameters['replacements'] = replacements
-                    
-                replay = Replay_attack(**parameters)
-                dataset = replay.build_dataset(dataset)
 
+# State of the batch being built, inherited by the forked workers instead of being pickled for every configuration
+_batch = dict()
+
+
+def _build_variant(config_path, export_path, graphs_path):
+    # Build and export one configuration of the batch on a copy of the shared base dataset
+    _, attacks = load_config(config_path)
+    ea = EnsambleAttack(source=_batch['source'], context=_batch['context'])
+    vulnerable_dataset = ea.build_dataset(_batch['dataset'].copy(), attacks)
+    if vulnerable_dataset is None:
+        warnings.warn('No attack of %s changed the dataset, nothing exported' % config_path)
+        return None
+    if graphs_path is not None:
+        ea.visualize_changes(path=graphs_path, open_browser=False)
+    ea.export_dataset(path=export_path, verbose=False)
+    return export_path
+
+
+def run_batch(config_paths, output_dir, workers=1, graphs=False, profiler=None, lazy=False):
+    """
+    Build and export the vulnerable dataset of every configuration. Configurations are grouped by dataset, every
+    dataset is loaded once and the values shared by the attacks (average intervals, READ signals) are computed once
+    for all the configurations on it
+
+    Parameters
+    ----------
+    config_paths: list(string)
+        The configuration files, every result is exported to output_dir/<configuration name>.csv
+
+    workers: integer, optional
+        The number of worker processes building the configurations of a dataset in parallel. Workers are forked so
+        that they share the loaded dataset, where fork is not available configurations are built one at a time
+
+    graphs: bool, optional
+        Write the graphs of every configuration to output_dir/<configuration name>.html
+
+    lazy: bool, optional
+        Keep the datasets as lazy sources, see load_base
+    """
+    assert type(workers) == int and workers > 0
+    profiler = profiler if profiler is not None else StageProfiler(enabled=False)
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    groups = dict()
+    for config_path in config_paths:
+        dataset_field, _ = load_config(config_path)
+        if dataset_field is None:
+            raise ValueError('No dataset specified in the configuration file %s' % config_path)
+        groups.setdefault(dataset_field, list()).append(config_path)
+
+    if workers > 1 and 'fork' not in multiprocessing.get_all_start_methods():
+        warnings.warn('Processes cannot be forked on this platform, configurations are built one at a time')
+        workers = 1
+
+    exported = list()
+    for dataset_field, paths in groups.items():
+        with profiler.stage('load', dataset=dataset_field):
+            source, dataset = load_base(dataset_field, lazy=lazy)
+        _batch.update({'source': source, 'dataset': dataset, 'context': AttackContext(dataset)})
+        # Warm the shared values before forking, so that every worker inherits them
+        with profiler.stage('context', dataset=dataset_field):
+            _warm_context(paths)
+
+        jobs = list()
+        for path in paths:
+            name = os.path.splitext(os.path.basename(path))[0]
+            jobs.append((path, os.path.join(output_dir, '%s.csv' % name), os.path.join(output_dir, '%s.html' % name) if graphs else None))
+
+        print('Building %d configuration(s) on %s..' % (len(jobs), dataset_field))
+        with profiler.stage('build', dataset=dataset_field, n_configs=len(jobs)):
+            if workers > 1 and len(jobs) > 1:
+                with ProcessPoolExecutor(max_workers=min(workers, len(jobs)), mp_context=multiprocessing.get_context('fork')) as executor:
+                    futures = [executor.submit(_build_variant, *job) for job in jobs]
+                    exported += [future.result() for future in futures]
             else:
-                raise ValueError('Invalid attack type ' + attack_type)
-        
-            self.vulnerable_dataset = dataset
-            
-        return self.vulnerable_dataset
+                exported += [_build_variant(*job) for job in jobs]
+        _batch.clear()
+    return exported
+
+
+def _warm_context(config_paths):
+    for config_path in config_paths:
+        _, attacks = load_config(config_path)
+        for attack in attacks:
+            _warm_attack(_batch['context'], attack)
+
+
+def _warm_attack(context, attack):
+    # Compute the values of the context the attack needs
+    parameters = attack.get('parameters', {})
+    if 'id' not in parameters or context.id_indices().get(id_to_int(parameters['id'])) is None:
+        return
+    if parameters.get('implementation_type') == ImplementationType.INJECTION or attack['attack_type'].upper() == AttackType.DOS.value:
+        context.average_interval(parameters['id'])
+    if attack['attack_type'].upper() == AttackType.FUZZY.value and parameters.get('smart_fuzzying') and 'intervals' not in parameters:
+        context.signals(parameters['id'])
+    if attack['attack_type'].upper() == AttackType.PROGRESSIVE.value and type(parameters.get('waveform')) == dict and 'bits' not in parameters['waveform']:
+        context.signals(parameters['id'])
 
 
 if __name__ == "__main__":
     parser = ArgumentParser(description='A tool to insert attacks into a CAN traffic dataset')
     parser.add_argument('-c', '--config_path', 
                             type=str,
-                            help='The path of the config file')     
+                            help='The path of the config file (.json or .jsonl)')     
     parser.add_argument('-e', '--export_path',
                             type=str,
                             default='vulnerable.csv',
                             help='The path where to export the vulnerable dataset')
+    parser.add_argument('--attack_ids',
+                            action='store_true',
+                            default=False,
+                            help='Add an AttackId column to the exported dataset, with the attack that last changed every frame')
+    parser.add_argument('--delta',
+                            action='store_true',
+                            default=False,
+                            help='Export only the frames changed against the base trace, to <export path without extension>.delta')
     parser.add_argument('--no_graphs', 
                             action='store_true',
                             default=False)
+    parser.add_argument('-b', '--batch',
+                            type=str,
+                            default=None,
+                            help='A folder or a glob pattern of config files to build in batch, instead of a single config')
+    parser.add_argument('-o', '--output_dir',
+                            type=str,
+                            default='vulnerable',
+                            help='The folder where the batch results are exported, one <config name>.csv per config')
+    parser.add_argument('-w', '--workers',
+                            type=int,
+                            default=1,
+                            help='The number of configurations of a batch built in parallel')
+    parser.add_argument('-j', '--jobs',
+                            type=int,
+                            default=1,
+                            help='The number of processes applying independent groups of attacks of a config in parallel')
+    parser.add_argument('--seed',
+                            type=int,
+                            default=None,
+                            help='Seed of the random generators, the same seed gives the same vulnerable dataset')
+    parser.add_argument('--checkpoint',
+                            type=str,
+                            default=None,
+                            help='Folder where the dataset built so far is checkpointed (default <export path>.checkpoint with --resume)')
+    parser.add_argument('--checkpoint_every',
+                            type=int,
+                            default=100,
+                            help='The number of attacks between two checkpoints')
+    parser.add_argument('--resume',
+                            action='store_true',
+                            default=False,
+                            help='Continue the build from the last checkpoint')
+    parser.add_argument('--cache',
+                            type=str,
+                            default=None,
+                            help='Folder where intermediate results are cached, a build with the same --seed reuses the unchanged attacks at the beginning of the config')
+    parser.add_argument('--cache_every',
+                            type=int,
+                            default=20,
+                            help='The number of attacks between two cached results')
+    parser.add_argument('--cache_max_entries',
+                            type=int,
+                            default=100,
+                            help='The number of cached results kept, each a full copy of the dataset on disk (the least recently used are removed)')
+    parser.add_argument('--lazy',
+                            action='store_true',
+                            default=False,
+                            help='Read the dataset through its columnar cache, kept on disk for the graphs (a csv is cached in ./datasets)')
+    parser.add_argument('--watch',
+                            action='store_true',
+                            default=False,
+                            help='Rebuild the config every time it is saved, keeping the dataset in memory')
+    parser.add_argument('--profile',
+                            type=str,
+                            nargs='?',
+                            const='profile.json',
+                            default=None,
+                            help='Record time and memory of every stage and attack into the given report (.json or .csv)')
+    parser.add_argument('--profile_cprofile',
+                            type=str,
+                            default=None,
+                            help='Folder where to dump a cProfile file for every stage, used with --profile')
+    parser.add_argument('--profile_no_memory',
+                            action='store_true',
+                            default=False,
+                            help='Do not trace memory allocations while profiling (faster)')
     args = parser.parse_args()
 
     path = args.config_path
     export_path = args.export_path
     graphs = not args.no_graphs
+    profiler = StageProfiler(enabled=args.profile is not None,
+                                trace_memory=not args.profile_no_memory,
+                                cprofile_dir=args.profile_cprofile)
 
-    if not os.path.isfile(path):
-        raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), path)
-        
-    # Load attacck settings file
-    with open(path) as f:
-        data = json.load(f)
+    if args.batch is not None:
+        config_paths = find_configs(args.batch)
+        if len(config_paths) == 0:
+            raise ValueError('No config file found in %s' % args.batch)
+        exported = run_batch(config_paths, args.output_dir, workers=args.workers, graphs=graphs, profiler=profiler, lazy=args.lazy)
+        print('%d vulnerable dataset(s) exported to %s' % (len([x for x in exported if x is not None]), args.output_dir))
+    else:
+        checkpoint_path = args.checkpoint if args.checkpoint is not None or not args.resume else export_path + '.checkpoint'
+        checkpoint = Checkpoint(checkpoint_path, every=args.checkpoint_every) if checkpoint_path is not None else None
+        cache = ResultCache(args.cache, every=args.cache_every, max_entries=args.cache_max_entries) if args.cache is not None else None
+        # The dataset of the last build, kept in memory when watching the config
+        loaded = dict()
 
-    try:
-        dataset_name = DEIBVehicle(data['dataset'])
-        dataset = load_dataset(dataset_name)
-    except ValueError:
-        # When importing from an external dataset, 
-        #  be sure that indexes are sequential starting from 0
-        dataset_path = data['dataset']
-        dataset = load_dataset(path=dataset_path)
+        def build():
+            # Load attacck settings file, JSON Lines configurations are read lazily
+            dataset_field, attacks = load_config(path)
+            if dataset_field is None:
+                raise ValueError('No dataset specified in the configuration file %s' % path)
+
+            if dataset_field not in loaded:
+                loaded.clear()
+                with profiler.stage('load', dataset=dataset_field):
+                    source, dataset = load_base(dataset_field, lazy=args.lazy)
+                loaded[dataset_field] = (source, dataset, AttackContext(dataset))
+            source, dataset, context = loaded[dataset_field]
+
+            ea = EnsambleAttack(profiler=profiler, source=source, context=context, workers=args.jobs, seed=args.seed,
+                                checkpoint=checkpoint, resume=args.resume, cache=cache)
+            with profiler.stage('build', dataset=dataset_field):
+                # Masquerade attacks change the dataset in place, a watched dataset is kept unchanged for the next builds
+                #  and a dataset without a source is kept as the base of the delta
+                final_dataset = ea.build_dataset(dataset.copy() if args.watch or (args.delta and source is None) else dataset, attacks)
+
+            if graphs:
+                print("Preparing data visualization---")
+                with profiler.stage('visualization'):
+                    ea.visualize_changes(open_browser=not args.watch)
 
-    ea = EnsambleAttack()
-    final_dataset = ea.build_dataset(dataset, data['attacks'])
+            with profiler.stage('export', path=export_path):
+                if args.delta:
+                    ea.export_delta(path=os.path.splitext(export_path)[0] + '.delta', base=source if source is not None else dataset)
+                else:
+                    ea.export_dataset(path=export_path, attack_ids=args.attack_ids)
 
-    if graphs:
-        print("Preparing data visualization---")
-        ea.visualize_changes()
+        if args.watch:
+            watch_config(path, build)
+        else:
+            build()
 
-    ea.export_dataset(path=export_path)
\ No newline at end of file
+    if profiler.enabled:
+        profiler.print_summary()
+        profiler.export(args.profile)
+        print('Profiling report written to %s' % args.profile)
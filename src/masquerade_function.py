@@ -1,8 +1,20 @@
 from dataset_loader import load_dataset
+from id_utils import id_to_int
+from time_utils import seconds_to_ns, ns_to_seconds
+from payload_utils import payloads_to_bits, bits_to_payloads, bits_to_values, values_to_payloads, payloads_to_matrix, MAX_PAYLOAD_BYTES
 import pandas as pd
 import numpy as np
 import warnings
-from tqdm import tqdm
+
+def masquerade_span(id_rows, start, n_of_packets):
+    """
+        Return the (start, end) times in nanoseconds of the frames a masquerade_function of n_of_packets packets
+        beginning at start changes, id_rows being the frames of the id in the dataset
+    """
+    times = id_rows['Time'].to_numpy()
+    times = times[times >= start]
+    end = times[min(n_of_packets, len(times)) - 1] if len(times) > 0 else start
+    return (int(start), int(end))
 
 def masquerade_function(dataset, id, beginning_time_delta, replacements, verbose = True):
     """
@@ -21,100 +33,179 @@ def masquerade_function(dataset, id, beginning_time_delta, replacements, verbose
             The id of the injected packets as an hexadecimal string
 
         injection_time_delta: float
-            The time difference in milliseconds between the timestamp of the first message in the dataset (in seconds from 1st January 1970) and
+            The time difference in seconds between the timestamp of the first message in the dataset (in seconds from 1st January 1970) and
             the beginning of the injection
         
         replacements: dict( couple(int, int) -> list[string]]
-            A dict containing the couple representing bit intervals as key and a list of payloads to replace as value.
+            A dict containing the couple representing bit intervals as key and a list of payloads to replace as value. The payloads
+            may also be given as an (n, end - start) uint8 matrix of 0/1 bits, written without building a string per frame.
+    """
+    return masquerade_batch(dataset, [(id, beginning_time_delta, replacements)], verbose=verbose)
+
+def masquerade_batch(dataset, masquerades, verbose = True):
+    """
+        Return the dataset with many masquerades applied, as applying them in order with masquerade_function. The frames of every id
+        are selected once, the payloads are replaced with integer masks on a copy of the payloads of the id and the dataset is written
+        once at the end, so that many masquerades on the same ids cost about one pass. All the masquerades are validated before
+        changing the dataset.
+
+        Parameters
+        ----------
+        dataset: pandas.Dataframe
+            The original dataset
+
+        masquerades: list(triple(string, float, dict))
+            The id, beginning_time_delta and replacements of every masquerade, as the arguments of masquerade_function
     """
-    # Parameters type assertion
     assert type(dataset) == pd.DataFrame
+    assert type(masquerades) == list
+
+    times = dataset['Time'].to_numpy()
+    initial_timestamp = times[0]
+    interval = times[-1] - initial_timestamp
+    ids = dataset['Id'].to_numpy()
+
+    # Frames of every id: positions in the dataset, times, and the payloads and flags changed so far
+    id_frames = dict()
+    for id, beginning_time_delta, replacements in masquerades:
+        id_value = id_to_int(id)
+        if id_value not in id_frames:
+            positions = np.flatnonzero(ids == id_value)
+            if positions.shape[0] == 0:
+                raise ValueError('No messages with the given id (%s) in the dataset' %id)
+            id_times = times[positions]
+            id_frames[id_value] = {'positions': positions,
+                                    'times': id_times,
+                                    'sorted': bool(np.all(id_times[1:] >= id_times[:-1])),
+                                    'payloads': None,
+                                    'tampered': None,
+                                    'changed': np.zeros(positions.shape[0], dtype=bool)}
+        _check_replacements(replacements)
+        # Check beggining_time_delta parameter
+        if seconds_to_ns(beginning_time_delta) > interval :
+            raise ValueError('Beginning time delta must be lower than the covered period from the dataset (%d)' % ns_to_seconds(interval))
+
+    for id, beginning_time_delta, replacements in masquerades:
+        frames = id_frames[id_to_int(id)]
+        if frames['payloads'] is None:
+            frames['payloads'] = dataset['Payload'].to_numpy()[frames['positions']].copy()
+            frames['tampered'] = dataset['IsTampered'].to_numpy()[frames['positions']].copy()
+
+        # The first n_of_packets frames of the id from the beginning of the attack
+        beginning_ot_attack_timestamp = initial_timestamp + seconds_to_ns(beginning_time_delta)
+        n_of_packets = len(list(replacements.values())[0])
+        if frames['sorted']:
+            first = int(np.searchsorted(frames['times'], beginning_ot_attack_timestamp, side='left'))
+            selected = np.arange(first, min(first + n_of_packets, frames['times'].shape[0]))
+        else:
+            selected = np.flatnonzero(frames['times'] >= beginning_ot_attack_timestamp)[:n_of_packets]
+
+        if np.sum(frames['tampered'][selected]) != 0:
+            warnings.warn('Attacks are overlapping')
+        if selected.shape[0] < n_of_packets:
+            warnings.warn('NOT ENOUGH PACKET, returning original dataset.')
+            continue
+
+        old_payloads = frames['payloads'][selected]
+        new_payloads = _replace(old_payloads, replacements)
+        if np.all(new_payloads == old_payloads):
+            if verbose:
+                from tqdm import tqdm
+                tqdm.write('The attack on id {} was not inserted because it would not change the dataset'.format(id))
+            continue
+        frames['payloads'][selected] = new_payloads
+        frames['tampered'][selected] = 1
+        frames['changed'][selected] = True
+
+    # A single indexed write of all the changed frames
+    changed = [frames for frames in id_frames.values() if frames['changed'].any()]
+    if len(changed) > 0:
+        positions = np.concatenate([frames['positions'][frames['changed']] for frames in changed])
+        dataset.iloc[positions, dataset.columns.get_loc('Payload')] = np.concatenate([frames['payloads'][frames['changed']] for frames in changed])
+        dataset.iloc[positions, dataset.columns.get_loc('IsTampered')] = 1
+
+    return dataset
+
+def _check_replacements(replacements):
+    # Validate the replacements of a masquerade, as masquerade_function describes them
     assert type(replacements) == dict
     assert len(replacements.keys()) > 0
-    if id not in list(set(dataset['Id'].tolist())):
-        raise ValueError('No messages with the given id (%s) in the dataset' %id)
     for bit_range in replacements.keys():
         assert type(bit_range) == tuple
         starting_bit = bit_range[0]
         ending_bit = bit_range[1]
-        assert starting_bit >= 0
-        assert ending_bit <= 64
+        if starting_bit < 0 or ending_bit > MAX_PAYLOAD_BYTES * 8:
+            raise ValueError('Each given bit range must be within the %d bits of a payload' % (MAX_PAYLOAD_BYTES * 8))
         if starting_bit > ending_bit:
             raise ValueError('Starting bit has to be lower than ending bit for each given bit range')
     for payloads in replacements.values():
-        assert type(payloads) == list
-    
-    # Calculate first dataset timestamp and starting timestamp of the attack
-    indexes = dataset.index
-    initial_timestamp = dataset['Time'][indexes[0]]
-    final_timestamp = dataset['Time'][indexes[-1]]
-    interval = final_timestamp - initial_timestamp 
-    
-    # Check beggining_time_delta parameter
-    if beginning_time_delta > interval :
-        raise ValueError('Beginning time delta must be lower than the covered period from the dataset (%d)' % interval)
-    
-    # Some information retriaval
-    beginning_ot_attack_timestamp = initial_timestamp + beginning_time_delta
-    n_of_packets = len(list(replacements.values())[0]) 
-    id_dataset = dataset[dataset['Id'] == id]
-    indices = id_dataset.index
-    can_num = id_dataset['Can#'][indices[0]]
-    dlc = id_dataset['Dlc'][indices[0]]
+        assert type(payloads) == list or type(payloads) == np.ndarray
 
-    for payloads in replacements.values():
-        payload_len = len(payloads[0])
+    for bit_range, payloads in replacements.items():
+        if type(payloads) == np.ndarray:
+            assert payloads.ndim == 2 and payloads.dtype == np.uint8
+            if np.any(payloads > 1):
+                raise ValueError('Payloads must be base 2 encoded')
+            if payloads.shape[1] != bit_range[1] - bit_range[0]:
+                raise ValueError('Provided payloads length (%d) must comply with the payloads section length to replace %s' % ((payloads.shape[1]), str(bit_range)))
+            continue
         for payload in payloads:
             assert type(payload) == str
-            try:
-                int(payload, 2)
-            except ValueError:
-                raise ValueError('Payloads must be base 2 encoded')
-            if len(payload) != payload_len:
-                raise ValueError('All given payloads must have the same length')
-
-    for bit_range in list(replacements.keys()):
-        starting_bit = bit_range[0]
-        ending_bit = bit_range[1]
-        payload_len = len(replacements[bit_range][0])
-        if payload_len != ending_bit - starting_bit:
-            raise ValueError('Provided payloads length (%d) must comply with the payloads section length to replace %s' % ((payload_len), str(bit_range)))
-
-
-    attack_dataset = id_dataset.loc[id_dataset['Time'] >= beginning_ot_attack_timestamp].head(n_of_packets)
-    if sum(attack_dataset['IsTampered']) != 0:
-        warnings.warn('Attacks are overlapping')
-    attack_indexes = attack_dataset.index
-    old_payloads = attack_dataset['Payload'].tolist()
-
-    if len(old_payloads) < n_of_packets:
-        warnings.warn('NOT ENOUGH PACKET, returning original dataset.')
-        return dataset
-
-    # If not all the payloads has to be replaced
-    new_payloads = list()
-    no_change = True
-    for i in range(n_of_packets):
-        new_payload = list(old_payloads[i])
-        for bit_range in replacements.keys():
-            payloads = replacements[bit_range]
-            starting_bit = bit_range[0]
-            ending_bit = bit_range[1]
-            if no_change and new_payload[starting_bit:ending_bit] != list(payloads[i]):
-                no_change = False
-            new_payload[starting_bit:ending_bit] = payloads[i]
-        new_payload = "".join(new_payload)
-        new_payloads.append(new_payload)
-        
-    if no_change:
-        if verbose:
-            tqdm.write('The attack on id {} was not inserted because it would not change the dataset'.format(id))
-        return dataset
-    dataset.loc[attack_indexes, 'Payload'] = new_payloads
-    dataset.loc[attack_indexes, 'IsTampered'] = 1
-
-
-    return dataset    
+        lengths = np.fromiter(map(len, payloads), dtype=np.int64, count=len(payloads))
+        if len(payloads) > 0 and lengths[0] > 0:
+            # Each character becomes a byte, all of them must be 0 or 1
+            characters = np.asarray(payloads, dtype='S%d' % lengths.max()).view(np.uint8)
+            is_binary = np.all((characters == ord('0')) | (characters == ord('1')) | (characters == 0))
+        else:
+            is_binary = len(payloads) == 0
+        if not is_binary or np.any(lengths == 0):
+            raise ValueError('Payloads must be base 2 encoded')
+        if np.any(lengths != lengths[0]):
+            raise ValueError('All given payloads must have the same length')
+        if len(payloads) > 0 and lengths[0] != bit_range[1] - bit_range[0]:
+            raise ValueError('Provided payloads length (%d) must comply with the payloads section length to replace %s' % ((lengths[0]), str(bit_range)))
+
+def _replace(old_payloads, replacements):
+    # Return the payloads with the bit ranges replaced, in order, by the payloads of the replacements
+    n = old_payloads.shape[0]
+    lengths = np.fromiter(map(len, old_payloads), dtype=np.int64, count=n)
+    n_bits = int(lengths[0])
+    ending_bit = max(x[1] for x in replacements.keys())
+    if np.any(lengths != n_bits) or n_bits > 64 or ending_bit > n_bits:
+        if ending_bit <= lengths.min() and np.all(lengths % 8 == 0) and lengths.max() <= MAX_PAYLOAD_BYTES * 8:
+            # CAN FD payloads, or payloads of different lengths all holding the ranges: bits written on the byte matrix
+            matrix = payloads_to_matrix(old_payloads)
+            for (starting_bit, ending_bit), payloads in replacements.items():
+                if ending_bit > starting_bit:
+                    matrix.set_bits(starting_bit, ending_bit, _bits(payloads[:n], ending_bit - starting_bit))
+            return matrix.to_payloads()
+
+        # Ranges past the end of shorter payloads extend them, as slices of lists do
+        replacements = {bit_range: bits_to_payloads(payloads) if type(payloads) == np.ndarray else payloads for bit_range, payloads in replacements.items()}
+        new_payloads = list()
+        for i in range(n):
+            new_payload = list(old_payloads[i])
+            for (starting_bit, ending_bit), payloads in replacements.items():
+                new_payload[starting_bit:ending_bit] = payloads[i]
+            new_payloads.append(''.join(new_payload))
+        return np.array(new_payloads, dtype=object)
+
+    # Payloads as integers: the bits of a range are cleared with a mask and set with an or
+    values = bits_to_values(payloads_to_bits(old_payloads, n_bits=n_bits))
+    for (starting_bit, ending_bit), payloads in replacements.items():
+        width = ending_bit - starting_bit
+        if width == 0:
+            continue
+        shift = np.uint64(n_bits - ending_bit)
+        mask = np.uint64((1 << width) - 1) << shift
+        replacing = bits_to_values(_bits(payloads[:n], width))
+        values = (values & ~mask) | (replacing << shift)
+
+    return values_to_payloads(values, n_bits)
+
+def _bits(payloads, n_bits):
+    # The 0/1 bit matrix of the payloads of a replacement, given as binary strings or already as bits
+    return payloads if type(payloads) == np.ndarray else payloads_to_bits(payloads, n_bits=n_bits)
 
 if __name__ == "__main__":
     dataset = load_dataset()
@@ -126,5 +217,5 @@ if __name__ == "__main__":
     res = masquerade_function(dataset, '1FA', 1000, replacements)
     print(res)
 
-    res = res[(res['Id'] == '1FA') & (res['IsTampered'] == 1)]
+    res = res[(res['Id'] == id_to_int('1FA')) & (res['IsTampered'] == 1)]
     print(res)
\ No newline at end of file
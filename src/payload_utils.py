@@ -0,0 +1,181 @@
+import numpy as np
+
+"""
+    Vectorized helpers for payloads stored as binary strings (e.g. '0110...'), to avoid decoding them one by one in Python
+"""
+
+# CAN FD payloads are up to 64 bytes long, the DLC codes 9 to 15 stand for the lengths 12 to 64
+MAX_PAYLOAD_BYTES = 64
+FD_DATA_LENGTHS = np.array([0, 1, 2, 3, 4, 5, 6, 7, 8, 12, 16, 20, 24, 32, 48, 64], dtype=np.uint8)
+
+
+def payloads_to_bits(payloads, n_bits=None, start=0):
+    """
+    Return the bits of the given payloads as an (n, n_bits) uint8 matrix of 0/1
+
+    Parameters
+    ----------
+    payloads: list, numpy array or pandas Series of strings
+        The payloads as binary strings. Shorter payloads are padded with 0s
+
+    n_bits: integer, optional
+        The number of bits to decode, by default the length of the longest payload
+
+    start: integer, optional
+        The first bit to decode
+    """
+    payloads = np.asarray(payloads, dtype=object)
+    if payloads.shape[0] == 0:
+        return np.zeros((0, n_bits if n_bits is not None else 0), dtype=np.uint8)
+    if n_bits is None:
+        n_bits = max(len(p) for p in payloads) - start
+    # Fixed width bytes: each character becomes one byte, missing ones are \x00
+    raw = payloads.astype('S%d' % (start + n_bits))
+    raw = raw.view(np.uint8).reshape(-1, start + n_bits)[:, start:]
+    return (raw == ord('1')).astype(np.uint8)
+
+
+def bits_to_values(bits):
+    """
+    Return the unsigned integer values (uint64, so at most 64 bits) of the rows of a 0/1 bit matrix, MSB first
+    """
+    n_bits = bits.shape[1]
+    assert n_bits <= 64
+    weights = np.left_shift(np.uint64(1), np.arange(n_bits - 1, -1, -1, dtype=np.uint64))
+    return (bits.astype(np.uint64) * weights).sum(axis=1, dtype=np.uint64)
+
+
+def signal_values(payloads, start_bit, end_bit):
+    """
+    Return the values of the signal in the bit range [start_bit, end_bit) of the given payloads as uint64
+    """
+    return bits_to_values(payloads_to_bits(payloads, n_bits=end_bit - start_bit, start=start_bit))
+
+
+def values_to_payloads(values, n_bits):
+    """
+    Return the unsigned integer values (at most 64 bits) as binary strings of n_bits characters, MSB first, in an object
+    array
+    """
+    assert n_bits <= 64
+    values = np.asarray(values, dtype=np.uint64)
+    if n_bits == 0:
+        return np.full(values.shape[0], '', dtype=object)
+    bits = (values[:, None] >> np.arange(n_bits - 1, -1, -1, dtype=np.uint64)) & np.uint64(1)
+    characters = np.ascontiguousarray(bits.astype(np.uint8) + ord('0'))
+    return characters.view('S%d' % n_bits).ravel().astype(str).astype(object)
+
+
+def bits_to_payloads(bits):
+    """
+    Return the rows of a 0/1 bit matrix as binary strings, MSB first, in an object array
+    """
+    if bits.shape[1] == 0:
+        return np.full(bits.shape[0], '', dtype=object)
+    characters = np.ascontiguousarray(bits.astype(np.uint8) + ord('0'))
+    return characters.view('S%d' % bits.shape[1]).ravel().astype(str).astype(object)
+
+
+def dlc_to_length(dlc):
+    """
+    Return the number of bytes of the payloads of the given DLC codes, 9 to 15 standing for the CAN FD lengths 12 to 64
+    """
+    return FD_DATA_LENGTHS[np.asarray(dlc, dtype=np.int64)]
+
+
+class PayloadMatrix(object):
+    """
+    Payloads of up to MAX_PAYLOAD_BYTES bytes (CAN FD) as an (n, MAX_PAYLOAD_BYTES) uint8 matrix with the number of bytes
+    of every payload, so that bit ranges of many payloads are read and written at once, at any position of the payload.
+
+    It is the working copy of a single attack, built from the payloads it rewrites only: the Payload column of the
+    dataset stays binary strings, the format every attack, the statistics, the caches and the export share, so the
+    frames inserted and dropped by every attack do not have to be mirrored in a matrix of the whole dataset
+    """
+    data = None
+    lengths = None
+
+    def __init__(self, data, lengths):
+        """
+        Parameters
+        ----------
+        data: numpy array
+            The (n, MAX_PAYLOAD_BYTES) uint8 matrix of the bytes of the payloads, the ones after the length are 0
+
+        lengths: numpy array
+            The number of bytes of every payload, as the Dlc column
+        """
+        assert data.dtype == np.uint8 and data.ndim == 2 and data.shape[1] == MAX_PAYLOAD_BYTES
+        assert lengths.shape[0] == data.shape[0]
+        self.data = data
+        self.lengths = lengths.astype(np.uint8)
+
+    def __len__(self):
+        return self.data.shape[0]
+
+    def take(self, rows):
+        """
+        Return the payloads at the given rows, as a new PayloadMatrix
+        """
+        return PayloadMatrix(self.data[rows], self.lengths[rows])
+
+    def get_bits(self, start, end):
+        """
+        Return the bits [start, end) of the payloads as an (n, end - start) uint8 matrix of 0/1
+        """
+        first, last = start // 8, (end + 7) // 8
+        return np.unpackbits(self.data[:, first:last], axis=1)[:, start - first * 8:end - first * 8]
+
+    def set_bits(self, start, end, bits):
+        """
+        Write the (n, end - start) 0/1 matrix of bits in the bits [start, end) of the payloads, the lengths are extended
+        to the bytes written
+        """
+        first, last = start // 8, (end + 7) // 8
+        block = np.unpackbits(self.data[:, first:last], axis=1)
+        block[:, start - first * 8:end - first * 8] = bits
+        self.data[:, first:last] = np.packbits(block, axis=1)
+        self.lengths = np.maximum(self.lengths, last).astype(np.uint8)
+
+    def get_values(self, start, end):
+        """
+        Return the unsigned integer values (uint64, so at most 64 bits) of the bits [start, end) of the payloads
+        """
+        return bits_to_values(self.get_bits(start, end))
+
+    def set_values(self, start, end, values):
+        """
+        Write the unsigned integer values (at most 64 bits) in the bits [start, end) of the payloads
+        """
+        assert end - start <= 64
+        values = np.asarray(values, dtype=np.uint64)
+        self.set_bits(start, end, ((values[:, None] >> np.arange(end - start - 1, -1, -1, dtype=np.uint64)) & np.uint64(1)).astype(np.uint8))
+
+    def to_payloads(self):
+        """
+        Return the payloads as binary strings in an object array, converted at once for every length
+        """
+        payloads = np.empty(len(self), dtype=object)
+        for length in np.unique(self.lengths):
+            rows = np.flatnonzero(self.lengths == length)
+            if length == 0:
+                payloads[rows] = ''
+                continue
+            characters = np.ascontiguousarray(np.unpackbits(self.data[rows, :length], axis=1) + np.uint8(ord('0')))
+            payloads[rows] = characters.view('S%d' % (length * 8)).ravel().astype(str)
+        return payloads
+
+
+def payloads_to_matrix(payloads):
+    """
+    Return the payloads, binary strings of whole bytes up to MAX_PAYLOAD_BYTES long, as a PayloadMatrix
+    """
+    payloads = np.asarray(payloads, dtype=object)
+    lengths = np.fromiter(map(len, payloads), dtype=np.int64, count=payloads.shape[0])
+    if np.any(lengths % 8 != 0) or np.any(lengths > MAX_PAYLOAD_BYTES * 8):
+        raise ValueError('Payloads must be whole bytes, %d at most' % MAX_PAYLOAD_BYTES)
+    data = np.zeros((payloads.shape[0], MAX_PAYLOAD_BYTES), dtype=np.uint8)
+    n_bytes = int(lengths.max()) // 8 if payloads.shape[0] > 0 else 0
+    if n_bytes > 0:
+        data[:, :n_bytes] = np.packbits(payloads_to_bits(payloads, n_bits=n_bytes * 8), axis=1)
+    return PayloadMatrix(data, lengths // 8)
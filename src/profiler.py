@@ -0,0 +1,162 @@
+from contextlib import contextmanager
+import cProfile, csv, json, os, time, tracemalloc
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, peak RSS is not reported there
+    resource = None
+
+"""
+    Per-stage profiler used by main.py --profile
+
+    Every stage records wall time, CPU time, the peak of the memory traced by tracemalloc during the stage and the RSS
+    of the process. Stages can be nested (e.g. the single attacks inside the attacks building), the peak of an outer
+    stage includes the ones of its inner stages.
+"""
+
+
+def _current_rss_mb():
+    # Linux only, None elsewhere
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2**20
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def _max_rss_mb():
+    if resource is None:
+        return None
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+
+
+class StageProfiler(object):
+    enabled = None
+    trace_memory = None
+    cprofile_dir = None
+    records = None
+
+    def __init__(self, enabled=True, trace_memory=True, cprofile_dir=None):
+        """
+        Parameters
+        ----------
+        enabled: bool, optional
+            If False, stages are not measured and nothing is recorded
+
+        trace_memory: bool, optional
+            Trace the allocations with tracemalloc to report the peak memory of every stage. It slows down the run
+
+        cprofile_dir: string, optional
+            If given, a cProfile dump of every stage is written in this folder. The dump of an outer stage does not
+            include its inner stages
+        """
+        assert type(enabled) == bool
+        assert type(trace_memory) == bool
+        self.enabled = enabled
+        self.trace_memory = trace_memory
+        self.cprofile_dir = cprofile_dir
+        self.records = list()
+        self.__stack = list()
+
+        if self.enabled and self.cprofile_dir is not None and not os.path.exists(self.cprofile_dir):
+            os.makedirs(self.cprofile_dir)
+
+    @contextmanager
+    def stage(self, stage, **info):
+        """
+        Measure the wrapped block as a stage. Additional keyword arguments (e.g. the attack name) are stored in the record
+        """
+        if not self.enabled:
+            yield
+            return
+
+        if self.trace_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            current, peak = tracemalloc.get_traced_memory()
+            # Keep the peak reached so far by the outer stage before resetting it
+            if len(self.__stack) > 0:
+                self.__stack[-1]['peak'] = max(self.__stack[-1]['peak'], peak)
+            tracemalloc.reset_peak()
+        else:
+            current = 0
+        frame = {'peak': 0, 'profile': None}
+        if self.cprofile_dir is not None:
+            # Only one cProfile can be active: the outer stage is paused while an inner one runs
+            if len(self.__stack) > 0 and self.__stack[-1]['profile'] is not None:
+                self.__stack[-1]['profile'].disable()
+            frame['profile'] = cProfile.Profile()
+            frame['profile'].enable()
+        self.__stack.append(frame)
+
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - wall_start
+            cpu = time.process_time() - cpu_start
+
+            profile = frame['profile']
+            if profile is not None:
+                profile.disable()
+
+            self.__stack.pop()
+            if profile is not None and len(self.__stack) > 0 and self.__stack[-1]['profile'] is not None:
+                self.__stack[-1]['profile'].enable()
+            peak = 0
+            if self.trace_memory:
+                peak = max(frame['peak'], tracemalloc.get_traced_memory()[1])
+                if len(self.__stack) > 0:
+                    self.__stack[-1]['peak'] = max(self.__stack[-1]['peak'], peak)
+
+            record = {'stage': stage}
+            record.update(info)
+            record['wall_s'] = wall
+            record['cpu_s'] = cpu
+            record['peak_traced_mb'] = peak / 2**20 if self.trace_memory else None
+            record['peak_traced_increase_mb'] = (peak - current) / 2**20 if self.trace_memory else None
+            record['rss_mb'] = _current_rss_mb()
+            record['max_rss_mb'] = _max_rss_mb()
+            self.records.append(record)
+
+            if profile is not None:
+                profile.dump_stats(os.path.join(self.cprofile_dir, '%03d_%s.prof' % (len(self.records), stage)))
+
+    def summary(self):
+        """
+        Return the total wall time, cpu time and number of records for every stage (attacks are grouped by attack type)
+        """
+        summary = dict()
+        for record in self.records:
+            key = record['stage'] if 'attack_type' not in record else '%s:%s' % (record['stage'], record['attack_type'])
+            if key not in summary:
+                summary[key] = {'n': 0, 'wall_s': 0, 'cpu_s': 0}
+            summary[key]['n'] += 1
+            summary[key]['wall_s'] += record['wall_s']
+            summary[key]['cpu_s'] += record['cpu_s']
+        return summary
+
+    def print_summary(self):
+        print('%-30s %8s %12s %12s' % ('Stage', 'N', 'Wall (s)', 'CPU (s)'))
+        for key, values in self.summary().items():
+            print('%-30s %8d %12.3f %12.3f' % (key, values['n'], values['wall_s'], values['cpu_s']))
+
+    def export(self, path):
+        """
+        Write the records to a .csv file, or to a .json file (together with the summary)
+        """
+        assert type(path) == str
+        if path.lower().endswith('.csv'):
+            fields = list()
+            for record in self.records:
+                fields += [k for k in record.keys() if k not in fields]
+            with open(path, 'w', newline='') as f:
+                writer = csv.DictWriter(f, fieldnames=fields)
+                writer.writeheader()
+                writer.writerows(self.records)
+        else:
+            with open(path, 'w') as f:
+                json.dump({'stages': self.records, 'summary': self.summary()}, f, indent=4)
@@ -3,8 +3,12 @@ import numpy as np
 from dataset_loader import load_dataset, ColumnHeader
 from basic_attack import Attack
 from enums.implementation_type import ImplementationType
-from injection_function import inject_function
-from masquerade_function import masquerade_function
+from injection_function import inject_function, injection_span
+from masquerade_function import masquerade_function, masquerade_batch, masquerade_span
+from attack_context import AttackContext
+from id_utils import id_to_int
+from payload_utils import values_to_payloads
+from waveform import check_waveform, waveform_length, waveform_bit_range, waveform_values
 
 class Progressive_injection_attackOLD(Attack):
 
@@ -76,7 +80,7 @@ class Progressive_injection_attackOLD(Attack):
         assert beginning_time_delta >= 0
         assert type(attack_type) == ImplementationType
 
-        dlc = dataset['Dlc'].tolist()[0]
+        dlc = int(dataset['Dlc'].iloc[0])
         if len(payloads[0]) != dlc * 8:
             raise ValueError('Given payloads must fit the original payloads length (%d)' % dlc*8)
 
@@ -109,7 +113,7 @@ class Progressive_injection_attack(Attack):
 
     attack_parameters = dict()
 
-    def __init__(self, _id, payloads, beginning_time_delta, attack_type, **kwargs):
+    def __init__(self, _id, payloads=None, beginning_time_delta=None, attack_type=None, **kwargs):
         """
         Initialize the object with its parameters
 
@@ -118,8 +122,9 @@ class Progressive_injection_attack(Attack):
         id: string
             The id of the injected packets as an hexadecimal string
 
-        payloads: list[string]
-            The payloads of the injected packets as hexadecimal strings, the number of injected packets is defined by the length of the list
+        payloads: list[string], optional
+            The payloads of the injected packets as hexadecimal strings, the number of injected packets is defined by the length of the list.
+            Either the payloads or a waveform are needed
 
         beginning_time_delta: int
             The time difference in seconds between the timestamp of the first message in the dataset (in seconds from 1st January 1970) and
@@ -132,17 +137,31 @@ class Progressive_injection_attack(Attack):
         **kwargs:
             injection_rate: integer
                 The rate of injection of packets with refer to the average packet inter-arrival time of the id, not used for masquerade attacks
+
+            waveform: dict, optional
+                The waveform of a signal of the id (see waveform), the payloads are built from it when the attack is built: the signal is
+                replaced in the masqueraded frames, the other bits of the injected ones are the ones of the last frame of the id before the attack
+
+            context: AttackContext, optional
+                Shared values of the run, the average interval of the id is taken from it when average_interval is not given, and the READ signals
+                of the id when the waveform has no bits
         """
-        super().__init__()
+        super().__init__(context=kwargs.get('context'))
         assert type(_id) == str
-        assert type(payloads) == list
-        for p in payloads:
-            assert type(p) == str
-            assert len(p) == len(payloads[0])
-            try: 
-                int(p, 2)
-            except ValueError:
-                raise ValueError('Payloads must be base 2 encoded')
+        waveform = kwargs.get('waveform')
+        if (payloads is None) == (waveform is None):
+            raise ValueError('Either the payloads or a waveform are needed for progressive attacks')
+        if payloads is not None:
+            assert type(payloads) == list
+            for p in payloads:
+                assert type(p) == str
+                assert len(p) == len(payloads[0])
+                try: 
+                    int(p, 2)
+                except ValueError:
+                    raise ValueError('Payloads must be base 2 encoded')
+        else:
+            check_waveform(waveform)
         assert type(beginning_time_delta) == int
         assert beginning_time_delta >= 0
         assert type(attack_type) == ImplementationType
@@ -151,17 +170,18 @@ class Progressive_injection_attack(Attack):
         self.attack_type = 'PROGRESSIVE'
         self.parameters = dict()
         self.parameters['id'] = _id
-        self.parameters['payloads'] = payloads
+        if payloads is not None:
+            self.parameters['payloads'] = payloads
+        else:
+            self.parameters['waveform'] = waveform
         self.parameters['beginning_time_delta'] = beginning_time_delta
         self.parameters['implementation_type'] = attack_type.value
 
-        dlc = dataset['Dlc'].tolist()[0]
-        if len(payloads[0]) != dlc * 8:
-            raise ValueError('Given payloads must fit the original payloads length (%d)' % dlc*8)
-
         if attack_type == ImplementationType.INJECTION:
             if 'injection_rate' not in kwargs or kwargs['injection_rate'] is None:
                 raise ValueError('Injection rate needed for progressive injection attack')
+            if kwargs['injection_rate'] <= 0:
+                raise ValueError('Injection rate must be positive')
 
             self.parameters['injection_rate'] = kwargs['injection_rate']
 
@@ -179,40 +199,90 @@ class Progressive_injection_attack(Attack):
                                 average_interval = average_interval
         )
 
-    def __with_masquearade(self, dataset, id, payloads, beginning_time_delta):
+    def __masquerades(self, payloads, bit_range=None):
         length = len(payloads[0])
 
         replacements = {
-            (0, length): payloads
+            bit_range if bit_range is not None else (0, length): payloads
         }
 
-        return masquerade_function(dataset, 
-                                    id = id,
-                                    beginning_time_delta = beginning_time_delta,
-                                    replacements=replacements)
-
+        return [(self.parameters['id'], self.parameters['beginning_time_delta'], replacements)]
+
+
+    def __bit_range(self, dataset):
+        # The bits of the signal of the waveform, from the READ signals of the id if not given
+        waveform = self.parameters['waveform']
+        if 'bits' in waveform:
+            return waveform_bit_range(waveform)
+        if self.context is None:
+            self.context = AttackContext(dataset)
+        return waveform_bit_range(waveform, self.context.signals(self.parameters['id']))
+
+    def __waveform_payloads(self, dataset, id_frames, dlc):
+        # The bit range and payloads of the waveform: the values of the signal alone for masquerade attacks, spliced into the last payload
+        # of the id before the attack for injection attacks
+        starting_bit, ending_bit = self.__bit_range(dataset)
+        if ending_bit > dlc * 8:
+            raise ValueError('The waveform signal %s must fit the original payloads length (%d)' % (str((starting_bit, ending_bit)), dlc*8))
+        signal = values_to_payloads(waveform_values(self.parameters['waveform'], ending_bit - starting_bit), ending_bit - starting_bit)
+        if self.parameters['implementation_type'] != ImplementationType.INJECTION:
+            return (starting_bit, ending_bit), signal.tolist()
+
+        start = self.get_start_time(dataset, self.parameters['beginning_time_delta'])
+        before = id_frames.loc[id_frames['Time'] < start, 'Payload']
+        base_payload = before.iloc[-1] if before.shape[0] > 0 else ('0' * dlc * 8)
+        return (0, dlc * 8), (base_payload[:starting_bit] + signal + base_payload[ending_bit:]).tolist()
+
+    def __payloads(self, dataset):
+        # The bit range (None for whole payloads) and the payloads of the attack
+        id_frames = dataset.loc[dataset['Id'] == id_to_int(self.parameters['id']), ['Time', 'Dlc', 'Payload']]
+        dlc = int(id_frames['Dlc'].iloc[0] if id_frames.shape[0] > 0 else dataset['Dlc'].iloc[0])
+        if 'payloads' in self.parameters and len(self.parameters['payloads'][0]) != dlc * 8:
+            raise ValueError('Given payloads must fit the original payloads length (%d)' % (dlc*8))
+
+        if 'payloads' in self.parameters:
+            return None, self.parameters['payloads']
+        return self.__waveform_payloads(dataset, id_frames, dlc)
+
+    def get_masquerade(self, dataset):
+        if self.parameters['implementation_type'] != ImplementationType.MASQUERADE:
+            return None
+        bit_range, payloads = self.__payloads(dataset)
+        return self.__masquerades(payloads, bit_range=bit_range)
 
     def build_dataset(self, dataset):
         assert type(dataset) == pd.DataFrame
-    
+
+        bit_range, payloads = self.__payloads(dataset)
         if self.original_dataset is None:
             self.original_dataset = dataset
 
         if self.parameters['implementation_type'] == ImplementationType.INJECTION:
             self.vulnerable_dataset = self.__with_injection(dataset,
                                                             id = self.parameters['id'],
-                                                            payloads = self.parameters['payloads'],
+                                                            payloads = payloads,
                                                             beginning_time_delta = self.parameters['beginning_time_delta'], 
                                                             injection_rate = self.parameters['injection_rate'],
-                                                            average_interval = self.parameters['average_interval'])
+                                                            average_interval = self.get_average_interval(dataset))
         else:
-            self.vulnerable_dataset = self.__with_masquearade(dataset,
-                                                            id = self.parameters['id'],
-                                                            payloads = self.parameters['payloads'], 
-                                                            beginning_time_delta = self.parameters['beginning_time_delta'])
+            self.vulnerable_dataset = masquerade_batch(dataset, self.__masquerades(payloads, bit_range=bit_range))
 
         return self.vulnerable_dataset
     
+    def get_span(self, dataset):
+        start = self.get_start_time(dataset, self.parameters['beginning_time_delta'])
+        if 'payloads' in self.parameters:
+            n_of_packets = len(self.parameters['payloads'])
+            payload_length = len(self.parameters['payloads'][0])
+        else:
+            n_of_packets = waveform_length(self.parameters['waveform'])
+            id_rows = self.get_id_rows(dataset)
+            payload_length = int(id_rows['Dlc'].iloc[0]) * 8 if id_rows.shape[0] > 0 else 64
+        if self.parameters['implementation_type'] == ImplementationType.INJECTION:
+            return injection_span(self.get_id_rows(dataset), self.parameters['id'], start, n_of_packets,
+                                    self.parameters['injection_rate'], self.get_average_interval(dataset), payload_length=payload_length)
+        return masquerade_span(self.get_id_rows(dataset), start, n_of_packets)
+
     def toJSON(self):
         dict_representation = dict()
         dict_representation['name'] = self.name
@@ -1,9 +1,10 @@
 from enum import Enum
-from tqdm import tqdm
-from pprint import pprint
 import math
 import numpy as np
 import pandas as pd
+from payload_utils import payloads_to_bits
+from id_utils import id_to_hex
+from time_utils import ns_to_seconds
 
 
 class SIGN_TYPE(Enum):
@@ -14,20 +15,14 @@ class SIGN_TYPE(Enum):
 
 
 def __pre_processing(payloads, dlc):
-    bit_flip = [0 for _ in range(dlc * 8)]
-    magnitude = [0 for _ in range(dlc * 8)]
     payload_len = len(payloads)
 
-    for i in range(1, len(payloads)):
-        payload = payloads[i]
-        previous = payloads[i - 1]
-        for j in range(dlc * 8):
-            if payload[j] != previous[j]:
-                bit_flip[j] = bit_flip[j] + 1
+    # Count the flips of every bit between consecutive payloads on the whole bit matrix at once
+    bits = payloads_to_bits(payloads, n_bits=dlc * 8)
+    flips = np.count_nonzero(bits[1:] != bits[:-1], axis=0)
 
-    for i in range(8 * dlc):
-        bit_flip[i] = bit_flip[i] / payload_len
-        magnitude[i] = math.ceil(math.log10(bit_flip[i])) if bit_flip[i] != 0 else float('-inf')
+    bit_flip = [int(x) / payload_len for x in flips]
+    magnitude = [math.ceil(math.log10(x)) if x != 0 else float('-inf') for x in bit_flip]
 
     return bit_flip, magnitude
 
@@ -124,8 +119,8 @@ def export_results(trace, results, export_path=None):
         counter = 0
         for sign in results[row['Id']]:
             new_row = [
-                row['Time'],
-                row['Id'],
+                ns_to_seconds(row['Time']),
+                id_to_hex(row['Id']),
                 sign[0],
                 sign[1],
                 row['Can#'],
@@ -137,6 +132,7 @@ def export_results(trace, results, export_path=None):
             counter += 1
         row_counter += 1
 
+    from pprint import pprint
     print("Building dataframe...")
     df = pd.DataFrame(all_rows,
                       columns=('Time', 'Id', 'StartBit', 'EndBit', 'Can#', 'Datatype', 'Variable', 'Value'))
@@ -153,8 +149,9 @@ def export_results(trace, results, export_path=None):
 
 
 def read(trace, verbose=True, full_result=False):
-    ids = set(trace['Id'].tolist())
-    ids = list(ids)
+    # Split the trace by id in a single pass
+    id_indices = trace.groupby('Id', sort=False).indices
+    ids = list(id_indices.keys())
 
     if verbose:
         print("""
@@ -166,7 +163,7 @@ def read(trace, verbose=True, full_result=False):
 
     subtraces = list()
     for _id in ids:
-        subtrace = trace[trace['Id'] == _id]
+        subtrace = trace.iloc[id_indices[_id]]
         subtraces.append(subtrace)
 
     assert len(subtraces) == len(ids)
@@ -175,6 +172,8 @@ def read(trace, verbose=True, full_result=False):
     bit_flips = dict()
     magnitudes = dict()
 
+    if verbose:
+        from tqdm import tqdm
     for i in (tqdm(range(len(subtraces))) if verbose else range(len(subtraces))):
         subtrace = subtraces[i]
         payloads = subtrace['Payload'].tolist()
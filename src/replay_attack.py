@@ -3,8 +3,11 @@ import numpy as np
 from dataset_loader import load_dataset, ColumnHeader
 from basic_attack import Attack
 from enums.implementation_type import ImplementationType
-from injection_function import inject_function
-from masquerade_function import masquerade_function
+from injection_function import inject_function, injection_span
+from masquerade_function import masquerade_function, masquerade_span
+from id_utils import id_to_int
+from payload_utils import payloads_to_bits, values_to_payloads, payloads_to_matrix, MAX_PAYLOAD_BYTES
+from time_utils import seconds_to_ns
 from enum import Enum
 import random
 import math
@@ -106,6 +109,7 @@ class Replacement:
 class Replay_attack(Attack):
 
     attack_parameters = dict()
+    source = None
 
     def __init__(self, _id, beginning_time_delta, sniffing_time_delta, injected_packets, attack_type, pattern_packets=None, is_random_start=False, **kwargs):
         """
@@ -144,8 +148,16 @@ class Replay_attack(Attack):
             
             replacements: dict(couple(int, int) -> Replacement]
                 A dict containing the couple representing bit intervals as key and a Replacement object for the specified bitrange. Look for Replacement definition for more information.
+
+            source: LazyDataset, optional
+                The original trace on disk. If given, the packets are sniffed from it, reading only the frames of the id in the sniffing window, instead of
+                scanning the dataset in memory. Packets of the original trace are sniffed even if previous attacks tampered or dropped them,
+                so it has to be given explicitly: by default the untampered packets of the dataset being attacked are sniffed.
+
+            context: AttackContext, optional
+                Shared values of the run, the average interval of the id is taken from it when average_interval is not given
         """
-        super().__init__()
+        super().__init__(context=kwargs.get('context'))
         assert type(beginning_time_delta) == int or type(beginning_time_delta) == float
         assert beginning_time_delta >= 0
         assert type(sniffing_time_delta) == int or type(sniffing_time_delta) == float
@@ -165,6 +177,7 @@ class Replay_attack(Attack):
         self.parameters['implementation_type'] = attack_type.value
         self.parameters['is_random_start'] = is_random_start
         self.parameters['replacements'] = kwargs['replacements'] if 'replacements' in kwargs else {}
+        self.source = kwargs['source'] if 'source' in kwargs else None
 
         if pattern_packets is not None:
             assert type(pattern_packets) == int
@@ -184,6 +197,8 @@ class Replay_attack(Attack):
         if attack_type == ImplementationType.INJECTION:
             if 'injection_rate' not in kwargs or kwargs['injection_rate'] is None:
                 raise ValueError('Injection rate needed for fuzzy injection attack')
+            if kwargs['injection_rate'] <= 0:
+                raise ValueError('Injection rate must be positive')
             self.parameters['injection_rate'] = kwargs['injection_rate']
             
             if 'average_interval' not in kwargs or kwargs['average_interval'] is None:
@@ -205,6 +220,12 @@ class Replay_attack(Attack):
                                     beginning_time_delta,
                                     replacements)
 
+    def __id_payloads(self, dataset_id):
+        # All the payloads of the attacked id, read from the source only for the MIN/MAX replacements needing them
+        if dataset_id is None:
+            dataset_id = self.source.filter(ids=[self.parameters['id']], columns=['Payload'])
+        return dataset_id['Payload'].tolist()
+
     def build_dataset(self, dataset):
         """
         Return the original dataset with the addition of the specified number of packets sniffed from the previous traffic at the specified time point, either unchanged of with
@@ -221,10 +242,15 @@ class Replay_attack(Attack):
         
         # Take the payloads from the dataset taking injected_packets packets from the id starting from sniffing_time_delta and before starting the attack
         init_time = dataset['Time'].iloc[0]
-        initial_sniffing = init_time + self.parameters['sniffing_time_delta']
-        final_sniffing = init_time + self.parameters['beginning_time_delta']
-        dataset_id = dataset.loc[(dataset['Id'] == self.parameters['id']) & (dataset['IsTampered'] == 0)]
-        dataset_sniffed_id = dataset_id.loc[(dataset['Time'] > initial_sniffing) & (dataset['Time'] < final_sniffing)]
+        initial_sniffing = init_time + seconds_to_ns(self.parameters['sniffing_time_delta'])
+        final_sniffing = init_time + seconds_to_ns(self.parameters['beginning_time_delta'])
+        if self.source is not None:
+            dataset_id = None
+            dataset_sniffed_id = self.source.filter(time_range=(initial_sniffing, final_sniffing), ids=[self.parameters['id']], columns=['Time', 'Dlc', 'Payload'])
+            dataset_sniffed_id = dataset_sniffed_id.loc[(dataset_sniffed_id['Time'] > initial_sniffing) & (dataset_sniffed_id['Time'] < final_sniffing)]
+        else:
+            dataset_id = dataset.loc[(dataset['Id'] == id_to_int(self.parameters['id'])) & (dataset['IsTampered'] == 0)]
+            dataset_sniffed_id = dataset_id.loc[(dataset['Time'] > initial_sniffing) & (dataset['Time'] < final_sniffing)]
         
         payload_sniffed = dataset_sniffed_id['Payload'].tolist()
 
@@ -254,13 +280,24 @@ class Replay_attack(Attack):
             replacements = self.parameters['replacements']
 
             assert type(replacements) == dict
-            assert all((type(x) == tuple and list(map(type, x)) == [int, int] and x[0] >= 0 and x[1] <= packet_length and x[0] < x[1]) for x in replacements.keys())
+            assert all((type(x) == tuple and list(map(type, x)) == [int, int]) for x in replacements.keys())
+            if not all(0 <= x[0] < x[1] <= packet_length for x in replacements.keys()):
+                raise ValueError('Each replacement must be a [start, end) range within the payloads length (%d)' % packet_length)
             assert all((type(x) == Replacement) for x in replacements.values())
 
+            # The ranges are written at once on the byte matrix of the payloads, unless some range passes the end of a shorter payload
+            lengths = np.fromiter(map(len, payloads), dtype=np.int64, count=len(payloads))
+            matrix = None
+            if np.all(lengths % 8 == 0) and lengths.max() <= MAX_PAYLOAD_BYTES * 8 and max(x[1] for x in replacements.keys()) <= lengths.min():
+                matrix = payloads_to_matrix(payloads)
+
             for interval in replacements.keys():
                 rep = replacements[interval]
                 replacement_type = rep.replacement_type
-                new_payloads = []
+                bits_num = interval[1] - interval[0]
+                # The new bits of the range, as binary strings or as values for ranges up to 64 bits
+                new_payloads = None
+                new_values = None
                 
                 if replacement_type == ReplacementType.PAYLOADS:
                     assert len(rep.payloads) == self.parameters['injected_packets']
@@ -269,16 +306,18 @@ class Replay_attack(Attack):
                 elif replacement_type == ReplacementType.FUZZY:
                     if rep.seed is not None:
                         random.seed(rep.seed)
-                    fuzzy_bits = interval[1] - interval[0]
-                    new_payloads = [(bin(random.getrandbits(fuzzy_bits))[2:].zfill(fuzzy_bits)) for i in range(len(payloads))]
+                    if bits_num <= 64:
+                        new_values = np.array([random.getrandbits(bits_num) for i in range(len(payloads))], dtype=np.uint64)
+                    else:
+                        new_payloads = [(bin(random.getrandbits(bits_num))[2:].zfill(bits_num)) for i in range(len(payloads))]
                 
                 elif replacement_type == ReplacementType.MIN:
-                    payloads_id = dataset_id['Payload'].tolist()
+                    payloads_id = self.__id_payloads(dataset_id)
                     min_value = min(x[interval[0]:interval[1]] for x in payloads_id)
                     new_payloads = [min_value for i in range(len(payloads))]
                 
                 elif replacement_type == ReplacementType.MAX:
-                    payloads_id = dataset_id['Payload'].tolist()
+                    payloads_id = self.__id_payloads(dataset_id)
                     max_value = max(x[interval[0]:interval[1]] for x in payloads_id)
                     new_payloads = [max_value for i in range(len(payloads))]
                 
@@ -289,25 +328,47 @@ class Replay_attack(Attack):
                     bits_num = len(initial_signal_value)
                     assert len(final_signal_value) == bits_num
                     average_change = (int(final_signal_value, 2) - int(initial_signal_value, 2)) / self.parameters['injected_packets']
-                    new_payloads = [bin(round(int(initial_signal_value, 2) + average_change * (i + 1)))[2:].zfill(bits_num) for i in range(len(payloads))]
+                    if bits_num <= 64:
+                        new_values = np.rint(int(initial_signal_value, 2) + average_change * np.arange(1, len(payloads) + 1)).astype(np.uint64)
+                    else:
+                        new_payloads = [bin(round(int(initial_signal_value, 2) + average_change * (i + 1)))[2:].zfill(bits_num) for i in range(len(payloads))]
                 
                 elif replacement_type == ReplacementType.COUNTER:
                     last_payload = payload_sniffed[-1]
                     last_counter_value = last_payload[interval[0]:interval[1]]
                     bits_num = len(last_counter_value)
                     bits_values = int(math.pow(2, bits_num))
-                    if rep.is_counter_decreasing:
+                    if bits_num <= 64:
+                        # uint64 arithmetic wraps around, the mask takes it modulo 2^bits_num
+                        steps = np.arange(1, len(payloads) + 1, dtype=np.uint64)
+                        counter = np.full(len(payloads), int(last_counter_value, 2), dtype=np.uint64)
+                        counter = counter - steps if rep.is_counter_decreasing else counter + steps
+                        new_values = counter & np.uint64((1 << bits_num) - 1)
+                    elif rep.is_counter_decreasing:
                         new_payloads = [bin((int(last_counter_value, 2) - (i + 1)) % bits_values)[2:].zfill(bits_num) for i in range(len(payloads))]
                     else:
                         new_payloads = [bin((int(last_counter_value, 2) + i + 1) % bits_values)[2:].zfill(bits_num) for i in range(len(payloads))]
                 else:
                     raise ValueError('This is not an element of the enum')
 
+                if new_payloads is not None:
+                    assert all(len(x) == interval[1] - interval[0] for x in new_payloads)
+                if matrix is not None:
+                    if new_values is not None:
+                        matrix.set_values(interval[0], interval[1], new_values)
+                    else:
+                        matrix.set_bits(interval[0], interval[1], payloads_to_bits(new_payloads[:len(payloads)], n_bits=bits_num))
+                    continue
+
+                if new_values is not None:
+                    new_payloads = values_to_payloads(new_values, bits_num)
                 for i in range(len(new_payloads)):
                     new_payload = new_payloads[i]
-                    assert len(new_payload) == interval[1] - interval[0]
                     payloads[i] = new_payload.join([payloads[i][:interval[0]], payloads[i][interval[1]:]])
 
+            if matrix is not None:
+                payloads = matrix.to_payloads().tolist()
+
 
         if self.parameters['implementation_type'] == ImplementationType.INJECTION:
             self.vulnerable_dataset = self.__with_injection(dataset,
@@ -315,7 +376,7 @@ class Replay_attack(Attack):
                                                             payloads,
                                                             self.parameters['beginning_time_delta'],
                                                             self.parameters['injection_rate'],
-                                                            self.parameters['average_interval'])
+                                                            self.get_average_interval(dataset))
         else:
             replacements={}
             replacements[(0, packet_length)] = payloads
@@ -327,6 +388,20 @@ class Replay_attack(Attack):
 
         return self.vulnerable_dataset
 
+    def get_span(self, dataset):
+        replacement_types = [x.replacement_type for x in self.parameters['replacements'].values()]
+        if self.source is None and (ReplacementType.MIN in replacement_types or ReplacementType.MAX in replacement_types):
+            # The payloads of the id in the whole dataset are read
+            return None
+        sniffing_start = self.get_start_time(dataset, self.parameters['sniffing_time_delta'])
+        start = self.get_start_time(dataset, self.parameters['beginning_time_delta'])
+        if self.parameters['implementation_type'] == ImplementationType.INJECTION:
+            span = injection_span(self.get_id_rows(dataset), self.parameters['id'], start, self.parameters['injected_packets'],
+                                    self.parameters['injection_rate'], self.get_average_interval(dataset))
+        else:
+            span = masquerade_span(self.get_id_rows(dataset), start, self.parameters['injected_packets'])
+        return (min(span[0], sniffing_start), span[1])
+
     def toJSON(self):
         dict_representation = dict()
 
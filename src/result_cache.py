@@ -0,0 +1,106 @@
+from checkpoint import Checkpoint
+import hashlib, json, os, shutil
+import pandas as pd
+
+"""
+    Content addressed cache of the intermediate results of EnsambleAttack builds.
+
+    The state of a build after an attack is identified by a key hashed from the key of the state before it, the
+    normalized configuration of the attack and its seed, the first key being a hash of the base dataset and of the code
+    of the attacks (see code_version), so results of another version of the attacks are never reused. States are
+    stored every few attacks as checkpoints (see checkpoint) named by their key, so a build of an edited configuration
+    starts from the last state stored before the first changed attack. Every state is a full copy of the dataset.
+"""
+
+# Changed when the format of the stored states changes
+CACHE_FORMAT = 1
+SOURCE_PATH = os.path.dirname(os.path.abspath(__file__))
+
+
+class ResultCache(object):
+    path = None
+    every = 20
+    max_entries = 100
+
+    def __init__(self, path, every=20, max_entries=100):
+        """
+        Parameters
+        ----------
+        path: string
+            The folder of the cache
+
+        every: integer, optional
+            The state of a build is stored every this many attacks, and at its end
+
+        max_entries: integer, optional
+            The least recently used states are removed beyond this number
+        """
+        assert type(path) == str
+        assert type(every) == int and every > 0
+        assert type(max_entries) == int and max_entries > 0
+        self.path = path
+        self.every = every
+        self.max_entries = max_entries
+
+    def entry(self, key):
+        return Checkpoint(os.path.join(self.path, key))
+
+    def get(self, key):
+        """
+        Return the checkpoint of the state with the given key, None if it is not cached
+        """
+        entry = self.entry(key)
+        if not entry.exists():
+            return None
+        os.utime(entry.path)
+        return entry
+
+    def put(self, key, dataset, state, arrays=None):
+        """
+        Store the dataset, the state and the arrays (see Checkpoint.save) with the given key
+        """
+        self.entry(key).save(dataset, state, arrays=arrays)
+        self.__evict()
+
+    def __evict(self):
+        entries = [os.path.join(self.path, x) for x in os.listdir(self.path) if not x.endswith('.tmp')]
+        entries.sort(key=os.path.getmtime)
+        for path in entries[:max(len(entries) - self.max_entries, 0)]:
+            shutil.rmtree(path)
+
+
+def code_version():
+    """
+    Return a hash of the cache format and of the source of the attacks (the modules of the source folder), any change
+    of the code giving new keys
+    """
+    digest = hashlib.sha256(str(CACHE_FORMAT).encode())
+    for folder in (SOURCE_PATH, os.path.join(SOURCE_PATH, 'enums')):
+        for name in sorted(x for x in os.listdir(folder) if x.endswith('.py')):
+            digest.update(name.encode())
+            with open(os.path.join(folder, name), 'rb') as f:
+                digest.update(hashlib.sha256(f.read()).digest())
+    return digest.hexdigest()
+
+
+def dataset_key(dataset):
+    """
+    Return the key of a dataset, hashed from its content and the version of the code (see code_version)
+    """
+    assert type(dataset) == pd.DataFrame
+    digest = hashlib.sha256(code_version().encode())
+    digest.update(json.dumps(list(dataset.columns)).encode())
+    digest.update(pd.util.hash_pandas_object(dataset, index=True).to_numpy().tobytes())
+    return digest.hexdigest()
+
+
+def attack_key(previous_key, attack, seed):
+    """
+    Return the key of the state after applying the attack (a configuration dict) with the given seed on the state
+    previous_key. The name of the attack does not change its result and is left out
+    """
+    normalized = {x: y for x, y in attack.items() if x != 'name'} if type(attack) == dict else attack
+    if type(normalized) == dict and type(normalized.get('attack_type')) == str:
+        normalized['attack_type'] = normalized['attack_type'].upper()
+    content = json.dumps([previous_key, normalized, seed], sort_keys=True, default=str)
+    return hashlib.sha256(content.encode()).hexdigest()
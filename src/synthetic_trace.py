@@ -0,0 +1,165 @@
+from argparse import ArgumentParser
+from utils import Logger
+from id_utils import ids_to_hex, ID_DTYPE
+from time_utils import timestamps_to_ns, ns_to_seconds
+import pandas as pd
+import numpy as np
+
+"""
+    Offline generator of synthetic CAN traces with the same layout returned by load_dataset.
+
+    Every id is periodic (with jitter) and its payload is made of the kind of signals READ looks for: a rolling counter,
+    physical values (slow random walks and sinusoids), rarely changing binary flags and a trailing CRC-8 byte.
+"""
+
+# Typical periods (seconds) of the periodic ids on a vehicle bus
+PERIODS = [0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0]
+PERIODS_PROBABILITIES = [0.25, 0.25, 0.15, 0.15, 0.1, 0.05, 0.05]
+DLCS = [8, 8, 8, 8, 6, 4, 2]
+
+CRC8_POLY = 0x1D
+CRC8_TABLE = np.zeros(256, dtype=np.uint8)
+for _byte in range(256):
+    _crc = _byte
+    for _ in range(8):
+        _crc = ((_crc << 1) ^ CRC8_POLY) & 0xFF if _crc & 0x80 else (_crc << 1) & 0xFF
+    CRC8_TABLE[_byte] = _crc
+
+
+def _physical_signal(rng, n, n_bits):
+    # Either a bounded random walk or a sinusoid quantized to n_bits, changing of about one LSB between frames
+    max_value = 2 ** n_bits - 1
+    if rng.random() < 0.5:
+        signal = np.cumsum(rng.normal(0, 0.7, n))
+        signal = signal - signal.min()
+        if signal.max() > 0.8 * max_value:
+            signal = signal * 0.8 * max_value / signal.max()
+        signal = signal + 0.1 * max_value
+    else:
+        period = 2 * np.pi * 0.4 * max_value * rng.uniform(0.5, 2)
+        signal = max_value * (0.5 + 0.4 * np.sin(np.arange(n) * 2 * np.pi / period + rng.uniform(0, 2 * np.pi)))
+    return np.clip(np.round(signal), 0, max_value).astype(np.uint64)
+
+
+def _id_payloads(rng, n, dlc):
+    """
+        Return an (n, dlc) uint8 matrix of payloads: counter in the first byte high nibble, physical values and flags
+        in the middle, CRC-8 of the previous bytes in the last byte
+    """
+    n_bits = dlc * 8
+    value = np.zeros(n, dtype=np.uint64)
+
+    # 4 bits counter at the beginning of the payload
+    counter = (np.arange(n, dtype=np.uint64) + np.uint64(rng.integers(0, 16))) % np.uint64(16)
+    value |= counter << np.uint64(n_bits - 4)
+    position = 4
+    last_bit = n_bits - 8 if dlc > 1 else n_bits
+
+    while position < last_bit:
+        remaining = last_bit - position
+        if remaining <= 2 or rng.random() < 0.2:
+            # Binary flag changing rarely
+            width = 1
+            changes = rng.random(n) < 0.0005
+            signal = (np.cumsum(changes) % 2).astype(np.uint64)
+        else:
+            width = int(min(remaining, rng.choice([4, 8, 10, 12, 16])))
+            signal = _physical_signal(rng, n, width)
+        value |= signal << np.uint64(n_bits - position - width)
+        position += width
+
+    payloads = np.zeros((n, dlc), dtype=np.uint8)
+    for byte in range(dlc):
+        payloads[:, byte] = ((value >> np.uint64(8 * (dlc - byte - 1))) & np.uint64(0xFF)).astype(np.uint8)
+
+    if dlc > 1:
+        crc = np.zeros(n, dtype=np.uint8)
+        for byte in range(dlc - 1):
+            crc = CRC8_TABLE[crc ^ payloads[:, byte]]
+        payloads[:, dlc - 1] = crc
+    return payloads
+
+
+def _to_binary_strings(payloads):
+    # (n, dlc) uint8 matrix -> array of binary strings of dlc * 8 characters
+    n_bits = payloads.shape[1] * 8
+    bits = np.unpackbits(payloads, axis=1) + np.uint8(ord('0'))
+    return np.ascontiguousarray(bits).view('S%d' % n_bits).ravel().astype('U%d' % n_bits).astype(object)
+
+
+def generate_trace(n_frames=1000000, n_ids=60, seed=42, start_time=1600000000.0, can_num=0, add_tampered_column=True, verbose=True):
+    """
+    Return a synthetic CAN trace as a pandas dataframe with the same columns returned by load_dataset
+
+    Parameters
+    ----------
+    n_frames: integer, optional
+        The approximate number of frames of the trace
+
+    n_ids: integer, optional
+        The number of periodic ids
+
+    seed: integer, optional
+        Seed of the random generator, the same seed always returns the same trace
+
+    start_time: float, optional
+        The timestamp of the beginning of the trace (seconds from 1st January 1970)
+    """
+    assert type(n_frames) == int and n_frames > 0
+    assert type(n_ids) == int and 0 < n_ids <= 0x7FF
+    logger = Logger(verbose=verbose)
+    rng = np.random.default_rng(seed)
+
+    ids = np.sort(rng.choice(np.arange(0x010, 0x800), size=n_ids, replace=False)).astype(ID_DTYPE)
+    periods = rng.choice(PERIODS, size=n_ids, p=PERIODS_PROBABILITIES)
+    dlcs = rng.choice(DLCS, size=n_ids)
+
+    # Duration needed to have about n_frames frames overall
+    duration = n_frames / np.sum(1 / periods)
+
+    logger.print('Generating %d ids over %.1fs..' % (n_ids, duration))
+    times = list()
+    id_indices = list()
+    payloads = list()
+    for i in range(n_ids):
+        n = max(int(duration / periods[i]), 2)
+        jitter = rng.normal(0, periods[i] * 0.01, n)
+        times.append(start_time + rng.uniform(0, periods[i]) + np.arange(n) * periods[i] + jitter)
+        id_indices.append(np.full(n, i, dtype=np.int32))
+        payloads.append(_to_binary_strings(_id_payloads(rng, n, int(dlcs[i]))))
+
+    times = np.concatenate(times)
+    order = np.argsort(times, kind='stable')
+    id_indices = np.concatenate(id_indices)[order]
+
+    trace = pd.DataFrame({
+        'Time': timestamps_to_ns(times[order]),
+        'Can#': np.full(id_indices.shape[0], can_num, dtype=np.uint8),
+        'Id': ids[id_indices],
+        'Dlc': dlcs[id_indices].astype(np.uint8),
+        'Payload': np.concatenate(payloads)[order]
+    })
+    if add_tampered_column:
+        trace['IsTampered'] = np.zeros(trace.shape[0], dtype=np.uint8)
+    logger.print('..done (%d frames)' % trace.shape[0])
+    return trace
+
+
+def export_trace(trace, path):
+    """
+        Write the trace in the raw csv format read by load_dataset(path=...)
+    """
+    trace = trace[['Time', 'Can#', 'Id', 'Dlc', 'Payload']].assign(Id=ids_to_hex(trace['Id']), Time=ns_to_seconds(trace['Time'].to_numpy()))
+    trace.to_csv(path, header=False, index=False, float_format='%.6f')
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description='Generate a synthetic CAN trace')
+    parser.add_argument('-n', '--n_frames', type=int, default=1000000, help='Approximate number of frames')
+    parser.add_argument('--n_ids', type=int, default=60, help='Number of periodic ids')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('-o', '--output', type=str, default='synthetic.csv', help='Path of the generated csv')
+    args = parser.parse_args()
+
+    trace = generate_trace(n_frames=args.n_frames, n_ids=args.n_ids, seed=args.seed)
+    export_trace(trace, args.output)
@@ -0,0 +1,41 @@
+import numpy as np
+
+"""
+    Timestamps are stored in the datasets as int64 nanoseconds from 1st January 1970, so that inter-arrival times and
+    frame durations are compared exactly. Time deltas and durations in the attack parameters stay in seconds and are
+    converted with these helpers.
+"""
+
+TIME_DTYPE = np.int64
+NS_PER_SECOND = 1000000000
+# Raw traces are written with microsecond resolution
+RAW_TIME_RESOLUTION_NS = 1000
+
+
+def seconds_to_ns(seconds):
+    """
+    Return a time delta (or an array of them) in seconds as integer nanoseconds
+    """
+    if np.ndim(seconds) == 0:
+        return int(round(seconds * NS_PER_SECOND))
+    return np.round(np.asarray(seconds, dtype=np.float64) * NS_PER_SECOND).astype(TIME_DTYPE)
+
+
+def ns_to_seconds(ns):
+    """
+    Return a time (or an array of them) in nanoseconds as float seconds
+    """
+    if np.ndim(ns) == 0:
+        return ns / NS_PER_SECOND
+    return np.asarray(ns) / NS_PER_SECOND
+
+
+def timestamps_to_ns(seconds, resolution_ns=RAW_TIME_RESOLUTION_NS):
+    """
+    Return float timestamps in seconds from 1st January 1970 as int64 nanoseconds
+
+    Float seconds cannot hold nanoseconds at today's timestamps, so they are rounded to resolution_ns: the float
+    parsed from a raw timestamp with microsecond resolution is converted back exactly
+    """
+    steps = np.round(np.asarray(seconds, dtype=np.float64) * (NS_PER_SECOND / resolution_ns))
+    return steps.astype(TIME_DTYPE) * resolution_ns
@@ -0,0 +1,221 @@
+from attack_stats import match_frames
+from dataset_cache import LazyDataset
+from dataset_loader import read_csv_chunks
+from payload_utils import payloads_to_bits
+from id_utils import id_to_hex
+from argparse import ArgumentParser
+import json, os
+import numpy as np
+import pandas as pd
+
+"""
+    Diff of two traces sorted by time, e.g. an original trace and a vulnerable dataset built from it.
+
+    Both traces are read in chunks and aligned in a single pass: the frames before the last time read in both are
+    matched by (Time, Id, Can#) (see attack_stats.match_frames), the unmatched frames of the original trace are removed,
+    the unmatched ones of the other trace inserted, the matched ones with a different dlc or payload modified, with the
+    bits of the payload that changed. Traces larger than memory are compared reading them from disk (a columnar cache
+    folder or a csv file) chunk by chunk.
+"""
+
+CHUNK_ROWS = 1 << 20
+INSERTED = 'inserted'
+REMOVED = 'removed'
+MODIFIED = 'modified'
+DIFF_COLUMNS = ['Change', 'OriginalRow', 'Row', 'Time', 'Can#', 'Id', 'Dlc', 'Payload', 'OriginalDlc', 'OriginalPayload',
+                'ChangedBits', 'BitMask']
+FRAME_COLUMNS = ['Time', 'Can#', 'Id', 'Dlc', 'Payload']
+
+
+def diff_traces(original, vulnerable, chunk_rows=CHUNK_ROWS):
+    """
+    Yield the differences of the vulnerable trace from the original one in chunks, as dataframes sorted by time with
+    columns:
+        - Change: INSERTED, REMOVED or MODIFIED
+        - OriginalRow, Row: the positions of the frame in the original and in the vulnerable trace (missing for
+          inserted and removed frames)
+        - Time, Can#, Id, Dlc, Payload: the frame, as in the original trace for the removed ones
+        - OriginalDlc, OriginalPayload: the frame in the original trace, for the modified ones
+        - ChangedBits, BitMask: the number of changed bits of the payload and a binary string with a 1 for each of
+          them, for the modified ones
+
+    Parameters
+    ----------
+    original, vulnerable: pandas.Dataframe, LazyDataset, string or iterable of pandas.Dataframe
+        The traces, sorted by time. A string is the path of a columnar cache folder or of a csv (see
+        dataset_loader.read_csv_chunks), an iterable yields the consecutive chunks of a trace (e.g. delta_export.read_delta)
+
+    chunk_rows: integer, optional
+        The number of frames read at a time from every trace
+    """
+    assert type(chunk_rows) == int and chunk_rows > 0
+    streams = [_Stream(original, chunk_rows), _Stream(vulnerable, chunk_rows)]
+    while True:
+        for stream in streams:
+            stream.fill()
+        if all(stream.exhausted and stream.is_empty() for stream in streams):
+            return
+
+        # The frames before the cut are all read in both traces
+        open_streams = [stream for stream in streams if not stream.exhausted]
+        cut = min(stream.last_time() for stream in open_streams) if len(open_streams) > 0 else None
+        (before, before_rows), (after, after_rows) = [stream.take(cut) for stream in streams]
+        if before.shape[0] == 0 and after.shape[0] == 0:
+            # Only frames at the cut time are buffered
+            for stream in open_streams:
+                if stream.last_time() == cut:
+                    stream.pull()
+            continue
+
+        changes = _diff_frames(before, before_rows, after, after_rows)
+        if changes.shape[0] > 0:
+            yield changes
+
+
+def diff_stats(changes):
+    """
+    Return the number of inserted, removed and modified frames, of changed payload bits and the ids of the changed
+    frames of the differences yielded by diff_traces
+    """
+    stats = {'N_inserted_rows': 0, 'N_removed_rows': 0, 'N_modified_rows': 0, 'N_changed_bits': 0}
+    ids = set()
+    for chunk in changes:
+        kinds = chunk['Change'].to_numpy()
+        stats['N_inserted_rows'] += int(np.sum(kinds == INSERTED))
+        stats['N_removed_rows'] += int(np.sum(kinds == REMOVED))
+        stats['N_modified_rows'] += int(np.sum(kinds == MODIFIED))
+        stats['N_changed_bits'] += int(chunk['ChangedBits'].sum())
+        ids.update(np.unique(chunk['Id'].to_numpy()).tolist())
+    stats['Changed_ids'] = [id_to_hex(x) for x in sorted(ids)]
+    return stats
+
+
+class _Stream(object):
+    # Frames of a trace read chunk by chunk, with their positions in the trace
+
+    def __init__(self, trace, chunk_rows):
+        self.chunks = iter(_chunks(trace, chunk_rows))
+        self.frames = None
+        self.rows = np.zeros(0, dtype=np.int64)
+        self.n_read = 0
+        self.exhausted = False
+        self.previous_time = None
+
+    def is_empty(self):
+        return self.frames is None or self.frames.shape[0] == 0
+
+    def last_time(self):
+        return int(self.frames['Time'].iat[-1])
+
+    def fill(self):
+        while self.is_empty() and not self.exhausted:
+            self.pull()
+
+    def pull(self):
+        chunk = next(self.chunks, None)
+        if chunk is None:
+            self.exhausted = True
+            return
+        chunk = chunk[[x for x in FRAME_COLUMNS if x in chunk.columns]].reset_index(drop=True)
+        times = chunk['Time'].to_numpy()
+        if np.any(times[1:] < times[:-1]) or (self.previous_time is not None and times.shape[0] > 0 and times[0] < self.previous_time):
+            raise ValueError('The traces to diff must be sorted by time')
+        if times.shape[0] > 0:
+            self.previous_time = times[-1]
+        rows = np.arange(self.n_read, self.n_read + chunk.shape[0])
+        self.n_read += chunk.shape[0]
+        self.frames = chunk if self.is_empty() else pd.concat([self.frames, chunk], ignore_index=True)
+        self.rows = np.concatenate([self.rows, rows])
+
+    def take(self, cut):
+        # Remove and return the frames before the cut time (all of them if it is None), with their positions
+        if self.is_empty():
+            return pd.DataFrame(columns=FRAME_COLUMNS), np.zeros(0, dtype=np.int64)
+        end = self.frames.shape[0] if cut is None else int(np.searchsorted(self.frames['Time'].to_numpy(), cut, side='left'))
+        frames, rows = self.frames.iloc[:end], self.rows[:end]
+        self.frames, self.rows = self.frames.iloc[end:].reset_index(drop=True), self.rows[end:]
+        return frames.reset_index(drop=True), rows
+
+
+def _chunks(trace, chunk_rows):
+    # The consecutive chunks of a trace given as in diff_traces
+    if type(trace) == str:
+        trace = LazyDataset(trace) if os.path.isdir(trace) else read_csv_chunks(trace, chunk_rows)
+    if type(trace) == pd.DataFrame:
+        return (trace.iloc[x:x + chunk_rows] for x in range(0, trace.shape[0], chunk_rows))
+    if type(trace) == LazyDataset:
+        return (trace.rows(x, x + chunk_rows) for x in range(0, len(trace), chunk_rows))
+    return trace
+
+
+def _diff_frames(before, before_rows, after, after_rows):
+    # The differences of the frames of after from the ones of before, as in diff_traces
+    matched_before, matched_after, removed, inserted = match_frames(before, after)
+    changed = before['Dlc'].to_numpy()[matched_before] != after['Dlc'].to_numpy()[matched_after]
+    changed |= before['Payload'].to_numpy()[matched_before] != after['Payload'].to_numpy()[matched_after]
+    matched_before, matched_after = matched_before[changed], matched_after[changed]
+    if removed.shape[0] == 0 and inserted.shape[0] == 0 and matched_before.shape[0] == 0:
+        return pd.DataFrame(columns=DIFF_COLUMNS)
+
+    before_payloads = before['Payload'].to_numpy()[matched_before]
+    after_payloads = after['Payload'].to_numpy()[matched_after]
+    n_bits = max([len(x) for x in before_payloads] + [len(x) for x in after_payloads] + [1])
+    changed_bits = payloads_to_bits(before_payloads, n_bits=n_bits) != payloads_to_bits(after_payloads, n_bits=n_bits)
+    # 0/1 characters of the changed bits, as long as the longest of the two payloads of every frame
+    masks = np.ascontiguousarray((changed_bits.astype(np.uint8) + ord('0'))).view('S%d' % n_bits).ravel().astype(str)
+    lengths = np.maximum([len(x) for x in before_payloads], [len(x) for x in after_payloads]) if matched_before.shape[0] > 0 else []
+    masks = np.array([mask[:length] for mask, length in zip(masks, lengths)], dtype=object)
+
+    parts = [_changes(REMOVED, before.iloc[removed], original_rows=before_rows[removed]),
+             _changes(INSERTED, after.iloc[inserted], rows=after_rows[inserted]),
+             _changes(MODIFIED, after.iloc[matched_after], original_rows=before_rows[matched_before],
+                      rows=after_rows[matched_after], original=before.iloc[matched_before],
+                      changed_bits=changed_bits.sum(axis=1), masks=masks)]
+    changes = pd.concat(parts, ignore_index=True)
+    order = np.lexsort((changes['Row'].fillna(-1).to_numpy(), changes['Time'].to_numpy()))
+    return changes.iloc[order].reset_index(drop=True)
+
+
+def _changes(change, frames, original_rows=None, rows=None, original=None, changed_bits=None, masks=None):
+    n = frames.shape[0]
+    changes = pd.DataFrame({'Change': np.full(n, change, dtype=object),
+                            'OriginalRow': pd.array(original_rows if original_rows is not None else np.full(n, None), dtype='Int64'),
+                            'Row': pd.array(rows if rows is not None else np.full(n, None), dtype='Int64')})
+    for column in FRAME_COLUMNS:
+        changes[column] = frames[column].to_numpy()
+    changes['OriginalDlc'] = original['Dlc'].to_numpy() if original is not None else pd.array(np.full(n, None), dtype='UInt8')
+    changes['OriginalPayload'] = original['Payload'].to_numpy() if original is not None else np.full(n, None, dtype=object)
+    changes['ChangedBits'] = changed_bits if changed_bits is not None else np.zeros(n, dtype=np.int64)
+    changes['BitMask'] = masks if masks is not None else np.full(n, None, dtype=object)
+    return changes[DIFF_COLUMNS]
+
+
+if __name__ == "__main__":
+    from basic_attack import to_export_frame, EXPORT_FLOAT_FORMAT
+
+    parser = ArgumentParser(description='Diff two CAN traces sorted by time, e.g. an original trace and a vulnerable dataset')
+    parser.add_argument('original',
+                            type=str,
+                            help='The original trace, a csv or a columnar cache folder')
+    parser.add_argument('vulnerable',
+                            type=str,
+                            help='The trace compared with it, a csv or a columnar cache folder')
+    parser.add_argument('-o', '--output',
+                            type=str,
+                            default=None,
+                            help='The csv where to write the changed frames')
+    parser.add_argument('--chunk_rows',
+                            type=int,
+                            default=CHUNK_ROWS,
+                            help='The number of frames read at a time from every trace')
+    args = parser.parse_args()
+
+    def written(changes, f):
+        # The changes are written as they are counted
+        for i, chunk in enumerate(changes):
+            to_export_frame(chunk).to_csv(f, header=i == 0, index=False, float_format=EXPORT_FLOAT_FORMAT)
+            yield chunk
+
+    with open(args.output if args.output is not None else os.devnull, 'w') as f:
+        stats = diff_stats(written(diff_traces(args.original, args.vulnerable, chunk_rows=args.chunk_rows), f))
+    print(json.dumps(stats, indent=4))
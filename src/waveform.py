@@ -0,0 +1,129 @@
+import numpy as np
+
+"""
+    Waveform specs of a signal, evaluated into the payloads of progressive attacks only when they are built.
+
+    A spec is a dict of the configuration, e.g. {"type": "ramp", "n_packets": 1000, "start": 0, "stop": 255}, giving the
+    values of a signal in the frames of the attack:
+        - ramp: from start to stop, linearly
+        - step: start up to the packet at (by default the middle one), then stop
+        - sine: offset + amplitude * sin(2 * pi * packet / period + phase), the period in packets
+        - random_walk: from start, changing by a random integer in [-step, step] at every packet (with the seed if given)
+        - table: the values, each repeated repeat times (1 by default), cycled over n_packets if given
+    The values are rounded and clipped to the range of the signal. The signal is in the bits [start, end) of the
+    payloads given as "bits", or found by READ: the signal at position "signal" of the signals of the id sorted by
+    their first bit, by default the longest physical value.
+"""
+
+WAVEFORM_TYPES = ('RAMP', 'STEP', 'SINE', 'RANDOM_WALK', 'TABLE')
+WAVEFORM_PARAMETERS = {'RAMP': ('start', 'stop'),
+                       'STEP': ('start', 'stop'),
+                       'SINE': ('offset', 'amplitude', 'period'),
+                       'RANDOM_WALK': ('start', 'step'),
+                       'TABLE': ('values',)}
+
+
+def check_waveform(waveform):
+    """
+    Validate a waveform spec, raising a ValueError if it is not valid
+    """
+    if type(waveform) != dict:
+        raise ValueError('A waveform must be a dict')
+    waveform_type = str(waveform.get('type', '')).upper()
+    if waveform_type not in WAVEFORM_TYPES:
+        raise ValueError('Invalid waveform type %s, it must be one of %s' % (waveform.get('type'), ', '.join(x.lower() for x in WAVEFORM_TYPES)))
+    for parameter in WAVEFORM_PARAMETERS[waveform_type]:
+        if parameter not in waveform:
+            raise ValueError('The parameter %s is needed for %s waveforms' % (parameter, waveform_type.lower()))
+
+    if waveform_type == 'TABLE':
+        values = waveform['values']
+        if type(values) != list or len(values) == 0 or any(type(x) != int or x < 0 for x in values):
+            raise ValueError('The values of a table waveform must be a non empty list of non negative integers')
+        if type(waveform.get('repeat', 1)) != int or waveform.get('repeat', 1) <= 0:
+            raise ValueError('The repeat of a table waveform must be a positive integer')
+    if waveform_type != 'TABLE' or 'n_packets' in waveform:
+        if type(waveform.get('n_packets')) != int or waveform['n_packets'] <= 0:
+            raise ValueError('The n_packets of a waveform must be a positive integer')
+    if waveform_type == 'SINE' and waveform['period'] <= 0:
+        raise ValueError('The period of a sine waveform must be positive')
+    if waveform_type == 'RANDOM_WALK' and (type(waveform['step']) != int or waveform['step'] < 0):
+        raise ValueError('The step of a random walk waveform must be a non negative integer')
+
+    if 'bits' in waveform:
+        bits = waveform['bits']
+        if type(bits) not in (list, tuple) or len(bits) != 2 or not 0 <= bits[0] < bits[1] or bits[1] - bits[0] > 64:
+            raise ValueError('The bits of a waveform must be a [start, end) range of 1 to 64 bits')
+    if 'signal' in waveform and type(waveform['signal']) != int:
+        raise ValueError('The signal of a waveform must be the position of a READ signal')
+
+
+def waveform_length(waveform):
+    """
+    Return the number of packets of the waveform
+    """
+    if 'n_packets' in waveform:
+        return waveform['n_packets']
+    return len(waveform['values']) * waveform.get('repeat', 1)
+
+
+def waveform_bit_range(waveform, signals=None):
+    """
+    Return the bit range (start, end) of the signal of the waveform
+
+    Parameters
+    ----------
+    signals: list, optional
+        The signals found by READ in the payloads of the id (see AttackContext.signals), needed when the waveform does
+        not give its bits
+    """
+    if 'bits' in waveform:
+        return (int(waveform['bits'][0]), int(waveform['bits'][1]))
+    from read import SIGN_TYPE
+    signals = sorted(signals if signals is not None else [], key=lambda x: x[0])
+    if 'signal' in waveform:
+        if not -len(signals) <= waveform['signal'] < len(signals):
+            raise ValueError('READ found %d signals, there is no signal %d' % (len(signals), waveform['signal']))
+        signal = signals[waveform['signal']]
+    else:
+        physical = [x for x in signals if x[2] == SIGN_TYPE.PHYSVAL]
+        if len(physical) == 0:
+            raise ValueError('READ found no physical value to bind the waveform to, its bits are needed')
+        signal = max(physical, key=lambda x: x[1] - x[0])
+    if signal[1] - signal[0] > 64:
+        raise ValueError('The signal of a waveform can be 64 bits long at most')
+    return (int(signal[0]), int(signal[1]))
+
+
+def waveform_values(waveform, n_bits):
+    """
+    Return the values of the waveform as a uint64 array, one per packet, for a signal of n_bits bits
+    """
+    assert 0 < n_bits <= 64
+    waveform_type = waveform['type'].upper()
+    n = waveform_length(waveform)
+    top = (1 << n_bits) - 1
+
+    if waveform_type == 'TABLE':
+        values = np.array([min(x, top) for x in waveform['values']], dtype=np.uint64)
+        return np.resize(np.repeat(values, waveform.get('repeat', 1)), n)
+
+    packets = np.arange(n)
+    if waveform_type == 'RAMP':
+        signal = np.linspace(waveform['start'], waveform['stop'], n)
+    elif waveform_type == 'STEP':
+        signal = np.where(packets < waveform.get('at', n // 2), waveform['start'], waveform['stop']).astype(np.float64)
+    elif waveform_type == 'SINE':
+        signal = waveform['offset'] + waveform['amplitude'] * np.sin(2 * np.pi * packets / waveform['period'] + waveform.get('phase', 0))
+    else:
+        rng = np.random.RandomState(waveform['seed']) if 'seed' in waveform else np.random
+        steps = rng.randint(-waveform['step'], waveform['step'] + 1, size=n)
+        steps[0] = 0
+        signal = waveform['start'] + np.cumsum(steps).astype(np.float64)
+
+    # Rounded and clipped to the range of the signal, the top is set apart as it may not fit a float
+    signal = np.rint(signal)
+    below_top = signal < float(top)
+    values = np.full(n, top, dtype=np.uint64)
+    values[below_top] = np.maximum(signal[below_top], 0).astype(np.uint64)
+    return values